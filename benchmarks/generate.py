@@ -0,0 +1,158 @@
+"""Генератор синтетических логов BBOX для замеров производительности.
+
+    python -m benchmarks.generate <каталог> [--stations 2] [--trks 4] [--fuels 3]
+                                  [--days 7] [--per-hour 12] [--seed 1] [--clogs 0]
+
+Создает по файлу на АЗС и день (<каталог>/<АЗС>/<ГГГГММДД>/BBOX.XML) в
+кодировке windows-1251. В потоке есть служебные строки, которые анализатор
+пропускает, перемещения заказа между ТРК, счетчики NAN и переходы счетчика
+через 1 000 000 л. С --clogs у нескольких рукавов скорость налива со
+случайного дня плавно падает — так имитируется засор фильтра.
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+FUEL_NAMES = ("АИ-92", "АИ-95", "ДТ", "АИ-98", "Газ")
+NOISE_ACTIONS = ("Смена: открыта; Кассир: Иванов", "Чек напечатан; Сумма: 1500,00",
+                 "Связь с процессингом восстановлена", "ТРК : {trk}; Статус: свободна",
+                 "Тр: {tr}; Оплата принята; Тип: наличные")
+
+
+class LogGenerator:
+    def __init__(self, stations=2, trks=4, fuels=3, days=7, per_hour=12, seed=1,
+                 move_rate=0.02, nan_rate=0.01, noise_rows=4, start=datetime(2024, 3, 1), clogs=0, clog_drop=0.4):
+        self.stations = stations
+        self.trks = trks
+        self.fuels = FUEL_NAMES[:fuels]
+        self.days = days
+        self.per_hour = per_hour
+        self.move_rate = move_rate
+        self.nan_rate = nan_rate
+        self.noise_rows = noise_rows
+        self.start = start
+        self.random = random.Random(seed)
+        self.transaction = 3000000
+        self.counters = dict()  # (АЗС, ТРК, рукав) -> показание счетчика
+        # (АЗС, ТРК, рукав) -> день начала засора; свой генератор, чтобы остальной поток не зависел от clogs
+        self.clog_drop = clog_drop
+        self.clogged = dict()
+        clog_random = random.Random(seed + 1)
+        keys = [(f"АЗС{station:03d}", trk, hose) for station in range(1, stations + 1)
+                for trk in range(1, trks + 1) for hose in range(1, len(self.fuels) + 1)]
+        for key in clog_random.sample(keys, min(clogs, len(keys))):
+            self.clogged[key] = clog_random.randint(days // 3, max(days // 3, days - 3))
+
+    def _counter(self, key):
+        if key not in self.counters:
+            # Часть рукавов начинает у самого конца шкалы, чтобы счетчик переходил через 1 000 000
+            if self.random.random() < 0.3:
+                self.counters[key] = self.random.uniform(999000, 999990)
+            else:
+                self.counters[key] = self.random.uniform(0, 900000)
+        return self.counters[key]
+
+    def _clog_factor(self, key, moment):
+        """Доля нормальной скорости: с начала засора падает линейно до 1 - clog_drop к последнему дню"""
+        clog_day = self.clogged.get(key)
+        if clog_day is None:
+            return 1.0
+        clog_start = self.start + timedelta(days=clog_day)
+        if moment <= clog_start:
+            return 1.0
+        progress = (moment - clog_start) / (self.start + timedelta(days=self.days) - clog_start)
+        return 1.0 - self.clog_drop * min(progress, 1.0)
+
+    @staticmethod
+    def _row(moment, host, action):
+        stamp = moment.strftime("%Y%m%dT%H:%M:%S") + "%03d" % (moment.microsecond // 1000)
+        action = action.replace('&', '&amp;').replace('"', '&quot;').replace('<', '&lt;')
+        return f'<ROW DATETIME="{stamp}" HOST="{host}" ACTION="{action}" />\n'
+
+    def _noise(self, moment, host, trk):
+        action = self.random.choice(NOISE_ACTIONS).format(trk=trk, tr=self.transaction)
+        return self._row(moment, host, action)
+
+    def day_rows(self, station, day):
+        """Строки одного дня одной АЗС"""
+        host = f"{station} - SRV01"
+        moment = self.start + timedelta(days=day)
+        end = moment + timedelta(days=1)
+        mean_gap = 3600 / self.per_hour
+        while True:
+            moment += timedelta(seconds=self.random.expovariate(1 / mean_gap))
+            if moment >= end:
+                break
+            self.transaction += 1
+            trk = self.random.randint(1, self.trks)
+            hose = self.random.randint(1, len(self.fuels))
+            fuel = self.fuels[hose - 1]
+            for _ in range(self.random.randint(0, self.noise_rows)):
+                yield self._noise(moment, host, trk)
+            yield self._row(moment, host, f"ТРК : {trk}; Снят пистолет; Рукав: {hose}")
+            yield self._row(moment, host, f"Тр: {self.transaction}; Доза установлена; ТРК: {trk}; "
+                                          f"Прод.: {fuel}; Объем: 50,00")
+            key = (station, trk, hose)
+            counter = self._counter(key)
+            yield self._row(moment, host, f"ТРК : {trk}; Установка дозы; Рукав: {hose}; "
+                                          f"Счетчик: {counter:.2f}".replace('.', ','))
+            if self.random.random() < self.move_rate:
+                other = self.random.randint(1, self.trks)
+                yield self._row(moment, host, f"Тр: {self.transaction}; Топливный заказ перемещен "
+                                              f"с ТРК: {trk} на ТРК: {other}")
+                continue
+            moment += timedelta(seconds=self.random.uniform(3, 15))
+            yield self._row(moment, host, f"ТРК : {trk}; На ТРК идет отпуск топлива")
+            liters = self.random.uniform(5, 60)
+            flow = self.random.gauss(40, 3) * self._clog_factor(key, moment)  # л/мин
+            moment += timedelta(seconds=liters / flow * 60)
+            yield self._row(moment, host, f"ТРК : {trk}; На ТРК закончен отпуск топлива")
+            yield self._row(moment, host, f"Тр: {self.transaction}; Налив зафиксирован (ТРК: {trk}; "
+                                          f"Прод.: {fuel}; Объем: {liters:.2f})")
+            counter = (counter + liters) % 1000000
+            self.counters[key] = counter
+            if self.random.random() < self.nan_rate:
+                yield self._row(moment, host, f"ТРК : {trk}; Конец транзакции; Счетчик: NAN")
+            else:
+                yield self._row(moment, host, f"ТРК : {trk}; Конец транзакции; "
+                                              f"Счетчик: {counter:.2f}".replace('.', ','))
+
+    def write(self, directory):
+        """Пишет все файлы и возвращает список их путей"""
+        paths = []
+        for number in range(1, self.stations + 1):
+            station = f"АЗС{number:03d}"
+            for day in range(self.days):
+                folder = os.path.join(directory, station, (self.start + timedelta(days=day)).strftime("%Y%m%d"))
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, "BBOX.XML")
+                with open(path, 'w', encoding='cp1251') as f:
+                    f.write('<?xml version="1.0" encoding="windows-1251"?>\n<ROWDATA>\n')
+                    f.writelines(self.day_rows(station, day))
+                    f.write('</ROWDATA>\n')
+                paths.append(path)
+        return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генератор синтетических логов BBOX")
+    parser.add_argument('directory')
+    parser.add_argument('--stations', type=int, default=2)
+    parser.add_argument('--trks', type=int, default=4, help="ТРК на АЗС")
+    parser.add_argument('--fuels', type=int, default=3, help="рукавов (видов топлива) на ТРК")
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--per-hour', type=float, default=12, help="транзакций в час на АЗС")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--clogs', type=int, default=0, help="рукавов с засором фильтра")
+    args = parser.parse_args()
+    generator = LogGenerator(args.stations, args.trks, args.fuels, args.days, args.per_hour, args.seed,
+                             clogs=args.clogs)
+    paths = generator.write(args.directory)
+    print(f"Создано файлов: {len(paths)}")
+    for (station, trk, hose), day in sorted(generator.clogged.items()):
+        print(f"Засор: {station}, ТРК {trk}, рукав {hose}, с {(generator.start + timedelta(days=day)).date()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""Замеры производительности на синтетических логах.
+
+    python -m benchmarks.run [--scenario small medium] [--output bench_results.json] [--workers 4]
+
+Для каждого сценария генерируются логи (benchmarks.generate) и замеряются:
+скорость разбора в каждом режиме BBOXParser (строк/с, МБ/с), пиковая память
+разбора (tracemalloc), разбор в пуле процессов, разбор тех же логов из
+архивов .zip и .XML.gz (скорость и место на диске), восстановление транзакций
+и построение индекса, поиск засоров, агрегаты по часам/дням/неделям, время перерисовки графика (matplotlib Agg, без Qt),
+частичные результаты: каждая АЗС — отдельный процесс main.py partial вместо узла, плюс узел
+с копией одной АЗС, слияние их результатов и сравнение с разбором на одной машине.
+Результаты пишутся в JSON, чтобы сравнивать версии между собой.
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generate import LogGenerator  # noqa: E402
+from src.detect import ClogDetector  # noqa: E402
+from src.engine import TransactionEngine, merge_events  # noqa: E402
+from src.files import find_bbox_files  # noqa: E402
+from src.index import SeriesIndex  # noqa: E402
+from src.ingest import iter_partials  # noqa: E402
+from src.parser import PARSE_MODES, BBOXParser  # noqa: E402
+from src.partial import PartialResult, load_partials  # noqa: E402
+from src.rollup import Rollups  # noqa: E402
+
+SCENARIOS = {
+    'small': dict(stations=1, trks=4, fuels=3, days=3, per_hour=12),
+    'medium': dict(stations=4, trks=6, fuels=3, days=14, per_hour=20),
+    'large': dict(stations=10, trks=8, fuels=4, days=30, per_hour=30),
+    # Большинство строк — служебные, анализатору не нужные
+    'noisy': dict(stations=4, trks=6, fuels=3, days=14, per_hour=20, noise_rows=60),
+    # Засоры фильтров у нескольких рукавов — для проверки детектора
+    'clogs': dict(stations=4, trks=6, fuels=3, days=45, per_hour=20, clogs=5),
+}
+
+
+def count_rows(paths):
+    rows = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                rows += chunk.count(b'<ROW ')
+    return rows
+
+
+def snapshot(parser):
+    """Все, что отдает разбор: по нему режимы сравниваются с 'tree'"""
+    events = [[(event.kind, event.station, event.trk, event.timestamp, event.hose, repr(event.counter),
+                event.fuel, event.target) for event in file_data] for file_data in parser.data]
+    return parser.gas_stations, parser.GlobalDict, parser.fuels, parser.columns, parser.files, events
+
+
+def bench_parse(paths, mode, size, rows):
+    parser = BBOXParser(mode)
+    started = time.perf_counter()
+    for path in paths:
+        parser.parse_file(path)
+    seconds = time.perf_counter() - started
+
+    # Память меряется отдельным проходом: tracemalloc замедляет разбор
+    tracemalloc.start()
+    peak = 0
+    for path in paths:
+        tracemalloc.reset_peak()
+        BBOXParser(mode).parse_file(path)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    return parser, {
+        'seconds': round(seconds, 4),
+        'rows_per_s': round(rows / seconds),
+        'mb_per_s': round(size / seconds / 1e6, 2),
+        'events': sum(len(file_data) for file_data in parser.data),
+        'peak_file_mb': round(peak / 1e6, 2),
+    }
+
+
+def bench_parallel(paths, workers):
+    parser = BBOXParser('stream')
+    started = time.perf_counter()
+    for _, _, partial, _ in iter_partials(paths, parser.mode, workers):
+        if partial is not None:
+            parser.merge(partial)
+    return {'workers': workers, 'seconds': round(time.perf_counter() - started, 4)}
+
+
+def pack_archives(paths, directory):
+    """Копии логов: .zip на каждую АЗС и .XML.gz рядом с каждым днем; возвращает {формат: каталог}"""
+    roots = {'zip': os.path.join(directory, '_zip'), 'gz': os.path.join(directory, '_gz')}
+    archives = dict()
+    for path in paths:
+        relative = os.path.relpath(path, directory)
+        station = relative.split(os.sep)[0]
+        if station not in archives:
+            os.makedirs(roots['zip'], exist_ok=True)
+            archives[station] = zipfile.ZipFile(os.path.join(roots['zip'], station + '.zip'), 'w',
+                                                zipfile.ZIP_DEFLATED)
+        archives[station].write(path, relative.replace(os.sep, '/'))
+        target = os.path.join(roots['gz'], relative + '.gz')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(path, 'rb') as source, gzip.open(target, 'wb') as packed:
+            shutil.copyfileobj(source, packed)
+    for archive in archives.values():
+        archive.close()
+    return roots
+
+
+def disk_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def bench_formats(paths, directory, size, workers):
+    """Потоковый разбор тех же логов без сжатия, из .zip и из .gz; архивы не распаковываются на диск"""
+    roots = pack_archives(paths, directory)
+    formats = {'xml': (paths, disk_bytes(paths))}
+    for name, root in roots.items():
+        files = [os.path.join(folder, file) for folder, _, names in os.walk(root) for file in names]
+        formats[name] = (find_bbox_files(root), disk_bytes(files))
+    result = dict()
+    reference = None
+    for name, (found, on_disk) in formats.items():
+        parser = BBOXParser('stream')
+        started = time.perf_counter()
+        for path in found:
+            parser.parse_file(path)
+        seconds = time.perf_counter() - started
+        # Пути файлов у форматов разные, сравниваются только события
+        events = sorted(repr(file_data) for file_data in snapshot(parser)[5])
+        reference = reference or events
+        parallel = bench_parallel(found, workers)
+        result[name] = {
+            'files': len(found),
+            'disk_bytes': on_disk,
+            'seconds': round(seconds, 4),
+            'mb_per_s': round(size / seconds / 1e6, 2),  # По распакованному объему
+            'parallel_seconds': parallel['seconds'],
+            # Столько места заняла бы предварительная распаковка; при потоковом разборе на диск ничего не пишется
+            'unpacked_bytes': size if name != 'xml' else 0,
+            'matches_xml': events == reference,
+        }
+    return result
+
+
+def bench_reconstruct(parser):
+    started = time.perf_counter()
+    engine = TransactionEngine()
+    engine.feed(merge_events(parser.data))
+    transactions = engine.transactions()
+    reconstructed = time.perf_counter() - started
+    index = SeriesIndex(transactions)
+    indexed = time.perf_counter() - started - reconstructed
+    started = time.perf_counter()
+    detector = ClogDetector()
+    detector.update(transactions)
+    detected = time.perf_counter() - started
+    started = time.perf_counter()
+    Rollups.from_transactions(transactions)
+    rolled_up = time.perf_counter() - started
+    return index, {
+        'transactions': len(transactions),
+        'outliers': int(transactions.outlier.sum()),
+        'seconds': round(reconstructed, 4),
+        'index_seconds': round(indexed, 4),
+        'detect_seconds': round(detected, 4),
+        'rollup_seconds': round(rolled_up, 4),
+        'alerts': len(detector.alerts()),
+        'transactions_per_s': round(len(transactions) / reconstructed) if reconstructed else None,
+    }
+
+
+def bench_redraw(index, repeats=5):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    from src.chart import FlowChart
+
+    if not index.series:
+        return {}
+    # Самый длинный ряд — худший случай для графика
+    key, (lo, hi) = max(index.series.items(), key=lambda item: item[1][1] - item[1][0])
+    figure = Figure(figsize=(12, 5), dpi=100)
+    FigureCanvasAgg(figure)
+    chart = FlowChart(figure.add_subplot(111))
+
+    def timed(action):
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            action()
+            figure.canvas.draw()
+            samples.append(time.perf_counter() - started)
+        return round(sorted(samples)[len(samples) // 2] * 1000, 2)
+
+    full = timed(lambda: chart.set_data(index.start[lo:hi], index.duration[lo:hi], index.flow[lo:hi],
+                                        index.mean_flow(lo, hi)))
+    x0, x1 = chart.ax.get_xlim()
+    middle = (x0 + x1) / 2
+    zoomed = timed(lambda: chart.ax.set_xlim(middle, middle + (x1 - x0) / 500))
+    return {'series_transactions': hi - lo, 'full_range_ms': full, 'zoomed_ms': zoomed}
+
+
+def bench_partials(directory, index):
+    """Узлы — процессы main.py partial по каталогу каждой АЗС и еще один по копии первой АЗС"""
+    output = os.path.join(directory, '_partials')
+    os.makedirs(output, exist_ok=True)
+    stations = sorted(name for name in os.listdir(directory) if not name.startswith('_'))
+    hosts = [(station, os.path.join(directory, station)) for station in stations]
+    hosts.append(('copy', os.path.join(directory, stations[0])))
+    main_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+    started = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, main_py, 'partial', path, '-o', os.path.join(output, name + '.bbp'),
+                                   '--no-cache', '--workers', '1'], stderr=subprocess.DEVNULL)
+                 for name, path in hosts]
+    failed = sum(process.wait() != 0 for process in processes)
+    hosts_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    results, errors = load_partials([output])
+    merged = PartialResult.merge_all(results)
+    merge_seconds = time.perf_counter() - started
+    merged_index = SeriesIndex(merged.transactions())
+    files = sum(len(result.files) for result in results)
+    on_disk = disk_bytes(os.path.join(output, name) for name in os.listdir(output))
+    return {
+        'hosts': len(hosts),
+        'failed': failed + len(errors),
+        'hosts_seconds': round(hosts_seconds, 4),
+        'merge_seconds': round(merge_seconds, 4),
+        'files': files,
+        'duplicated': files - len(merged.files),
+        'disk_bytes': on_disk,
+        'bytes_per_transaction': round(on_disk / len(merged), 2) if len(merged) else None,
+        'matches_direct': same_series(merged_index, index),
+    }
+
+
+def same_series(index, other):
+    """Одинаковые ряды с одинаковыми транзакциями; порядок рядов в массивах зависит от кодов станций и топлива"""
+    if index.series.keys() != other.series.keys():
+        return False
+    for key, (lo, hi) in index.series.items():
+        other_lo, other_hi = other.series[key]
+        if not (np.array_equal(index.start[lo:hi], other.start[other_lo:other_hi]) and
+                np.array_equal(index.flow[lo:hi], other.flow[other_lo:other_hi])):
+            return False
+    return True
+
+
+def run_scenario(name, params, workers, keep):
+    directory = tempfile.mkdtemp(prefix=f"bbox_bench_{name}_")
+    try:
+        started = time.perf_counter()
+        paths = LogGenerator(**params).write(directory)
+        generated = time.perf_counter() - started
+        size = sum(os.path.getsize(path) for path in paths)
+        rows = count_rows(paths)
+        result = {'params': params, 'files': len(paths), 'bytes': size, 'rows': rows,
+                  'generate_seconds': round(generated, 2), 'parse': dict()}
+        parser = None
+        reference = None
+        for mode in PARSE_MODES:
+            parser, result['parse'][mode] = bench_parse(paths, mode, size, rows)
+            reference = reference or snapshot(parser)
+            result['parse'][mode]['matches_tree'] = snapshot(parser) == reference
+            print(f"  {mode}: {result['parse'][mode]}")
+        result['parallel'] = bench_parallel(paths, workers)
+        print(f"  parallel: {result['parallel']}")
+        result['formats'] = bench_formats(paths, directory, size, workers)
+        for name, values in result['formats'].items():
+            print(f"  {name}: {values}")
+        index, result['reconstruct'] = bench_reconstruct(parser)
+        print(f"  reconstruct: {result['reconstruct']}")
+        result['redraw'] = bench_redraw(index)
+        print(f"  redraw: {result['redraw']}")
+        result['partials'] = bench_partials(directory, index)
+        print(f"  partials: {result['partials']}")
+        return result
+    finally:
+        if keep:
+            print(f"  логи сохранены в {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности анализатора BBOX")
+    parser.add_argument('--scenario', nargs='+', choices=sorted(SCENARIOS), default=['small', 'medium'])
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--keep', action='store_true', help="не удалять сгенерированные логи")
+    args = parser.parse_args()
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scenarios': dict(),
+    }
+    for name in args.scenario:
+        print(f"Сценарий {name}: {SCENARIOS[name]}")
+        results['scenarios'][name] = run_scenario(name, SCENARIOS[name], args.workers, args.keep)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
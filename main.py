@@ -1,11 +1,31 @@
 import sys
+import time
 
-from PyQt5.QtWidgets import QApplication
+STARTED = time.perf_counter()
 
-from src.main_window import MainWindow
 
-if __name__ == '__main__':
+def main():
+    # Qt и matplotlib загружаются только для окна; отчет и процессы-разборщики обходятся без них
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        from src.cli import main as report
+        return report(sys.argv[2:], STARTED)
+    if len(sys.argv) > 1 and sys.argv[1] == 'partial':
+        from src.cli import partial_main
+        return partial_main(sys.argv[2:], STARTED)
+    if len(sys.argv) > 1 and sys.argv[1] == 'history':
+        from src.cli import history_main
+        return history_main(sys.argv[2:])
+
+    from PyQt5.QtWidgets import QApplication
+
+    from src.main_window import MainWindow
+
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
-    sys.exit(app.exec_())
+    window.log_message(f"Время запуска: {(time.perf_counter() - STARTED) * 1000:.0f} мс")
+    return app.exec_()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
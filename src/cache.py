@@ -0,0 +1,113 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import zlib
+
+from src.files import source_stat
+from src.metrics import Metrics
+from src.parser import PARSER_VERSION
+
+
+def default_cache_dir(name='parse'):
+    """Каталог кэша пользователя: %LOCALAPPDATA% в Windows, $XDG_CACHE_HOME или ~/.cache в остальных системах"""
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'bbox_analyzer', name)
+
+
+class ParseCache:
+    """Кэш результатов разбора на диске.
+
+    Ключ — путь, размер и время изменения файла (для файла внутри .zip — архива) плюс PARSER_VERSION, так что
+    измененный файл или новая версия парсера просто не найдут старую запись.
+    Записи — сжатый pickle частичного BBOXParser одного файла. Общий размер
+    ограничен max_bytes: при превышении удаляются давно не читавшиеся записи.
+    Испорченная запись считается промахом и попадает в metrics.warnings,
+    сбой записи — в метрики самого результата разбора.
+    """
+    SUFFIX = '.bin'
+
+    def __init__(self, directory=None, max_bytes=2 * 1024 ** 3):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.metrics = Metrics()
+
+    def key(self, file_path):
+        stat = source_stat(file_path)
+        raw = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{PARSER_VERSION}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, file_path):
+        """Возвращает закэшированный частичный парсер или None"""
+        try:
+            entry = self._entry_path(self.key(file_path))
+            with open(entry, 'rb') as f:
+                partial = pickle.loads(zlib.decompress(f.read()))
+            os.utime(entry)  # Отмечаем использование для вытеснения давно не читавшихся записей
+            return partial
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.metrics.warn('cache_errors', file_path, f"запись кэша не читается: {str(e)}")
+            self.invalidate(file_path)
+            return None
+
+    def put(self, file_path, partial):
+        """Сохраняет результат разбора; сбой записи попадает в partial.metrics (put вызывается и в процессе-разборщике)"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            payload = zlib.compress(pickle.dumps(partial, protocol=pickle.HIGHEST_PROTOCOL), 1)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, self._entry_path(self.key(file_path)))
+        except Exception as e:
+            partial.metrics.warn('cache_errors', file_path, f"не удалось сохранить в кэш: {str(e)}")
+
+    def invalidate(self, file_path):
+        try:
+            os.remove(self._entry_path(self.key(file_path)))
+        except OSError:
+            pass
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if name.endswith(self.SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Удаляет самые давние записи, пока кэш не уложится в max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
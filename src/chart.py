@@ -0,0 +1,244 @@
+import numpy as np
+import matplotlib.dates as mdates
+from matplotlib.collections import PolyCollection
+
+US_PER_DAY = 86400000000
+LEGEND_SERIES = 12  # При большем числе рядов в сравнении легенда не выводится
+
+
+class FlowChart:
+    """График скорости налива с уровнем детализации.
+
+    Если в видимом диапазоне транзакций больше, чем пикселей по ширине
+    области графика, они сворачиваются в интервалы времени: полоса min–max,
+    линия среднего и число транзакций на второй оси. При приближении
+    рисуется каждая транзакция отдельным столбцом. Оси и художники
+    создаются один раз и только обновляются, перерисовка вызывается при
+    смене данных и при масштабировании/сдвиге графика. Вычисления (prepare,
+    layout) отделены от обновления художников (show), поэтому данные нового
+    выбора можно готовить в фоновом потоке.
+
+    В режиме сравнения (prepare_comparison) на тех же осях рисуются линии
+    средней скорости нескольких рядов на общей сетке интервалов; линии
+    берутся из пула и переиспользуются при следующих выборах.
+    """
+
+    def __init__(self, ax):
+        self.ax = ax
+        self.count_ax = ax.twinx()
+        self._epoch = mdates.date2num(np.datetime64(0, 'us'))  # Число matplotlib для 1970-01-01
+        self.bars = PolyCollection([], facecolors="blue", edgecolors="none")
+        self.band = PolyCollection([], facecolors="blue", edgecolors="none", alpha=0.35)
+        ax.add_collection(self.bars)
+        ax.add_collection(self.band)
+        self.bucket_mean, = ax.plot([], [], color="blue", linewidth=1)
+        self.mean_line = ax.axhline(0, color="red", visible=False)
+        self.count_line, = self.count_ax.plot([], [], color="gray", linewidth=0.8, drawstyle="steps-mid")
+
+        ax.xaxis_date()
+        locator = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator(locator)
+        # При приближении подписи переходят с дат на часы и минуты
+        ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator, defaultfmt='%Y-%m-%d'))
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.set_ylim(0, 100)
+        ax.set_xlabel("Дата")
+        ax.set_ylabel("Скорость")
+        self.count_ax.set_ylabel("Транзакций")
+        self.count_ax.set_visible(False)
+        self.series_lines = []  # Пул линий режима сравнения
+        self.comparing = False
+
+        self.start = np.empty(0, dtype=np.int64)
+        self.duration = np.empty(0, dtype=np.int64)
+        self.flow = np.empty(0)
+        self._updating = False
+        ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+
+    def _to_num(self, us):
+        return self._epoch + us / US_PER_DAY
+
+    def _to_us(self, num):
+        return int((num - self._epoch) * US_PER_DAY)
+
+    def set_data(self, start, duration, flow, mean, title=""):
+        """start/duration — микросекунды (start отсортирован), flow — л/мин, mean — средняя линия"""
+        self.show(self.prepare(start, duration, flow, mean, title, self.width()))
+
+    def width(self):
+        """Ширина области графика в пикселях — число интервалов при сворачивании"""
+        return max(1, int(self.ax.bbox.width))
+
+    def prepare(self, start, duration, flow, mean, title, buckets):
+        """Все вычисления для set_data без обращения к художникам — можно вызывать из фонового потока"""
+        if not len(start):
+            return None
+        x0 = self._to_num(start[0])
+        x1 = self._to_num(start[-1] + duration[-1])
+        margin = (x1 - x0) * 0.05 or 1 / 24
+        xlim = (x0 - margin, x1 + margin)
+        return {
+            'start': start,
+            'duration': duration,
+            'flow': flow,
+            'mean': mean,
+            'title': title,
+            'xlim': xlim,
+            'geometry': self.layout(start, duration, flow, *xlim, buckets),
+        }
+
+    def prepare_comparison(self, edges, mean, labels, title):
+        """Линии рядов сравнения: edges — границы общей сетки (микросекунды), mean — ряды x интервалы"""
+        if not len(labels):
+            return None
+        centers = self._to_num((edges[:-1] + edges[1:]) / 2)
+        return {
+            'centers': centers,
+            'mean': mean,
+            'labels': labels,
+            'title': title,
+            'xlim': (self._to_num(edges[0]), self._to_num(edges[-1])),
+        }
+
+    def show(self, prepared):
+        """Применяет результат prepare или prepare_comparison к художникам (в потоке интерфейса)"""
+        if prepared is None:
+            self.clear()
+            return
+        if 'labels' in prepared:
+            self._show_comparison(prepared)
+            return
+        self._hide_comparison()
+        self.start = prepared['start']
+        self.duration = prepared['duration']
+        self.flow = prepared['flow']
+        self.ax.set_title(prepared['title'], fontsize='small')
+        self.mean_line.set_ydata([prepared['mean'], prepared['mean']])
+        self.mean_line.set_visible(True)
+        self._updating = True
+        try:
+            self.ax.set_xlim(*prepared['xlim'])
+        finally:
+            self._updating = False
+        self._apply(prepared['geometry'])
+
+    def _show_comparison(self, prepared):
+        self.start = np.empty(0, dtype=np.int64)
+        self.duration = np.empty(0, dtype=np.int64)
+        self.flow = np.empty(0)
+        self.comparing = True
+        self.bars.set_verts([])
+        self.band.set_verts([])
+        self.bucket_mean.set_data([], [])
+        self.count_line.set_data([], [])
+        self.count_ax.set_visible(False)
+        self.mean_line.set_visible(False)
+        labels = prepared['labels']
+        while len(self.series_lines) < len(labels):
+            self.series_lines.append(self.ax.plot([], [], linewidth=1)[0])
+        for line, values, label in zip(self.series_lines, prepared['mean'], labels):
+            line.set_data(prepared['centers'], values)
+            line.set_label(label)
+            line.set_visible(True)
+        for line in self.series_lines[len(labels):]:
+            line.set_data([], [])
+            line.set_visible(False)
+        legend = self.ax.get_legend()
+        if len(labels) <= LEGEND_SERIES:
+            self.ax.legend(handles=self.series_lines[:len(labels)], fontsize='x-small', loc='upper right')
+        elif legend is not None:
+            legend.remove()
+        self.ax.set_title(prepared['title'], fontsize='small')
+        self._updating = True
+        try:
+            self.ax.set_xlim(*prepared['xlim'])
+        finally:
+            self._updating = False
+        self.ax.figure.canvas.draw_idle()
+
+    def _hide_comparison(self):
+        if not self.comparing:
+            return
+        self.comparing = False
+        for line in self.series_lines:
+            line.set_data([], [])
+            line.set_visible(False)
+        if self.ax.get_legend() is not None:
+            self.ax.get_legend().remove()
+
+    def clear(self):
+        self._hide_comparison()
+        self.start = np.empty(0, dtype=np.int64)
+        self.duration = np.empty(0, dtype=np.int64)
+        self.flow = np.empty(0)
+        self.bars.set_verts([])
+        self.band.set_verts([])
+        self.bucket_mean.set_data([], [])
+        self.count_line.set_data([], [])
+        self.count_ax.set_visible(False)
+        self.mean_line.set_visible(False)
+        self.ax.set_title("")
+        self.ax.figure.canvas.draw_idle()
+
+    def _on_xlim_changed(self, ax):
+        # Сетка сравнения считается на весь период, при масштабировании линии только перерисовываются
+        if not self._updating and not self.comparing:
+            self.refresh()
+
+    def refresh(self):
+        """Перестраивает видимую часть; работа ограничена шириной графика в пикселях"""
+        self._apply(self.layout(self.start, self.duration, self.flow, *self.ax.get_xlim(), self.width()))
+
+    def layout(self, start, duration, flow, x0, x1, buckets):
+        """Геометрия видимой части [x0, x1] (числа дат matplotlib): столбцы транзакций или свернутые интервалы"""
+        lo_us, hi_us = self._to_us(x0), self._to_us(x1)
+        i, j = np.searchsorted(start, [lo_us, hi_us])
+        if j - i > buckets:
+            return self._buckets(start, flow, i, j, lo_us, hi_us, buckets)
+        return self._bars(start, duration, flow, i, j)
+
+    def _apply(self, geometry):
+        if geometry['bars'] is not None:
+            self.bars.set_verts(geometry['bars'])
+            self.band.set_verts([])
+            self.bucket_mean.set_data([], [])
+            self.count_line.set_data([], [])
+            self.count_ax.set_visible(False)
+        else:
+            self.bars.set_verts([])
+            self.band.set_verts(geometry['band'])
+            self.bucket_mean.set_data(geometry['centers'], geometry['mean'])
+            self.count_line.set_data(geometry['centers'], geometry['count'])
+            self.count_ax.set_ylim(0, max(1, int(geometry['count'].max())) * 4)  # Счетчик — в нижней четверти графика
+            self.count_ax.set_visible(True)
+        self.ax.figure.canvas.draw_idle()
+
+    def _bars(self, start, duration, flow, i, j):
+        left = self._to_num(start[i:j])
+        right = self._to_num(start[i:j] + duration[i:j])
+        height = flow[i:j]
+        zero = np.zeros_like(height)
+        verts = np.stack([np.column_stack([left, zero]), np.column_stack([left, height]),
+                          np.column_stack([right, height]), np.column_stack([right, zero])], axis=1)
+        return {'bars': verts}
+
+    def _buckets(self, start, flow, i, j, lo_us, hi_us, buckets):
+        edges = np.linspace(lo_us, hi_us, buckets + 1)
+        bounds = np.searchsorted(start, edges)
+        bounds = np.clip(bounds, i, j)
+        count = np.diff(bounds)
+        filled = count > 0
+        starts = bounds[:-1][filled]
+        # Отрезки между соседними непустыми интервалами содержат ровно транзакции одного интервала
+        low = np.minimum.reduceat(flow[:j], starts)
+        high = np.maximum.reduceat(flow[:j], starts)
+        total = np.add.reduceat(flow[:j], starts)
+        mean = np.full(buckets, np.nan)
+        mean[filled] = total / count[filled]
+
+        left = self._to_num(edges[:-1][filled])
+        right = self._to_num(edges[1:][filled])
+        verts = np.stack([np.column_stack([left, low]), np.column_stack([left, high]),
+                          np.column_stack([right, high]), np.column_stack([right, low])], axis=1)
+        centers = self._to_num((edges[:-1] + edges[1:]) / 2)
+        return {'bars': None, 'band': verts, 'centers': centers, 'mean': mean, 'count': count}
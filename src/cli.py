@@ -0,0 +1,374 @@
+"""Пакетный отчет без графического интерфейса.
+
+    python main.py report [<каталог>] [--from 2024-03-01] [--to 2024-03-31]
+                          [--station АЗС] [--trk 1] [--fuel АИ-95]
+                          [--format csv|json] [--output файл] [--min-flow 20]
+                          [--metrics metrics.json] [--timings] [--parser tree|stream|scan]
+                          [--alerts] [--partials файл.bbp|каталог ...] [--history [база]]
+
+    python main.py partial <каталог> --output файл.bbp [--from ...] [--to ...] [--station АЗС]
+
+    python main.py history [--db база] [--from ...] [--to ...] [--station АЗС] [--trk 1] [--fuel АИ-95]
+                           [--by series|day|month] [--format csv|json] [--output файл]
+
+partial сохраняет транзакции логов каталога в частичный результат (src.partial),
+report с --partials сливает такие результаты с разных узлов, повторяющиеся
+файлы учитываются один раз; каталог с логами при этом можно не указывать.
+report с --history дописывает разобранные транзакции в историю (src.history),
+history строит сводку по истории без разбора логов.
+
+Модуль не импортирует Qt и matplotlib и сам загружается из main.py только
+в режиме отчета. Код возврата: 0 — успех, 1 — ошибка
+(нет файлов или данных), 2 — средняя скорость хотя бы одного ряда ниже --min-flow
+или, с --alerts, найдено подозрение на засор.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from src.cache import ParseCache
+from src.detect import ALERT_FIELDS, ClogDetector
+from src.engine import MAX_SPEED, MIN_SPEED, US_PER_MINUTE, TransactionEngine, merge_events
+from src.events import to_datetime, to_timestamp
+from src.files import find_bbox_files
+from src.history import AGGREGATE_FIELDS, HistoryStore
+from src.index import SeriesIndex
+from src.ingest import iter_partials
+from src.manifest import Manifest
+from src.metrics import Metrics
+from src.parser import PARSE_MODES, BBOXParser
+from src.partial import PartialResult, load_partials
+from src.rollup import Rollups
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_LOW_FLOW = 2
+
+REPORT_FIELDS = ('station', 'trk', 'fuel', 'transactions', 'liters', 'minutes',
+                 'mean_flow', 'median_flow', 'min_flow', 'max_flow', 'p10_flow', 'p90_flow', 'outliers',
+                 'first', 'last')
+
+
+def add_input_arguments(parser):
+    """Аргументы выбора и разбора файлов, общие для report и partial"""
+    parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help="начальная дата, ГГГГ-ММ-ДД")
+    parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help="конечная дата включительно")
+    parser.add_argument('--station', help="номер АЗС")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="число процессов разбора")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="не читать и не сохранять кэш разбора и оглавление архива; файлы по-прежнему "
+                             "отбираются по оглавлению, построенному заново")
+    parser.add_argument('--parser', choices=PARSE_MODES, default='stream',
+                        help="режим разбора; scan — быстрый поиск нужных строк в байтах файла")
+    parser.add_argument('--timings', action='store_true', help="вывести время этапов и счетчики в stderr")
+    parser.add_argument('--metrics', help="записать метрики обработки в JSON-файл")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog='main.py report',
+                                     description="Статистика скорости налива по АЗС, ТРК и видам топлива")
+    parser.add_argument('directory', nargs='?', help="каталог с файлами BBOX")
+    add_input_arguments(parser)
+    parser.add_argument('--trk', type=int, help="номер ТРК")
+    parser.add_argument('--fuel', help="вид топлива")
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    parser.add_argument('-o', '--output', help="файл отчета (по умолчанию stdout)")
+    parser.add_argument('--min-flow', type=float,
+                        help="порог средней скорости, л/мин; ниже порога — код возврата 2")
+    parser.add_argument('--alerts', action='store_true',
+                        help="вместо статистики — подозрения на засор фильтров, от самого сильного падения скорости")
+    parser.add_argument('--partials', nargs='+', default=[],
+                        help="частичные результаты других узлов (.bbp или каталоги с ними) для слияния")
+    parser.add_argument('--history', nargs='?', const='',
+                        help="дописать транзакции в историю (по умолчанию — в кэше пользователя)")
+    return parser
+
+
+def build_partial_arg_parser():
+    parser = argparse.ArgumentParser(prog='main.py partial',
+                                     description="Частичный результат для слияния на другом узле")
+    parser.add_argument('directory', help="каталог с файлами BBOX")
+    parser.add_argument('-o', '--output', required=True, help="файл частичного результата (.bbp)")
+    add_input_arguments(parser)
+    return parser
+
+
+def build_history_arg_parser():
+    parser = argparse.ArgumentParser(prog='main.py history',
+                                     description="Сводка по истории транзакций без разбора логов")
+    parser.add_argument('--db', help="файл истории (по умолчанию — в кэше пользователя)")
+    parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help="начальная дата, ГГГГ-ММ-ДД")
+    parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help="конечная дата включительно")
+    parser.add_argument('--station', help="номер АЗС")
+    parser.add_argument('--trk', type=int, help="номер ТРК")
+    parser.add_argument('--fuel', help="вид топлива")
+    parser.add_argument('--by', choices=('series', 'day', 'month'), default='series',
+                        help="строка на ряд за весь период, на сутки или на месяц")
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    parser.add_argument('-o', '--output', help="файл отчета (по умолчанию stdout)")
+    return parser
+
+
+def series_report(index, key, lo, hi, quantiles):
+    """quantiles — сводка Rollups.stats за тот же период (p10/p90 с погрешностью около 1 %)"""
+    flow = index.flow[lo:hi]
+    minutes = index.duration[lo:hi] / US_PER_MINUTE
+    station, trk, fuel = key
+    return {
+        'station': station,
+        'trk': trk,
+        'fuel': fuel,
+        'transactions': hi - lo,
+        'liters': round(float(index.liters[lo:hi].sum()), 3),
+        'minutes': round(float(minutes.sum()), 3),
+        'mean_flow': round(float(flow.mean()), 3),
+        'median_flow': round(float(np.median(flow)), 3),
+        'min_flow': round(float(flow.min()), 3),
+        'max_flow': round(float(flow.max()), 3),
+        'p10_flow': round(quantiles['p10_flow'], 3),
+        'p90_flow': round(quantiles['p90_flow'], 3),
+        'outliers': int(((flow < MIN_SPEED) | (flow > MAX_SPEED)).sum()),
+        'first': to_datetime(int(index.start[lo])).isoformat(sep=' '),
+        'last': to_datetime(int(index.start[hi - 1])).isoformat(sep=' '),
+    }
+
+
+def write_report(rows, output_format, stream, fields=REPORT_FIELDS):
+    if output_format == 'json':
+        json.dump(rows, stream, ensure_ascii=False, indent=2)
+        stream.write('\n')
+    else:
+        writer = csv.DictWriter(stream, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def date_bounds(args):
+    """[start, end) в микросекундах по --from/--to; без границы — крайние значения int64"""
+    start = to_timestamp(datetime.combine(args.date_from, datetime.min.time())) if args.date_from else \
+        np.iinfo(np.int64).min
+    end = to_timestamp(datetime.combine(args.date_to + timedelta(days=1), datetime.min.time())) if args.date_to \
+        else np.iinfo(np.int64).max
+    return start, end
+
+
+def print_warnings(warnings):
+    for file_path, error in warnings:
+        print(f"Предупреждение: {file_path}: {error}", file=sys.stderr)
+
+
+def ingest(args, metrics, found_files, start, end, parser, on_file=None):
+    """Разбирает файлы, которые по оглавлению могут попасть в выбор; on_file(file_path, partial) — для успешных"""
+    # Разбираются только файлы, которые по оглавлению могут попасть в отчет
+    with metrics.stage('manifest'):
+        # С --no-cache оглавление строится заново в памяти и не сохраняется
+        manifest = Manifest() if args.no_cache else Manifest.for_directory(args.directory)
+        metrics.count('manifest_scanned', manifest.refresh(found_files))
+        selected_files = manifest.select(found_files, args.station, start, end)
+    metrics.count('files_skipped', len(found_files) - len(selected_files))
+
+    cache = None if args.no_cache else ParseCache()
+    with metrics.stage('ingest'):
+        for file_path, ok, partial, from_cache in iter_partials(selected_files, parser.mode, args.workers,
+                                                                cache=cache):
+            if partial is not None:
+                parser.merge(partial)
+                print_warnings(partial.metrics.warnings)
+            if ok:
+                manifest.record(file_path, partial)
+                if on_file is not None:
+                    on_file(file_path, partial)
+            else:
+                error = partial.metrics.errors[-1][1] if partial is not None and partial.metrics.errors else ""
+                print(f"Ошибка при обработке файла: {file_path}: {error}", file=sys.stderr)
+    manifest.save()
+    # Сбои оглавления и кэша не прерывают разбор — они в предупреждениях и в сводке
+    for owner in (manifest, cache):
+        if owner is not None:
+            metrics.merge(owner.metrics)
+            print_warnings(owner.metrics.warnings)
+
+
+def partial_main(argv, started=None):
+    """Режим partial: argv — аргументы после слова partial"""
+    started = time.perf_counter() if started is None else started
+    metrics = Metrics()
+    metrics.add_time('startup', time.perf_counter() - started)
+    args = build_partial_arg_parser().parse_args(argv)
+
+    with metrics.stage('find_files'):
+        found_files = find_bbox_files(args.directory, metrics)
+    print_warnings(metrics.warnings)
+    if not found_files:
+        print(f"Файлы BBOX не найдены: {args.directory}", file=sys.stderr)
+        return EXIT_ERROR
+    start, end = date_bounds(args)
+    parser = BBOXParser(mode=args.parser)
+    parser.metrics = metrics
+    items = []  # (файл, частичный разбор) успешно разобранных файлов
+    ingest(args, metrics, found_files, start, end, parser,
+           lambda file_path, partial: items.append((file_path, partial)))
+    if not items:
+        print("Нет разобранных файлов", file=sys.stderr)
+        return EXIT_ERROR
+    with metrics.stage('reconstruct'):
+        # Файлы узла восстанавливаются вместе, чтобы транзакции на стыке файлов не терялись
+        results = PartialResult.from_files(items)
+    with metrics.stage('save'):
+        result = PartialResult.merge_all(results)
+        result.save(args.output)
+    metrics.add_time('total', time.perf_counter() - started)
+
+    print(f"Частичный результат: файлов {len(result.files)}, транзакций {len(result)}, "
+          f"{os.path.getsize(args.output) / 1024:.0f} КБ — {args.output}", file=sys.stderr)
+    if args.timings:
+        for line in metrics.summary():
+            print(line, file=sys.stderr)
+    if args.metrics:
+        metrics.to_json(args.metrics)
+    return EXIT_OK
+
+
+def history_main(argv):
+    """Режим history: argv — аргументы после слова history"""
+    args = build_history_arg_parser().parse_args(argv)
+    if args.db is not None and not os.path.exists(args.db):
+        print(f"Файл истории не найден: {args.db}", file=sys.stderr)
+        return EXIT_ERROR
+    start, end = date_bounds(args)
+    rows = HistoryStore(args.db).aggregate(args.station, args.trk, args.fuel, start if args.date_from else None,
+                                           end if args.date_to else None, args.by)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            write_report(rows, args.format, f, AGGREGATE_FIELDS)
+    else:
+        write_report(rows, args.format, sys.stdout, AGGREGATE_FIELDS)
+    if not rows:
+        print("Нет данных за выбранный период", file=sys.stderr)
+        return EXIT_ERROR
+    return EXIT_OK
+
+
+def main(argv, started=None):
+    """argv — аргументы после слова report; started — time.perf_counter() на старте процесса"""
+    started = time.perf_counter() if started is None else started
+    metrics = Metrics()
+    metrics.add_time('startup', time.perf_counter() - started)
+    args = build_arg_parser().parse_args(argv)
+    if args.directory is None and not args.partials:
+        print("Укажите каталог с файлами BBOX или --partials", file=sys.stderr)
+        return EXIT_ERROR
+
+    found_files = []
+    if args.directory is not None:
+        with metrics.stage('find_files'):
+            found_files = find_bbox_files(args.directory, metrics)
+        print_warnings(metrics.warnings)
+        if not found_files and not args.partials:
+            print(f"Файлы BBOX не найдены: {args.directory}", file=sys.stderr)
+            return EXIT_ERROR
+
+    start, end = date_bounds(args)
+    parser = BBOXParser(mode=args.parser)
+    items = []  # (файл, частичный разбор) своих файлов — для слияния с частичными результатами других узлов
+    if not args.partials:
+        parser.metrics = metrics
+    if found_files:
+        ingest(args, metrics, found_files, start, end, parser,
+               (lambda file_path, partial: items.append((file_path, partial)))
+               if args.partials or args.history is not None else None)
+
+    local = []
+    imported = []
+    with metrics.stage('reconstruct'):
+        if items:
+            local = PartialResult.from_files(items)
+        if args.partials:
+            # Метрики разбора и транзакций — из результатов файлов, повторы файлов учитываются один раз
+            imported, errors = load_partials(args.partials)
+            for path, error in errors:
+                print(f"Ошибка при загрузке частичного результата: {path}: {error}", file=sys.stderr)
+            merged = PartialResult.merge_all(local + imported)
+            metrics.count('partials', len(imported))
+            metrics.count('files_duplicated', sum(len(result.files) for result in local + imported) -
+                          len(merged.files))
+            metrics.merge(merged.metrics())
+            transactions = merged.transactions()
+            metrics.set_transactions(transactions)
+        else:
+            engine = TransactionEngine(metrics)
+            # Один проход по событиям всех файлов в порядке времени: транзакции на стыке файлов не теряются
+            engine.feed(merge_events(parser.data))
+            transactions = engine.transactions()
+        index = SeriesIndex(transactions)
+        rollups = Rollups.from_transactions(transactions)
+    if args.history is not None:
+        with metrics.stage('history'):
+            metrics.count('history_added', HistoryStore(args.history or None).add(
+                PartialResult.merge_all(local + imported)))
+
+    stage = time.perf_counter()
+    rows = []
+    selected = []
+    for key in sorted(index.keys()):
+        station, trk, fuel = key
+        if ((args.station is not None and station != args.station) or
+                (args.trk is not None and trk != args.trk) or
+                (args.fuel is not None and fuel != args.fuel)):
+            continue
+        lo, hi = index.range(key, start, end)
+        if hi > lo:
+            selected.append((key, lo, hi))
+            rows.append(series_report(index, key, lo, hi, rollups.stats(key, start if args.date_from else None,
+                                                                         end if args.date_to else None)))
+
+    fields = REPORT_FIELDS
+    if args.alerts:
+        # Ряды индекса уже отсортированы по времени — каждый проходит через детектор один раз
+        detector = ClogDetector()
+        for key, lo, hi in selected:
+            keep = (index.flow[lo:hi] >= MIN_SPEED) & (index.flow[lo:hi] <= MAX_SPEED)
+            detector.feed(key, index.start[lo:hi][keep], index.flow[lo:hi][keep])
+        rows = detector.alerts()
+        fields = ALERT_FIELDS
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            write_report(rows, args.format, f, fields)
+    else:
+        write_report(rows, args.format, sys.stdout, fields)
+    metrics.add_time('report', time.perf_counter() - stage)
+    metrics.add_time('total', time.perf_counter() - started)
+
+    if args.timings:
+        print(f"Рядов в отчете: {len(rows)}", file=sys.stderr)
+        for line in metrics.summary():
+            print(line, file=sys.stderr)
+    if args.metrics:
+        metrics.to_json(args.metrics)
+
+    if args.alerts:
+        if not selected:
+            print("Нет данных за выбранный период", file=sys.stderr)
+            return EXIT_ERROR
+        for row in rows:
+            print(f"Подозрение на засор: АЗС {row['station']}, ТРК {row['trk']}, {row['fuel']}: скорость ниже на "
+                  f"{row['drop']:.0%} с {row['decline_start']}", file=sys.stderr)
+        return EXIT_LOW_FLOW if rows else EXIT_OK
+    if not rows:
+        print("Нет данных за выбранный период", file=sys.stderr)
+        return EXIT_ERROR
+    if args.min_flow is not None:
+        low = [row for row in rows if row['mean_flow'] < args.min_flow]
+        for row in low:
+            print(f"Низкая скорость: АЗС {row['station']}, ТРК {row['trk']}, {row['fuel']}: "
+                  f"{row['mean_flow']} л/мин", file=sys.stderr)
+        if low:
+            return EXIT_LOW_FLOW
+    return EXIT_OK
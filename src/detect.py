@@ -0,0 +1,197 @@
+from bisect import bisect_left, insort
+from collections import deque
+
+import numpy as np
+
+from src.engine import US_PER_DAY
+from src.events import to_datetime
+
+ALERT_FIELDS = ('station', 'trk', 'fuel', 'drop', 'baseline_flow', 'current_flow', 'ewma_flow', 'slope',
+                'decline_start', 'transactions', 'last')
+
+
+class SeriesState:
+    """Скользящая статистика скорости одного ряда (станция, ТРК, топливо).
+
+    Транзакции добавляются по времени начала, каждая — за постоянное время
+    при фиксированном окне: EWMA скорости, медиана и наклон прямой МНК по
+    последним window транзакциям (наклон — в л/мин за сутки), максимум медианы
+    за baseline_days суток как исходный уровень и последнее время, когда
+    медиана была ниже него не больше чем на tolerance, — начало снижения.
+    """
+    __slots__ = ('window', 'alpha', 'baseline_span', 'tolerance', 'origin', 'last', 'count', 'ewma', 'values',
+                 'ordered', 'sum_t', 'sum_y', 'sum_tt', 'sum_ty', 'peaks', 'normal')
+
+    def __init__(self, window, alpha, baseline_days, tolerance):
+        self.window = window
+        self.alpha = alpha
+        self.baseline_span = baseline_days * US_PER_DAY
+        self.tolerance = tolerance
+        self.origin = None  # Время первой транзакции; от него считаются сутки в суммах МНК
+        self.last = None
+        self.count = 0
+        self.ewma = None
+        self.values = deque()  # (сутки от origin, скорость) в окне
+        self.ordered = []  # Скорости окна по возрастанию — для медианы
+        self.sum_t = self.sum_y = self.sum_tt = self.sum_ty = 0.0
+        self.peaks = deque()  # (время, медиана) с убывающей медианой — скользящий максимум
+        self.normal = None  # Последнее время, когда медиана была на исходном уровне
+
+    def add(self, start, flow):
+        if self.origin is None:
+            self.origin = start
+        self.last = start
+        self.count += 1
+        self.ewma = flow if self.ewma is None else self.ewma + self.alpha * (flow - self.ewma)
+
+        t = (start - self.origin) / US_PER_DAY
+        self.values.append((t, flow))
+        insort(self.ordered, flow)
+        self.sum_t += t
+        self.sum_y += flow
+        self.sum_tt += t * t
+        self.sum_ty += t * flow
+        if len(self.values) > self.window:
+            old_t, old_flow = self.values.popleft()
+            del self.ordered[bisect_left(self.ordered, old_flow)]
+            self.sum_t -= old_t
+            self.sum_y -= old_flow
+            self.sum_tt -= old_t * old_t
+            self.sum_ty -= old_t * old_flow
+        if len(self.values) < self.window:
+            return
+
+        median = self.median()
+        peaks = self.peaks
+        while peaks and peaks[-1][1] <= median:
+            peaks.pop()
+        peaks.append((start, median))
+        while peaks[0][0] < start - self.baseline_span:
+            peaks.popleft()
+        if median >= peaks[0][1] * (1 - self.tolerance):
+            self.normal = start
+
+    def median(self):
+        ordered = self.ordered
+        middle = len(ordered) // 2
+        return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+    def slope(self):
+        n = len(self.values)
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if n < 2 or denominator <= 0:
+            return 0.0
+        return (n * self.sum_ty - self.sum_t * self.sum_y) / denominator
+
+    def ready(self):
+        return len(self.values) >= self.window
+
+
+class ClogDetector:
+    """Поиск засоров фильтров сразу по всем рядам (станция, ТРК, топливо).
+
+    update принимает снимок TransactionEngine.transactions() и проводит через
+    состояния рядов только транзакции, добавленные после прошлого вызова.
+    Ряд, в который пришли транзакции раньше уже учтенных (например, догружен
+    более старый файл), пересчитывается целиком. Засор — медиана последних
+    window транзакций ниже исходного уровня не меньше чем на threshold, и
+    EWMA это подтверждает; начало снижения — последний момент, когда медиана
+    отставала от исходного уровня не больше чем на треть threshold. Скорости
+    вне диапазона (outlier) не учитываются.
+    """
+
+    def __init__(self, window=50, alpha=0.05, baseline_days=60, threshold=0.15):
+        self.window = window
+        self.alpha = alpha
+        self.baseline_days = baseline_days
+        self.threshold = threshold
+        self.series = dict()  # (станция, ТРК, топливо) -> SeriesState
+        self.seen = 0  # Сколько транзакций снимка уже учтено
+
+    def _new_state(self):
+        return SeriesState(self.window, self.alpha, self.baseline_days, self.threshold / 3)
+
+    def update(self, transactions):
+        """Учитывает новые транзакции снимка; возвращает число учтенных"""
+        if len(transactions) < self.seen:
+            # Снимок другого движка — начинаем заново
+            self.series = dict()
+            self.seen = 0
+        lo = self.seen
+        self.seen = len(transactions)
+        if lo == self.seen:
+            return 0
+        station = transactions.station[lo:]
+        trk = transactions.trk[lo:]
+        fuel = transactions.fuel[lo:]
+        start = transactions.start[lo:]
+        flow = transactions.flow[lo:]
+        keep = ~transactions.outlier[lo:]
+        order = np.lexsort((start, fuel, trk, station))
+        order = order[keep[order]]
+        if not len(order):
+            return 0
+        station, trk, fuel, start, flow = station[order], trk[order], fuel[order], start[order], flow[order]
+        change = np.flatnonzero((station[1:] != station[:-1]) | (trk[1:] != trk[:-1]) | (fuel[1:] != fuel[:-1])) + 1
+        bounds = np.concatenate(([0], change, [len(order)])).tolist()
+        starts = start.tolist()
+        flows = flow.tolist()
+        for group_lo, group_hi in zip(bounds[:-1], bounds[1:]):
+            key = (transactions.stations[station[group_lo]], int(trk[group_lo]), transactions.fuels[fuel[group_lo]])
+            state = self.series.get(key)
+            if state is not None and state.last is not None and starts[group_lo] < state.last:
+                self._rebuild(transactions, key)
+                continue
+            if state is None:
+                state = self.series[key] = self._new_state()
+            add = state.add
+            for index in range(group_lo, group_hi):
+                add(starts[index], flows[index])
+        return len(order)
+
+    def _rebuild(self, transactions, key):
+        mask = transactions.mask(*key) & ~transactions.outlier
+        order = np.argsort(transactions.start[mask], kind='stable')
+        del self.series[key]
+        self.feed(key, transactions.start[mask][order], transactions.flow[mask][order])
+
+    def feed(self, key, start, flow):
+        """Добавляет транзакции одного ряда, упорядоченные по времени начала (например, отрезок SeriesIndex)"""
+        state = self.series.get(key)
+        if state is None:
+            state = self.series[key] = self._new_state()
+        for moment, value in zip(start.tolist(), flow.tolist()):
+            state.add(moment, value)
+
+    def alert(self, key):
+        """Описание засора ряда key или None"""
+        state = self.series.get(key)
+        if state is None or not state.ready() or not state.peaks:
+            return None
+        baseline = state.peaks[0][1]
+        if baseline <= 0:
+            return None
+        median = state.median()
+        drop = 1 - median / baseline
+        if drop < self.threshold or state.ewma > baseline * (1 - self.threshold):
+            return None
+        station, trk, fuel = key
+        return {
+            'station': station,
+            'trk': trk,
+            'fuel': fuel,
+            'drop': round(drop, 3),
+            'baseline_flow': round(baseline, 3),
+            'current_flow': round(median, 3),
+            'ewma_flow': round(state.ewma, 3),
+            'slope': round(state.slope(), 3),
+            'decline_start': to_datetime(state.normal).date().isoformat(),
+            'transactions': state.count,
+            'last': to_datetime(state.last).isoformat(sep=' '),
+        }
+
+    def alerts(self, keys=None):
+        """Подозрения на засор, от самого сильного падения скорости"""
+        alerts = [alert for alert in map(self.alert, self.series if keys is None else keys) if alert is not None]
+        alerts.sort(key=lambda alert: (-alert['drop'], alert['slope']))
+        return alerts
@@ -0,0 +1,289 @@
+import heapq
+import math
+from array import array
+from datetime import timedelta
+from itertools import chain
+from operator import attrgetter
+
+import numpy as np
+
+from src.events import EPOCH, EventKind
+from src.metrics import Metrics
+
+ROLLOVER = 1000000  # Счетчик ТРК переходит через ноль после 999 999,99 л
+MIN_SPEED = 0
+MAX_SPEED = 150  # л/мин; все, что вне [MIN_SPEED, MAX_SPEED], считается выбросом
+US_PER_MINUTE = 60000000
+US_PER_DAY = 86400000000
+
+# Поля состояния ТРК между событиями одной транзакции
+START_VALUE, END_VALUE, START_TIME, END_TIME, FUEL_NAME, HOSE = range(6)
+
+
+def new_state():
+    return [0.0, 0.0, 0, 0, "", -1]
+
+
+def merge_events(streams):
+    """События списков streams (например, parser.data — по списку на файл) одним потоком по времени.
+
+    Порядок событий внутри файла сохраняется (событие, записанное раньше
+    предыдущего по времени, идет сразу за ним), при равном времени раньше
+    идет файл, стоящий раньше в streams. Отрезки файлов из merge_ranges
+    выдаются по индексам, без копирования списков.
+    """
+    return chain.from_iterable(streams[number] if lo == 0 and hi == len(streams[number]) else
+                               map(streams[number].__getitem__, range(lo, hi))
+                               for number, lo, hi in merge_ranges(streams))
+
+
+def merge_ranges(streams):
+    """Порядок слияния по времени в виде отрезков (номер списка в streams, от, до) — k-way слияние на куче.
+
+    В куче по одной позиции на файл; отрезок файла продолжается, пока этот
+    файл раньше по времени остальных. Состояния ТРК разных АЗС не связаны,
+    поэтому по времени сливаются только файлы с общими АЗС, а такие группы
+    идут одна за другой.
+    """
+    numbers = [number for number, stream in enumerate(streams) if len(stream)]
+    if len(numbers) == 1:
+        yield numbers[0], 0, len(streams[numbers[0]])
+        return
+    for group in _station_groups([streams[number] for number in numbers]):
+        for position, lo, hi in _merge_blocks([streams[numbers[member]] for member in group]):
+            yield numbers[group[position]], lo, hi
+
+
+def _station_groups(streams):
+    """Номера файлов, связанных общими АЗС, по группам в порядке первого файла"""
+    parent = list(range(len(streams)))
+
+    def find(number):
+        while parent[number] != number:
+            parent[number] = number = parent[parent[number]]
+        return number
+
+    first = dict()  # АЗС -> номер первого файла с ней
+    for number, stream in enumerate(streams):
+        for station in set(map(attrgetter('station'), stream)):
+            parent[find(number)] = find(first.setdefault(station, number))
+    groups = dict()
+    for number in range(len(streams)):
+        groups.setdefault(find(number), []).append(number)
+    return groups.values()
+
+
+def _merge_blocks(streams):
+    """Отрезки (номер, от, до) непустых streams одной группы в порядке времени"""
+    last = [max(map(attrgetter('timestamp'), stream)) for stream in streams]
+    # Куча (наибольшее время до текущей позиции, номер файла, позиция)
+    heap = [(stream[0].timestamp, number, 0) for number, stream in enumerate(streams)]
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        top, number, position = heapq.heappop(heap)
+        stream = streams[number]
+        bound, other, _ = heap[0]
+        # При равном времени файл с меньшим номером идет первым
+        limit = bound if other > number else bound - 1
+        end = position + 1
+        size = len(stream)
+        if last[number] <= limit:
+            end = size  # Весь остаток файла раньше остальных — без просмотра событий
+        while end < size:
+            timestamp = stream[end].timestamp
+            if timestamp > top:
+                top = timestamp
+                if top > limit:
+                    break
+            end += 1
+        yield number, position, end
+        if end < size:
+            heapq.heappush(heap, (top, number, end))
+    if heap:
+        _, number, position = heap[0]
+        yield number, position, len(streams[number])
+
+
+class Transactions:
+    """Завершенные транзакции в виде столбцов NumPy.
+
+    station и fuel — коды в списках stations и fuels, start/end — микросекунды
+    от 1970-01-01, liters — объем с учетом перехода счетчика через ROLLOVER,
+    flow — скорость налива в л/мин, outlier — скорость вне [MIN_SPEED, MAX_SPEED].
+    """
+
+    def __init__(self, stations, fuels, station, trk, fuel, start, end, start_value, end_value):
+        self.stations = stations
+        self.fuels = fuels
+        self.station = station
+        self.trk = trk
+        self.fuel = fuel
+        self.start = start
+        self.end = end
+        liters = end_value - start_value
+        rolled = liters < 0
+        liters[rolled] = ROLLOVER - start_value[rolled] + end_value[rolled]
+        self.liters = liters
+        self.minutes = (end - start) / US_PER_MINUTE
+        self.flow = liters / self.minutes
+        self.outlier = (self.flow < MIN_SPEED) | (self.flow > MAX_SPEED)
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Транзакции нескольких снимков (например, своих и загруженных с других узлов) с общими списками"""
+        stations = []
+        fuels = []
+        columns = [[] for _ in range(7)]
+        for part in parts:
+            for name in part.stations:
+                if name not in stations:
+                    stations.append(name)
+            for name in part.fuels:
+                if name not in fuels:
+                    fuels.append(name)
+            station_codes = np.array([stations.index(name) for name in part.stations] or [0], dtype=np.int32)
+            fuel_codes = np.array([fuels.index(name) for name in part.fuels] or [0], dtype=np.int32)
+            for column, values in zip(columns, (station_codes[part.station], part.trk, fuel_codes[part.fuel],
+                                                part.start, part.end, np.zeros(len(part)), part.liters)):
+                column.append(values)
+        dtypes = (np.int32, np.int32, np.int32, np.int64, np.int64, np.float64, np.float64)
+        # Объем уже учитывает переход счетчика — он передается как конечное показание при нулевом начальном
+        return cls(stations, fuels, *(np.concatenate(column).astype(dtype) if column else np.empty(0, dtype=dtype)
+                                      for column, dtype in zip(columns, dtypes)))
+
+    def take(self, index):
+        """Транзакции с номерами (или по маске) index с теми же списками stations и fuels"""
+        return Transactions(self.stations, self.fuels, self.station[index], self.trk[index], self.fuel[index],
+                            self.start[index], self.end[index], np.zeros(len(self.start[index])),
+                            self.liters[index])
+
+    def dates(self):
+        """Даты окончания транзакций (по ним строится диапазон дат в окне)"""
+        days = np.unique(self.end // US_PER_DAY)
+        return [(EPOCH + timedelta(days=int(day))).date() for day in days]
+
+    def outlier_dates(self):
+        days = np.unique(self.end[self.outlier] // US_PER_DAY)
+        return [(EPOCH + timedelta(days=int(day))).date() for day in days]
+
+    def mask(self, station=None, trk=None, fuel=None):
+        """Булева маска транзакций выбранной станции, ТРК и вида топлива (None — без фильтра)"""
+        mask = np.ones(len(self), dtype=bool)
+        if station is not None:
+            mask &= self.station == (self.stations.index(station) if station in self.stations else -1)
+        if trk is not None:
+            mask &= self.trk == trk
+        if fuel is not None:
+            mask &= self.fuel == (self.fuels.index(fuel) if fuel in self.fuels else -1)
+        return mask
+
+
+class TransactionEngine:
+    """Восстановление транзакций налива из событий лога без привязки к интерфейсу.
+
+    Состояние ТРК хранится по ключу (поток, станция, ТРК). События всех
+    файлов подаются одним потоком (stream=None) в порядке времени через
+    merge_events, поэтому транзакция, начатая в конце одного файла и
+    законченная в следующем, не теряется, а дочитанные события продолжают
+    начатые транзакции. Отдельный stream изолирует свои события от
+    остальных. Отброшенные транзакции считаются в metrics по АЗС.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.states = dict()
+        self.stations = []
+        self.fuels = []
+        self._station_codes = dict()
+        self._fuel_codes = dict()
+        self._station = array('i')
+        self._trk = array('i')
+        self._fuel = array('i')
+        self._start = array('q')
+        self._end = array('q')
+        self._start_value = array('d')
+        self._end_value = array('d')
+
+    def feed(self, events, stream=None):
+        """Проводит события через конечный автомат ТРК; завершенные транзакции копятся в буферах"""
+        states = self.states
+        for event in events:
+            key = (stream, event.station, event.trk)
+            state = states.get(key)
+            if state is None:
+                state = states[key] = new_state()
+            kind = event.kind
+            if kind == EventKind.DOSE_SET:
+                if event.fuel is not None:
+                    state[FUEL_NAME] = event.fuel
+            elif kind == EventKind.DOSE_SETUP:
+                if event.hose is not None:
+                    state[HOSE] = event.hose
+                if event.counter is not None:
+                    state[START_VALUE] = event.counter
+            elif kind == EventKind.DISPENSE_START:
+                if not state[START_TIME]:
+                    state[START_TIME] = event.timestamp
+            elif kind == EventKind.DISPENSE_END:
+                state[END_TIME] = event.timestamp
+            elif kind == EventKind.TRANSACTION_END:
+                counter = event.counter
+                # Счетчик NAN в начале или в конце — объем неизвестен, транзакция отбрасывается
+                if (counter is None or not math.isnan(counter)) and not math.isnan(state[START_VALUE]):
+                    if counter is not None:
+                        state[END_VALUE] = counter
+                    if not state[START_TIME] or not state[END_TIME]:
+                        self.metrics.count('dropped_incomplete', station=event.station)
+                    elif state[START_TIME] == state[END_TIME]:
+                        self.metrics.count('dropped_zero_duration', station=event.station)
+                    else:
+                        self._append(event.station, event.trk, state)
+                else:
+                    self.metrics.count('dropped_nan', station=event.station)
+                states[key] = new_state()
+            elif kind == EventKind.ORDER_MOVED:
+                target = states.get((stream, event.station, event.target))
+                if target is None:
+                    target = states[(stream, event.station, event.target)] = new_state()
+                target[FUEL_NAME] = state[FUEL_NAME]
+                # Отброшенной считается только начатая транзакция, а не заказ до отпуска
+                if state[START_TIME]:
+                    self.metrics.count('dropped_moved', station=event.station)
+                states[key] = new_state()
+
+    def __len__(self):
+        """Число завершенных транзакций"""
+        return len(self._start)
+
+    def _append(self, station, trk, state):
+        station_code = self._station_codes.get(station)
+        if station_code is None:
+            station_code = self._station_codes[station] = len(self.stations)
+            self.stations.append(station)
+        fuel_code = self._fuel_codes.get(state[FUEL_NAME])
+        if fuel_code is None:
+            fuel_code = self._fuel_codes[state[FUEL_NAME]] = len(self.fuels)
+            self.fuels.append(state[FUEL_NAME])
+        self._station.append(station_code)
+        self._trk.append(trk)
+        self._fuel.append(fuel_code)
+        self._start.append(state[START_TIME])
+        self._end.append(state[END_TIME])
+        self._start_value.append(state[START_VALUE])
+        self._end_value.append(state[END_VALUE])
+
+    def transactions(self):
+        """Снимок всех завершенных транзакций; объем, скорость и выбросы считаются векторно"""
+        transactions = Transactions(list(self.stations), list(self.fuels),
+                            np.array(self._station, dtype=np.int32),
+                            np.array(self._trk, dtype=np.int32),
+                            np.array(self._fuel, dtype=np.int32),
+                            np.array(self._start, dtype=np.int64),
+                            np.array(self._end, dtype=np.int64),
+                            np.array(self._start_value, dtype=np.float64),
+                            np.array(self._end_value, dtype=np.float64))
+        self.metrics.set_transactions(transactions)
+        return transactions
@@ -0,0 +1,118 @@
+import math
+import sys
+from datetime import date, datetime, timedelta
+from enum import IntEnum
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+class EventKind(IntEnum):
+    DOSE_SET = 1  # Тр: ...; Доза установлена; ТРК: N; Прод.: ...
+    DOSE_SETUP = 2  # ТРК : N; Установка дозы; Рукав: H; Счетчик: X
+    DISPENSE_START = 3  # ТРК : N; На ТРК идет отпуск топлива
+    DISPENSE_END = 4  # ТРК : N; На ТРК закончен отпуск топлива
+    TRANSACTION_END = 5  # ТРК : N; Конец транзакции; Счетчик: X
+    ORDER_MOVED = 6  # Тр: ...; Топливный заказ перемещен с ТРК: N на ТРК: M
+
+
+class Event:
+    """Разобранная строка лога. Время хранится целым числом микросекунд от 1970-01-01"""
+    __slots__ = ('kind', 'station', 'trk', 'hose', 'counter', 'timestamp', 'fuel', 'target')
+
+    def __init__(self, kind, station, trk, timestamp, hose=None, counter=None, fuel=None, target=None):
+        self.kind = kind
+        self.station = station
+        self.trk = trk
+        self.timestamp = timestamp
+        self.hose = hose
+        self.counter = counter
+        self.fuel = fuel
+        self.target = target
+
+    def __reduce__(self):
+        # Компактная сериализация для передачи между процессами
+        return Event, (self.kind, self.station, self.trk, self.timestamp,
+                       self.hose, self.counter, self.fuel, self.target)
+
+    def __repr__(self):
+        return (f"Event({self.kind.name}, {self.station!r}, trk={self.trk}, t={self.timestamp}, "
+                f"hose={self.hose}, counter={self.counter}, fuel={self.fuel!r}, target={self.target})")
+
+
+def parse_timestamp(value):
+    """DATETIME вида 20240301T08:15:30123 -> микросекунды от 1970-01-01"""
+    if len(value) >= 17 and value[8] == 'T' and value[11] == ':' and value[14] == ':':
+        fraction = value[17:] + "000"
+        if len(fraction) <= 6 and value[:8].isdigit() and fraction.isdigit():
+            days = date(int(value[:4]), int(value[4:6]), int(value[6:8])).toordinal() - EPOCH_ORDINAL
+            seconds = ((days * 24 + int(value[9:11])) * 60 + int(value[12:14])) * 60 + int(value[15:17])
+            return seconds * 1000000 + int(fraction.ljust(6, '0'))
+    return to_timestamp(datetime.strptime(value + "000", "%Y%m%dT%H:%M:%S%f"))
+
+
+def to_timestamp(moment):
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+def to_datetime(timestamp):
+    return EPOCH + timedelta(microseconds=timestamp)
+
+
+def _number_after_colon(data):
+    return int(data[data.find(':') + 1:])
+
+
+def _counter(data):
+    txt = str(data[data.find(':') + 1:]).replace(',', '.').strip()
+    if txt == "NAN":
+        return math.nan
+    return float(txt)
+
+
+def decode_event(station, datetime_value, action):
+    """Разбирает ACTION один раз; возвращает Event или None, если строка не участвует в расчете"""
+    if "Доза установлена" in action:
+        trk = 0
+        fuel = None
+        for data in action.split(';'):
+            if "ТРК: " in data:
+                trk = _number_after_colon(data)
+            elif "Прод.: " in data:
+                fuel = sys.intern(data[data.find('Прод.: ') + len("Прод.: "):].strip())
+                break
+        return Event(EventKind.DOSE_SET, station, trk, parse_timestamp(datetime_value), fuel=fuel)
+    elif "Установка дозы" in action:
+        trk = 0
+        hose = None
+        counter = None
+        for data in action.split(';'):
+            if "ТРК : " in data:
+                trk = _number_after_colon(data)
+            elif "Рукав: " in data:
+                hose = int(data[data.find('Рукав:') + len("Рукав:"):])
+            elif "Счетчик:" in data:
+                counter = float(str(data[data.find(':') + 1:]).replace(',', '.'))
+        return Event(EventKind.DOSE_SETUP, station, trk, parse_timestamp(datetime_value), hose=hose, counter=counter)
+    elif "На ТРК идет отпуск топлива" in action or "На ТРК закончен отпуск топлива" in action:
+        kind = EventKind.DISPENSE_START if "На ТРК идет отпуск топлива" in action else EventKind.DISPENSE_END
+        trk = 0
+        for data in action.split(';'):
+            if "ТРК : " in data:
+                trk = _number_after_colon(data)
+                break
+        return Event(kind, station, trk, parse_timestamp(datetime_value))
+    elif "Конец транзакции" in action:
+        trk = 0
+        counter = None
+        for data in action.split(';'):
+            if "ТРК : " in data:
+                trk = _number_after_colon(data)
+            if "Счетчик:" in data:
+                counter = _counter(data)
+        return Event(EventKind.TRANSACTION_END, station, trk, parse_timestamp(datetime_value), counter=counter)
+    elif "Топливный заказ перемещен" in action:
+        # Тр: 3078491; Топливный заказ перемещен с ТРК: 8 на ТРК: 7
+        FROM, TO = action[action.find("ТРК:") + len("ТРК:"):].split("на ТРК:")
+        return Event(EventKind.ORDER_MOVED, station, int(FROM), parse_timestamp(datetime_value), target=int(TO))
+    return None
@@ -0,0 +1,117 @@
+import gzip
+import os
+import struct
+import zipfile
+from contextlib import contextmanager
+from functools import lru_cache
+
+# Архивы станций читаются без распаковки на диск: файл BBOX внутри .zip получает
+# путь <архив>.zip/<путь в архиве>, сжатый gzip файл BBOX*.XML.gz разбирается как есть
+ZIP_SUFFIX = '.zip'
+GZIP_SUFFIX = '.gz'
+
+
+def is_bbox_file(file_name):
+    return file_name.upper().endswith('.XML') and str(file_name.upper()).startswith('BBOX')
+
+
+def is_bbox_gzip(file_name):
+    return file_name.lower().endswith(GZIP_SUFFIX) and is_bbox_file(file_name[:-len(GZIP_SUFFIX)])
+
+
+def split_zip_path(file_path):
+    """(архив, имя в архиве) для файла внутри .zip или None"""
+    lowered = file_path.lower()
+    position = lowered.find(ZIP_SUFFIX + os.sep)
+    while position >= 0:
+        archive = file_path[:position + len(ZIP_SUFFIX)]
+        if os.path.isfile(archive):
+            return archive, file_path[len(archive) + 1:].replace(os.sep, '/')
+        position = lowered.find(ZIP_SUFFIX + os.sep, position + 1)
+    return None
+
+
+def is_compressed(file_path):
+    return file_path.lower().endswith(GZIP_SUFFIX) or split_zip_path(file_path) is not None
+
+
+@lru_cache(maxsize=8)
+def _zip_file(archive, size, mtime_ns):
+    # Оглавление большого архива читается один раз на процесс, а не для каждого файла в нем
+    return zipfile.ZipFile(archive)
+
+
+def _open_zip(archive):
+    stat = os.stat(archive)
+    return _zip_file(archive, stat.st_size, stat.st_mtime_ns)
+
+
+@contextmanager
+def open_bbox(file_path):
+    """Двоичный поток содержимого файла BBOX: обычного, gzip или файла внутри .zip"""
+    member = split_zip_path(file_path)
+    if member is not None:
+        f = _open_zip(member[0]).open(member[1])
+    elif file_path.lower().endswith(GZIP_SUFFIX):
+        f = gzip.open(file_path, 'rb')
+    else:
+        f = open(file_path, 'rb')
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def source_stat(file_path):
+    """os.stat файла на диске: для файла внутри .zip — самого архива"""
+    member = split_zip_path(file_path)
+    return os.stat(member[0] if member is not None else file_path)
+
+
+def bbox_sizes(file_path):
+    """(байт после распаковки, байт на диске) для обычного и сжатого файла"""
+    member = split_zip_path(file_path)
+    if member is not None:
+        info = _open_zip(member[0]).getinfo(member[1])
+        return info.file_size, info.compress_size
+    size = os.path.getsize(file_path)
+    if file_path.lower().endswith(GZIP_SUFFIX) and size >= 4:
+        # Последние 4 байта gzip — размер исходных данных по модулю 2^32
+        with open(file_path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0], size
+    return size, size
+
+
+def zip_members(archive):
+    """Файлы BBOX внутри архива (по одному на каталог архива)"""
+    found_files = []
+    directories = set()
+    with zipfile.ZipFile(archive) as zf:
+        for name in zf.namelist():
+            directory, _, file_name = name.rpartition('/')
+            if is_bbox_file(file_name) and directory not in directories:
+                directories.add(directory)
+                found_files.append(os.path.join(archive, *name.split('/')))
+    return found_files
+
+
+def find_bbox_files(directory, metrics=None):
+    """Рекурсивный поиск BBOX файлов (по одному на каталог), в том числе в архивах .zip и .gz.
+
+    Нечитаемый архив .zip пропускается и попадает в metrics.warnings.
+    """
+    found_files = []
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if is_bbox_file(file) or is_bbox_gzip(file):
+                found_files.append(os.path.join(root, file))
+                break
+        for file in files:
+            if file.lower().endswith(ZIP_SUFFIX):
+                try:
+                    found_files.extend(zip_members(os.path.join(root, file)))
+                except (OSError, zipfile.BadZipFile) as e:
+                    if metrics is not None:
+                        metrics.warn('archive_errors', os.path.join(root, file), f"архив не читается: {str(e)}")
+    return found_files
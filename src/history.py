@@ -0,0 +1,313 @@
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+
+import numpy as np
+
+from src.cache import default_cache_dir
+from src.engine import MAX_SPEED, MIN_SPEED, US_PER_DAY, US_PER_MINUTE
+from src.events import to_datetime
+
+# Долговременная история транзакций в SQLite. Транзакции лежат в таблице, упорядоченной по
+# (ряд, начало), поэтому выбор ряда за период — поиск по первичному ключу. Суточные и месячные
+# агрегаты обновляются при каждом добавлении, запросы по годам и сотням АЗС читают только их.
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    station TEXT NOT NULL,
+    trk INTEGER NOT NULL,
+    fuel TEXT NOT NULL,
+    UNIQUE (station, trk, fuel)
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    series INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    liters REAL NOT NULL,
+    flow REAL NOT NULL,
+    PRIMARY KEY (series, start)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+# Агрегаты: period — номер суток или месяца от 1970-01-01
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    series INTEGER NOT NULL,
+    period INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    liters REAL NOT NULL,
+    minutes REAL NOT NULL,
+    flow_sum REAL NOT NULL,
+    flow_min REAL NOT NULL,
+    flow_max REAL NOT NULL,
+    outliers INTEGER NOT NULL,
+    PRIMARY KEY (series, period)
+) WITHOUT ROWID;
+"""
+STATS_TABLES = {'day': 'day_stats', 'month': 'month_stats'}
+UPSERT = """
+INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (series, period) DO UPDATE SET
+    count = count + excluded.count,
+    liters = liters + excluded.liters,
+    minutes = minutes + excluded.minutes,
+    flow_sum = flow_sum + excluded.flow_sum,
+    flow_min = min(flow_min, excluded.flow_min),
+    flow_max = max(flow_max, excluded.flow_max),
+    outliers = outliers + excluded.outliers
+"""
+AGGREGATE_FIELDS = ('station', 'trk', 'fuel', 'period', 'transactions', 'liters', 'minutes', 'mean_flow',
+                    'min_flow', 'max_flow', 'outliers')
+CHUNK_ROWS = 100000  # Строк за одну выборку — память запроса не зависит от размера истории
+
+
+def month_of(us):
+    """Номер месяца от 1970-01 для микросекунд от 1970-01-01 (скаляр или массив)"""
+    return np.asarray(us).astype('datetime64[us]').astype('datetime64[M]').astype(np.int64)
+
+
+def month_start(month):
+    return int(np.datetime64(int(month), 'M').astype('datetime64[us]').astype(np.int64))
+
+
+def _period_label(by, period):
+    if by == 'day':
+        return to_datetime(period * US_PER_DAY).date().isoformat()
+    return str(np.datetime64(int(period), 'M'))
+
+
+def _group(series, period, start, end, liters, flow):
+    """Строки агрегатов по (ряд, период) для новых транзакций"""
+    order = np.lexsort((period, series))
+    series, period = series[order], period[order]
+    change = np.ones(len(order), dtype=bool)
+    change[1:] = (series[1:] != series[:-1]) | (period[1:] != period[:-1])
+    starts = np.flatnonzero(change)
+    flow = flow[order]
+    outlier = ((flow < MIN_SPEED) | (flow > MAX_SPEED)).astype(np.int64)
+    columns = (series[starts], period[starts], np.diff(np.append(starts, len(order))),
+               np.add.reduceat(liters[order], starts), np.add.reduceat((end - start)[order] / US_PER_MINUTE, starts),
+               np.add.reduceat(flow, starts), np.minimum.reduceat(flow, starts), np.maximum.reduceat(flow, starts),
+               np.add.reduceat(outlier, starts))
+    return zip(*(column.tolist() for column in columns))
+
+
+class HistoryStore:
+    """Долговременная история транзакций всех АЗС с запросами по рядам и периодам.
+
+    Добавлять можно только новые данные: файл лога (по ключу file_identity)
+    повторно не записывается, пока не вырастет, а транзакция с уже известным
+    (ряд, начало) пропускается. Соединение открывается на каждый вызов,
+    поэтому хранилище можно читать и пополнять из разных потоков и процессов.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(default_cache_dir('history'), 'history.sqlite3')
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as connection:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, SCHEMA_VERSION):
+                raise ValueError(f"{self.path}: неподдерживаемая версия истории {version}")
+            connection.executescript(SCHEMA + "".join(STATS_SCHEMA.format(table=table)
+                                                      for table in STATS_TABLES.values()))
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            # WAL: чтение из окна не ждет записи из потока разбора
+            connection.execute("PRAGMA journal_mode = WAL")
+            with connection:
+                yield connection
+
+    def known(self, key, size):
+        """Файл с ключом key записан не меньшего размера — повторно добавлять не нужно"""
+        with self._connect() as connection:
+            row = connection.execute("SELECT size FROM files WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] >= size
+
+    def add(self, result):
+        """Добавляет новые файлы частичного результата (src.partial.PartialResult); возвращает число новых транзакций"""
+        with self._connect() as connection:
+            stored = dict(connection.execute("SELECT key, size FROM files"))
+            take = [position for position, entry in enumerate(result.files)
+                    if stored.get(entry['key'], -1) < entry['size']]
+            if not take:
+                return 0
+            rows = np.concatenate([np.arange(result.offsets[position], result.offsets[position + 1])
+                                   for position in take]).astype(np.int64)
+            columns = result.columns
+            with np.errstate(divide='ignore', invalid='ignore'):
+                flow = columns['liters'][rows] / ((columns['end'][rows] - columns['start'][rows]) / US_PER_MINUTE)
+            # Пустая транзакция нулевой длительности (скорость NaN) в SQLite не записывается
+            rows, flow = rows[~np.isnan(flow)], flow[~np.isnan(flow)]
+            # Номер ряда в хранилище для каждой тройки (станция, ТРК, топливо) новых транзакций
+            triples, inverse = np.unique(np.stack([columns['station'][rows], columns['trk'][rows],
+                                                   columns['fuel'][rows]]), axis=1, return_inverse=True)
+            ids = []
+            for station_code, trk, fuel_code in triples.T.tolist():
+                key = (result.stations[station_code], trk, result.fuels[fuel_code])
+                connection.execute("INSERT OR IGNORE INTO series (station, trk, fuel) VALUES (?, ?, ?)", key)
+                ids.append(connection.execute("SELECT id FROM series WHERE station = ? AND trk = ? AND fuel = ?",
+                                              key).fetchone()[0])
+            series = np.array(ids, dtype=np.int64)[inverse.reshape(-1)]
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS staging (series INTEGER, start INTEGER, "
+                               "end INTEGER, liters REAL, flow REAL, PRIMARY KEY (series, start)) WITHOUT ROWID")
+            connection.execute("DELETE FROM staging")
+            connection.executemany("INSERT OR IGNORE INTO staging VALUES (?, ?, ?, ?, ?)",
+                                   zip(series.tolist(), columns['start'][rows].tolist(),
+                                       columns['end'][rows].tolist(), columns['liters'][rows].tolist(),
+                                       flow.tolist()))
+            # Транзакции, уже записанные из другой версии файла, в агрегаты второй раз не попадают
+            connection.execute("DELETE FROM staging WHERE EXISTS (SELECT 1 FROM transactions t "
+                               "WHERE t.series = staging.series AND t.start = staging.start)")
+            # Микросекунды до 2255 года точно представимы в float64
+            new = np.array(connection.execute("SELECT series, start, end, liters, flow FROM staging").fetchall(),
+                           dtype=np.float64).reshape(-1, 5)
+            connection.execute("INSERT INTO transactions SELECT * FROM staging")
+            connection.execute("DELETE FROM staging")
+            if len(new):
+                series, start, end = new[:, 0].astype(np.int64), new[:, 1].astype(np.int64), new[:, 2].astype(np.int64)
+                for by, table in STATS_TABLES.items():
+                    period = start // US_PER_DAY if by == 'day' else month_of(start)
+                    connection.executemany(UPSERT.format(table=table),
+                                           _group(series, period, start, end, new[:, 3], new[:, 4]))
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                                   [(result.files[position]['key'], result.files[position]['name'],
+                                     result.files[position]['size']) for position in take])
+        return len(new)
+
+    def _series(self, connection, station=None, trk=None, fuel=None):
+        """{id: (станция, ТРК, топливо)} рядов, подходящих под фильтр (None — любое значение)"""
+        conditions = []
+        values = []
+        for name, value in (('station', station), ('trk', trk), ('fuel', fuel)):
+            if value is not None:
+                conditions.append(f"{name} = ?")
+                values.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return {row[0]: tuple(row[1:]) for row in
+                connection.execute(f"SELECT id, station, trk, fuel FROM series{where}", values)}
+
+    def series(self):
+        """Все ряды (станция, ТРК, топливо), для которых есть транзакции, по порядку"""
+        with self._connect() as connection:
+            return sorted(tuple(row) for row in connection.execute("SELECT station, trk, fuel FROM series"))
+
+    def date_range(self):
+        """(первая дата, последняя дата) транзакций или None"""
+        with self._connect() as connection:
+            # Первые и последние сутки каждого ряда — поиск по первичному ключу, без просмотра таблицы
+            first, last = connection.execute(
+                "SELECT min((SELECT period FROM day_stats WHERE series = s.id ORDER BY period LIMIT 1)), "
+                "max((SELECT period FROM day_stats WHERE series = s.id ORDER BY period DESC LIMIT 1)) "
+                "FROM series s").fetchone()
+        if first is None:
+            return None
+        return to_datetime(first * US_PER_DAY).date(), to_datetime(last * US_PER_DAY).date()
+
+    def iter_rows(self, station=None, trk=None, fuel=None, start=None, end=None, chunk=CHUNK_ROWS):
+        """Транзакции рядов под фильтром, начавшиеся в [start, end), порциями.
+
+        Выдает (ряд, столбцы) — столбцы start, end, liters, flow упорядочены по
+        времени начала; в порции не больше chunk строк.
+        """
+        start = np.iinfo(np.int64).min if start is None else int(start)
+        end = np.iinfo(np.int64).max if end is None else int(end)
+        with self._connect() as connection:
+            for series_id, key in sorted(self._series(connection, station, trk, fuel).items(),
+                                         key=lambda item: item[1]):
+                cursor = connection.execute("SELECT start, end, liters, flow FROM transactions WHERE series = ? "
+                                            "AND start >= ? AND start < ? ORDER BY start", (series_id, start, end))
+                while rows := cursor.fetchmany(chunk):
+                    columns = np.array(rows, dtype=np.float64)
+                    yield key, {'start': columns[:, 0].astype(np.int64), 'end': columns[:, 1].astype(np.int64),
+                                'liters': columns[:, 2], 'flow': columns[:, 3]}
+
+    def rows(self, key, start=None, end=None):
+        """Все транзакции одного ряда за [start, end) одним набором столбцов"""
+        parts = [columns for _, columns in self.iter_rows(*key, start=start, end=end)]
+        if not parts:
+            return {'start': np.empty(0, dtype=np.int64), 'end': np.empty(0, dtype=np.int64),
+                    'liters': np.empty(0), 'flow': np.empty(0)}
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    @staticmethod
+    def _parts(by, start, end):
+        """[(таблица, от, до)] агрегатов, из которых складывается период [start, end).
+
+        В период входят сутки (месяцы для 'month'), начинающиеся в [start, end).
+        Для 'series' целые месяцы читаются из месячных агрегатов, а сутки по
+        краям — из суточных.
+        """
+        low, high = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+        if by == 'month':
+            lo = low if start is None else int(month_of(start)) + (month_start(month_of(start)) < start)
+            hi = high if end is None else int(month_of(end)) + (month_start(month_of(end)) < end)
+            return [('month_stats', lo, hi)]
+        lo = low if start is None else -(-int(start) // US_PER_DAY)
+        hi = high if end is None else -(-int(end) // US_PER_DAY)
+        if by == 'day':
+            return [('day_stats', lo, hi)]
+        first = low if start is None else int(month_of(lo * US_PER_DAY)) + (month_start(month_of(lo * US_PER_DAY))
+                                                                             < lo * US_PER_DAY)
+        last = high if end is None else int(month_of(hi * US_PER_DAY))
+        if first >= last:
+            return [('day_stats', lo, hi)]
+        parts = [('month_stats', first, last)]
+        if start is not None:
+            parts.append(('day_stats', lo, month_start(first) // US_PER_DAY))
+        if end is not None:
+            parts.append(('day_stats', month_start(last) // US_PER_DAY, hi))
+        return parts
+
+    def aggregate(self, station=None, trk=None, fuel=None, start=None, end=None, by='series'):
+        """Сводка рядов под фильтром за [start, end) по агрегатам.
+
+        by: 'series' — строка на ряд за весь период, 'day' или 'month' — на ряд
+        и сутки/месяц. Учитываются сутки (месяцы), начинающиеся в [start, end).
+        Возвращает словари с полями AGGREGATE_FIELDS, упорядоченные по ряду и периоду.
+        """
+        if by not in ('series', 'day', 'month'):
+            raise ValueError(f"Неизвестная группировка: {by}")
+        parts = self._parts(by, start, end)
+        period = "period" if by != 'series' else "NULL"
+        group = "series, period" if by != 'series' else "series"
+        rows = " UNION ALL ".join(f"SELECT * FROM {table} WHERE series = ? AND period >= ? AND period < ?"
+                                  for table, _, _ in parts)
+        query = (f"SELECT series, {period}, sum(count), sum(liters), sum(minutes), sum(flow_sum), min(flow_min), "
+                 f"max(flow_max), sum(outliers) FROM ({rows}) GROUP BY {group} ORDER BY {group}")
+        labels = dict()  # Период -> подпись
+        result = []
+        with self._connect() as connection:
+            for series_id, key in sorted(self._series(connection, station, trk, fuel).items(),
+                                         key=lambda item: item[1]):
+                values = [value for _, lo, hi in parts for value in (series_id, lo, hi)]
+                for _, period_value, count, liters, minutes, flow_sum, low, high, outliers in connection.execute(
+                        query, values):
+                    if not count:
+                        continue
+                    label = None
+                    if period_value is not None:
+                        label = labels.get(period_value)
+                        if label is None:
+                            label = labels[period_value] = _period_label(by, period_value)
+                    result.append({
+                        'station': key[0],
+                        'trk': key[1],
+                        'fuel': key[2],
+                        'period': label,
+                        'transactions': count,
+                        'liters': round(liters, 3),
+                        'minutes': round(minutes, 3),
+                        'mean_flow': round(flow_sum / count, 3),
+                        'min_flow': round(low, 3),
+                        'max_flow': round(high, 3),
+                        'outliers': outliers,
+                    })
+        return result
@@ -0,0 +1,124 @@
+import copy
+
+import numpy as np
+
+
+class SeriesIndex:
+    """Транзакции, сгруппированные по (станция, ТРК, топливо) и отсортированные по времени начала.
+
+    Каждый ряд занимает непрерывный отрезок [lo, hi) в общих массивах start,
+    duration, flow и liters, поэтому выбор диапазона дат — два двоичных поиска, а
+    статистика по диапазону считается над срезом без копирования.
+    """
+
+    def __init__(self, transactions):
+        order = np.lexsort((transactions.start, transactions.fuel, transactions.trk, transactions.station))
+        station = transactions.station[order]
+        trk = transactions.trk[order]
+        fuel = transactions.fuel[order]
+        self.start = transactions.start[order]
+        self.duration = (transactions.end - transactions.start)[order]
+        self.flow = transactions.flow[order]
+        self.liters = transactions.liters[order]
+
+        self.series = dict()  # (станция, ТРК, топливо) -> (lo, hi)
+        if not len(order):
+            return
+        change = np.flatnonzero((station[1:] != station[:-1]) | (trk[1:] != trk[:-1]) | (fuel[1:] != fuel[:-1])) + 1
+        bounds = np.concatenate(([0], change, [len(order)]))
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            key = (transactions.stations[station[lo]], int(trk[lo]), transactions.fuels[fuel[lo]])
+            self.series[key] = (lo, hi)
+
+    def keys(self):
+        return self.series.keys()
+
+    def extend(self, transactions):
+        """Новый индекс, в который добавлены транзакции transactions (например, дочитанные в онлайн-режиме).
+
+        Новые транзакции встают в отрезки своих рядов по двоичному поиску,
+        остальные ряды только сдвигаются, поэтому весь индекс заново не
+        сортируется. Сам индекс не меняется: его может читать другой поток.
+        """
+        if not len(transactions):
+            return self
+        # Ряды индекса в порядке их отрезков; новые ряды встают в конец в порядке ключей
+        layout = sorted(self.series, key=self.series.get)
+        rank_of = {key: rank for rank, key in enumerate(layout)}
+        triples, inverse = np.unique(np.stack([transactions.station, transactions.trk, transactions.fuel]), axis=1,
+                                     return_inverse=True)
+        keys = [(transactions.stations[station], trk, transactions.fuels[fuel])
+                for station, trk, fuel in triples.T.tolist()]
+        added = sorted(key for key in keys if key not in rank_of)
+        for key in added:
+            rank_of[key] = len(rank_of)
+        layout.extend(added)
+        row_rank = np.array([rank_of[key] for key in keys], dtype=np.int64)[inverse.reshape(-1)]
+        order = np.lexsort((transactions.start, row_rank))
+        row_rank = row_rank[order]
+        start = transactions.start[order]
+        # Место каждой новой транзакции в старых массивах — внутри отрезка ее ряда
+        positions = np.full(len(order), len(self.start), dtype=np.int64)
+        bounds = np.append(_changes(row_rank), len(order)).tolist()
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            series = self.series.get(layout[row_rank[lo]])
+            if series is not None:
+                positions[lo:hi] = series[0] + np.searchsorted(self.start[series[0]:series[1]], start[lo:hi],
+                                                               'right')
+        extended = copy.copy(self)
+        extended.start = np.insert(self.start, positions, start)
+        extended.duration = np.insert(self.duration, positions, (transactions.end - transactions.start)[order])
+        extended.flow = np.insert(self.flow, positions, transactions.flow[order])
+        extended.liters = np.insert(self.liters, positions, transactions.liters[order])
+        counts = np.bincount(row_rank, minlength=len(layout))
+        shift = (np.cumsum(counts) - counts).tolist()
+        counts = counts.tolist()
+        extended.series = dict()
+        for rank, key in enumerate(layout):
+            lo, hi = self.series.get(key, (len(self.start), len(self.start)))
+            extended.series[key] = (lo + shift[rank], hi + shift[rank] + counts[rank])
+        return extended
+
+    def range(self, key, start, end):
+        """Отрезок [lo, hi) транзакций ряда key, начавшихся в [start, end) (микросекунды от 1970-01-01)"""
+        lo, hi = self.series.get(key, (0, 0))
+        starts = self.start[lo:hi]
+        return lo + int(np.searchsorted(starts, start, 'left')), lo + int(np.searchsorted(starts, end, 'left'))
+
+    def mean_flow(self, lo, hi):
+        if hi <= lo:
+            return float('nan')
+        return float(self.flow[lo:hi].mean())
+
+    def grid(self, keys, start, end, buckets):
+        """Средняя скорость и число транзакций рядов keys на общей сетке из buckets интервалов [start, end).
+
+        Все ряды считаются одним векторным проходом (flow_grid); возвращает
+        (границы интервалов, средняя — массив ряды x интервалы с NaN в пустых, число транзакций).
+        """
+        ranges = np.array([self.range(key, start, end) for key in keys], dtype=np.int64).reshape(-1, 2)
+        lengths = ranges[:, 1] - ranges[:, 0]
+        # Номера транзакций всех рядов подряд без цикла по рядам
+        offsets = np.cumsum(lengths) - lengths
+        take = np.arange(int(lengths.sum())) + np.repeat(ranges[:, 0] - offsets, lengths)
+        rows = np.repeat(np.arange(len(ranges)), lengths)
+        return flow_grid(rows, self.start[take], self.flow[take], len(ranges), start, end, buckets)
+
+
+def flow_grid(rows, start, flow, count, lo, hi, buckets):
+    """Сетка средних скоростей: транзакция с началом start попадает в строку rows и интервал времени [lo, hi)"""
+    edges = np.linspace(lo, hi, buckets + 1)
+    bucket = np.clip(((start - lo) / (hi - lo) * buckets).astype(np.int64), 0, buckets - 1)
+    cells = rows * buckets + bucket
+    counts = np.bincount(cells, minlength=count * buckets).reshape(count, buckets)
+    total = np.bincount(cells, weights=flow, minlength=count * buckets).reshape(count, buckets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(counts > 0, total / counts, np.nan)
+    return edges, mean, counts
+
+
+def _changes(column):
+    """Начала групп одинаковых значений в упорядоченном столбце"""
+    change = np.ones(len(column), dtype=bool)
+    change[1:] = column[1:] != column[:-1]
+    return np.flatnonzero(change)
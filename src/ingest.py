@@ -0,0 +1,85 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from src.parser import BBOXParser
+
+
+def parse_partial(file_path, mode, cache=None):
+    """Разбирает один файл отдельным парсером. Результат сливается в общий через BBOXParser.merge"""
+    partial = BBOXParser(mode)
+    ok = partial.parse_file(file_path)
+    if ok and cache is not None:
+        cache.put(file_path, partial)
+    return ok, partial
+
+
+def from_cache(partial):
+    """Метрики закэшированного результата: время разбора относится к прошлому запуску, его не учитываем"""
+    partial.metrics.stages.clear()
+    partial.metrics.count('files_cached')
+    return partial
+
+
+def iter_partials(found_files, mode='stream', workers=1, is_cancelled=lambda: False, cache=None):
+    """Выдает (file_path, ok, partial, from_cache) строго в порядке found_files.
+
+    Файлы, найденные в кэше, не разбираются. При workers > 1 остальные файлы
+    разбираются в пуле процессов; впереди держится не больше 2 * workers задач,
+    чтобы готовые результаты не копились в памяти.
+    """
+    if workers <= 1:
+        for file_path in found_files:
+            if is_cancelled():
+                return
+            partial = cache.get(file_path) if cache is not None else None
+            if partial is not None:
+                yield file_path, True, from_cache(partial), True
+                continue
+            ok, partial = parse_partial(file_path, mode, cache)
+            yield file_path, ok, partial, False
+        if cache is not None:
+            cache.evict()
+        return
+
+    files = iter(found_files)
+    pending = deque()
+    executor = ProcessPoolExecutor(max_workers=workers)
+
+    def submit_next():
+        file_path = next(files, None)
+        if file_path is None:
+            return False
+        partial = cache.get(file_path) if cache is not None else None
+        if partial is not None:
+            pending.append((file_path, None, from_cache(partial)))
+        else:
+            pending.append((file_path, executor.submit(parse_partial, file_path, mode, cache), None))
+        return True
+
+    try:
+        while len(pending) < 2 * workers and submit_next():
+            pass
+        while pending:
+            file_path, future, partial = pending.popleft()
+            ok = True
+            while True:
+                if is_cancelled():
+                    return
+                if future is None:
+                    break
+                try:
+                    ok, partial = future.result(timeout=0.2)
+                    break
+                except TimeoutError:
+                    continue
+                except Exception as e:
+                    # Упал сам процесс-разборщик: ошибка попадает в метрики, как и ошибки разбора
+                    ok, partial = False, BBOXParser(mode)
+                    partial.metrics.fail(file_path, e)
+                    break
+            submit_next()
+            yield file_path, ok, partial, future is None
+        if cache is not None:
+            cache.evict()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
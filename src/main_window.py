@@ -1,17 +1,174 @@
 import os
+import time
+from itertools import islice
 
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout,
                            QHBoxLayout, QListWidget, QLineEdit, QPushButton,
                            QLabel, QComboBox,
                            QFileDialog, QMessageBox,
-                           QDateEdit)
-from PyQt5.QtCore import QDate
-import matplotlib.pyplot as plt
+                           QDateEdit, QSpinBox, QCheckBox)
+from PyQt5.QtCore import QDate, Qt, QTimer
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from datetime import datetime, timedelta
 
+import numpy as np
+
+from src.cache import ParseCache
+from src.chart import FlowChart
+from src.detect import ClogDetector
+from src.engine import TransactionEngine, Transactions, merge_events
+from src.events import to_timestamp
+from src.index import SeriesIndex, flow_grid
+from src.files import find_bbox_files
+from src.history import HistoryStore
+from src.manifest import Manifest
+from src.metrics import Metrics
 from src.parser import BBOXParser
-from src.processor import DataProcessor
+from src.partial import file_identity
+from src.processor import DataProcessor, GraphWorker, LiveUpdater, ManifestBuilder, PartialLoader
+from src.rollup import Rollups
+
+SELECTION_DELAY = 150  # мс: изменения фильтров за это время сливаются в один пересчет
+CANCEL_EVENTS = 100000  # Событий между проверками отмены пересчета
+# Режимы сравнения: подпись в списке -> какие ряды сравниваются с выбранным
+COMPARE_MODES = (("Один ряд", None), ("Все ТРК АЗС", 'station'), ("Топливо по всем АЗС", 'fuel'))
+COMPARE_SERIES = 50  # Больше линий на одном графике не различить
+COMPARE_PIXELS = 4  # Ширина интервала сетки сравнения в пикселях: линии рядов не сливаются, отрисовка не дольше одного ряда
+
+
+def engine_metrics(engine):
+    """Копия метрик движка: окно читает ее, пока движок продолжает работу в фоновом потоке"""
+    metrics = Metrics()
+    metrics.merge(engine.metrics)
+    return metrics
+
+
+def build_graph_data(snapshot, imported, is_cancelled):
+    """Транзакции, индекс рядов, детектор засоров и агрегаты по снимку загруженных файлов; None — отменено.
+
+    snapshot — (путь, события, число событий): онлайн-режим может дописать
+    события к списку файла, пока идет пересчет, они учитываются следующим.
+    События всех файлов проходят через движок одним потоком в порядке времени.
+    imported — частичный результат других узлов или None; файлы, разобранные
+    здесь же, берутся из snapshot.
+    """
+    timings = dict()
+    started = time.perf_counter()
+    engine = TransactionEngine()
+    events = merge_events([file_data if len(file_data) == size else file_data[:size]
+                           for _, file_data, size in snapshot])
+    while chunk := list(islice(events, CANCEL_EVENTS)):
+        if is_cancelled():
+            return None
+        engine.feed(chunk)
+    transactions = engine.transactions()
+    if imported is not None:
+        imported = imported.exclude({file_identity(file_path)[0] for file_path, _, _ in snapshot})
+        transactions = Transactions.concatenate([transactions, imported.transactions()])
+    index = SeriesIndex(transactions)
+    timings['reconstruct'] = time.perf_counter() - started
+    if is_cancelled():
+        return None
+    started = time.perf_counter()
+    detector = ClogDetector()
+    detector.update(transactions)
+    timings['detect'] = time.perf_counter() - started
+    started = time.perf_counter()
+    rollups = Rollups.from_transactions(transactions)
+    timings['rollup'] = time.perf_counter() - started
+    return {'engine': engine, 'metrics': engine_metrics(engine), 'transactions': transactions, 'index': index,
+            'detector': detector, 'alerts': detector.alerts(), 'rollups': rollups, 'imported': imported,
+            'timings': timings, 'fed': {file_path: size for file_path, _, size in snapshot}}
+
+
+def update_graph_data(state, snapshot):
+    """Продолжает пересчет state дочитанными событиями snapshot; индекс, детектор и агрегаты — по новым транзакциям.
+
+    state — результат build_graph_data, его движок и детектор продолжают
+    работу, а fed — сколько событий каждого файла уже прошло через движок.
+    state обновляется, даже если результат уже не нужен: следующее задание
+    продолжит с того же места. Возвращает копию state.
+    """
+    timings = dict()
+    started = time.perf_counter()
+    engine, fed = state['engine'], state['fed']
+    seen = len(engine)
+    # Дочитанные события продолжают состояние ТРК, в том числе начатое в прошлом файле
+    engine.feed(merge_events([file_data[fed.get(file_path, 0):size] for file_path, file_data, size in snapshot]))
+    transactions = engine.transactions()
+    added = transactions.take(slice(seen, None))
+    index = state['index'].extend(added)
+    timings['reconstruct'] = time.perf_counter() - started
+    started = time.perf_counter()
+    state['detector'].update(transactions)
+    timings['detect'] = time.perf_counter() - started
+    started = time.perf_counter()
+    rollups = state['rollups'].merge(Rollups.from_transactions(transactions, seen))
+    timings['rollup'] = time.perf_counter() - started
+    state.update(metrics=engine_metrics(engine), transactions=transactions, index=index,
+                 alerts=state['detector'].alerts(), rollups=rollups, timings=timings, fed=dict(fed, **{file_path: size for file_path, _, size in snapshot}))
+    return dict(state)
+
+
+def prepare_plot(index, rollups, chart, key, start, end, buckets):
+    """Срез ряда key за [start, end), сводка по агрегатам и геометрия графика; None — нет данных"""
+    lo, hi = index.range(key, start, end)
+    if hi <= lo:
+        return None
+    # Средняя и квантили — по агрегатам дней и недель, без прохода по транзакциям
+    stats = rollups.stats(key, start, end)
+    return chart.prepare(index.start[lo:hi], index.duration[lo:hi], index.flow[lo:hi], stats['mean_flow'],
+                         f"Транзакций: {stats['transactions']}, средняя {stats['mean_flow']:.1f}, "
+                         f"медиана {stats['median_flow']:.1f}, p10–p90: {stats['p10_flow']:.1f}–"
+                         f"{stats['p90_flow']:.1f} л/мин", buckets)
+
+
+def compare_keys(keys, mode, key):
+    """Ряды для сравнения с рядом key: все ТРК и виды топлива его АЗС или его топливо на всех АЗС"""
+    station, _, fuel = key
+    if mode == 'station':
+        return sorted(other for other in keys if other[0] == station)
+    return sorted(other for other in keys if other[2] == fuel)
+
+
+def prepare_comparison(grid, chart, keys, start, end, buckets):
+    """Средняя скорость рядов keys на общей сетке; grid(keys, start, end, buckets) — SeriesIndex.grid или его аналог"""
+    edges, mean, counts = grid(keys, start, end, buckets)
+    filled = counts.sum(axis=1) > 0
+    labels = [f"{station}, ТРК {trk}, {fuel}" for (station, trk, fuel), used in zip(keys, filled) if used]
+    return chart.prepare_comparison(edges, mean[filled], labels,
+                                    f"Сравнение рядов: {len(labels)}, транзакций: {int(counts.sum())}")
+
+
+def history_grid(history, keys, start, end, buckets):
+    """Как SeriesIndex.grid, но по транзакциям из истории"""
+    rows, starts, flows = [], [], []
+    for number, key in enumerate(keys):
+        for _, columns in history.iter_rows(*key, start=start, end=end):
+            rows.append(np.full(len(columns['start']), number))
+            starts.append(columns['start'])
+            flows.append(columns['flow'])
+    if not rows:
+        return flow_grid(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), len(keys),
+                         start, end, buckets)
+    return flow_grid(np.concatenate(rows), np.concatenate(starts), np.concatenate(flows), len(keys),
+                     start, end, buckets)
+
+
+def prepare_history_plot(history, chart, key, start, end, buckets):
+    """То же, что prepare_plot, но по транзакциям из истории (src.history); квантили — точные"""
+    rows = history.rows(key, start, end)
+    if not len(rows['start']):
+        return None
+    flow = rows['flow']
+    mean = float(flow.mean())
+    p10, median, p90 = np.percentile(flow, (10, 50, 90))
+    return chart.prepare(rows['start'], rows['end'] - rows['start'], flow, mean,
+                         f"История — транзакций: {len(flow)}, средняя {mean:.1f}, медиана {median:.1f}, "
+                         f"p10–p90: {p10:.1f}–{p90:.1f} л/мин", buckets)
+
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -33,6 +190,36 @@ class MainWindow(QMainWindow):
         top_panel.addWidget(QLabel("Директория:"))
         top_panel.addWidget(self.dir_path)
         top_panel.addWidget(browse_button)
+        # Число процессов для разбора файлов
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, os.cpu_count() or 1)
+        self.workers_spin.setValue(os.cpu_count() or 1)
+        top_panel.addWidget(QLabel("Процессов:"))
+        top_panel.addWidget(self.workers_spin)
+        # Быстрый разбор: нужные строки ищутся прямо в байтах файла, необычные файлы разбираются как XML
+        self.scan_checkbox = QCheckBox("Быстрый разбор")
+        top_panel.addWidget(self.scan_checkbox)
+        stop_button = QPushButton("Остановить")
+        stop_button.clicked.connect(self.stop_processing)
+        top_panel.addWidget(stop_button)
+        clear_cache_button = QPushButton("Сбросить кэш")
+        clear_cache_button.clicked.connect(self.clear_cache)
+        top_panel.addWidget(clear_cache_button)
+        export_metrics_button = QPushButton("Экспорт метрик")
+        export_metrics_button.clicked.connect(self.export_metrics)
+        top_panel.addWidget(export_metrics_button)
+        # Результаты, посчитанные на других узлах (python main.py partial), — без разбора их логов
+        import_button = QPushButton("Загрузить результаты")
+        import_button.clicked.connect(self.import_partials)
+        top_panel.addWidget(import_button)
+        # Онлайн-режим: дочитывание текущего лога и новых файлов без повторного разбора архива
+        self.live_checkbox = QCheckBox("Онлайн-режим")
+        self.live_checkbox.toggled.connect(self.toggle_live)
+        top_panel.addWidget(self.live_checkbox)
+        # График и списки — по накопленной истории всех разобранных файлов, без разбора логов
+        self.history_checkbox = QCheckBox("Из истории")
+        self.history_checkbox.toggled.connect(self.toggle_history)
+        top_panel.addWidget(self.history_checkbox)
         layout.addLayout(top_panel)
 
         # Создаем панель с выпадающими списками
@@ -51,6 +238,13 @@ class MainWindow(QMainWindow):
         filter_panel.addWidget(self.fuel_type_combo)
         filter_panel.addWidget(QLabel("Номер заправки:"))
         filter_panel.addWidget(self.gas_station)
+        # Сравнение выбранного ряда с соседними на одном графике
+        self.compare_combo = QComboBox(self)
+        for title, _ in COMPARE_MODES:
+            self.compare_combo.addItem(title)
+        self.compare_combo.currentIndexChanged.connect(self.onComboBoxChange)
+        filter_panel.addWidget(QLabel("Сравнение:"))
+        filter_panel.addWidget(self.compare_combo)
 
         layout.addLayout(filter_panel)
 
@@ -73,24 +267,74 @@ class MainWindow(QMainWindow):
         layout.addLayout(date_panel)
 
         # Создаем область для графика
-        self.figure, self.ax = plt.subplots()
+        self.figure = Figure()
+        self.ax = self.figure.add_subplot(111)
         self.canvas = FigureCanvas(self.figure)
         self.canvas.setMinimumHeight(300)  # Устанавливаем минимальную высоту
+        # Оси и элементы графика создаются один раз; масштаб и сдвиг — через панель инструментов
+        self.chart = FlowChart(self.ax)
+        self.figure.tight_layout()
+        layout.addWidget(NavigationToolbar(self.canvas, self))
         layout.addWidget(self.canvas, stretch=1)  # Добавляем stretch=1 для автоматического изменения размера
 
         # Добавляем консоль для вывода
+        bottom_panel = QHBoxLayout()
         console_layout = QVBoxLayout()
         console_label = QLabel("Консоль:")
         self.console = QListWidget()
         self.console.setMaximumHeight(250)
         console_layout.addWidget(console_label)
         console_layout.addWidget(self.console)
-        layout.addLayout(console_layout)
+        bottom_panel.addLayout(console_layout, stretch=2)
+        # Подозрения на засор по всем рядам; щелчок выбирает ряд в выпадающих списках
+        alerts_layout = QVBoxLayout()
+        alerts_layout.addWidget(QLabel("Подозрения на засор:"))
+        self.alerts_list = QListWidget()
+        self.alerts_list.setMaximumHeight(250)
+        self.alerts_list.itemClicked.connect(self.select_alert)
+        alerts_layout.addWidget(self.alerts_list)
+        bottom_panel.addLayout(alerts_layout, stretch=1)
+        layout.addLayout(bottom_panel)
 
         # Инициализируем парсер и список найденных файлов
-        self.parser = BBOXParser()
+        self.parser = BBOXParser(mode='stream')
+        self.cache = ParseCache()
+        self.metrics = Metrics()  # Этапы окна; разбор считается в self.parser.metrics, отбрасывания — в self.engine_metrics
         self.found_files = []
         self.loaded_dates = set()  # Множество для хранения загруженных дат
+        # Оглавление архива: по нему разбираются только файлы, попадающие в выбранные АЗС и даты
+        self.manifest = None
+        self.requested_files = set()  # Файлы, уже отданные в разбор (в том числе с ошибкой)
+        self.alerts = []  # Подозрения на засор по последнему пересчету
+        self.rollups = Rollups()  # Агрегаты по часам, дням и неделям — для средней линии и квантилей
+        self.imported = None  # Частичные результаты других узлов
+        self.imported_used = None  # Их часть без файлов, разобранных здесь, — она вошла в транзакции
+        self.live = None
+        try:
+            self.history = HistoryStore()  # Пополняется при разборе и загрузке результатов
+        except Exception as e:
+            self.history = None
+            self.history_checkbox.setEnabled(False)
+            self.log_message(f"История недоступна: {str(e)}")
+
+        # Пересчет транзакций и подготовка графика идут в фоне; в потоке окна — только обновление художников.
+        # Новое задание отменяет устаревшее, результат принимается, только если номер задания последний
+        self.rebuild_worker = GraphWorker()
+        self.rebuild_worker.ready.connect(self.on_graph_data)
+        self.rebuild_worker.failed.connect(self.on_graph_failed)
+        self.plot_worker = GraphWorker()
+        self.plot_worker.ready.connect(self.plot_selection)
+        self.plot_worker.failed.connect(self.on_graph_failed)
+        self.rebuild_job = None  # Номер пересчета транзакций, результат которого еще не пришел
+        self.live_job = None  # Номер задания с дочитанными событиями
+        self.graph_state = None  # Результат последнего пересчета — с него продолжает онлайн-режим
+        self.plot_job = None
+        self.report_metrics = False  # Вывести сводку метрик, когда будут готовы транзакции
+        # Быстрые изменения фильтров сливаются в один пересчет
+        self.selection_timer = QTimer(self)
+        self.selection_timer.setSingleShot(True)
+        self.selection_timer.setInterval(SELECTION_DELAY)
+        self.selection_timer.timeout.connect(self.load_selection)
 
     def log_message(self, message):
         """Добавляет сообщение в консоль"""
@@ -98,17 +342,19 @@ class MainWindow(QMainWindow):
         self.console.addItem(f"[{current_time}] {message}")
         self.console.scrollToBottom()
 
+    def log_warnings(self, warnings):
+        for file_path, error in warnings:
+            self.log_message(f"Предупреждение: {os.path.basename(file_path)}: {error}")
+
     def find_bbox_files(self, directory):
         """Рекурсивный поиск BBOX файлов"""
         try:
-            self.found_files = []
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if file.upper().endswith('.XML') and str(file.upper()).startswith('BBOX'):
-                        full_path = os.path.join(root, file)
-                        self.found_files.append(full_path)
-                        self.log_message(f"Найден файл: {full_path}")
-                        break
+            warned = len(self.metrics.warnings)
+            with self.metrics.stage('find_files'):
+                self.found_files = find_bbox_files(directory, self.metrics)
+            self.log_warnings(self.metrics.warnings[warned:])
+            for full_path in self.found_files:
+                self.log_message(f"Найден файл: {full_path}")
 
             self.log_message(f"Всего найдено файлов: {len(self.found_files)}")
             return True
@@ -122,21 +368,223 @@ class MainWindow(QMainWindow):
             self.dir_path.setText(directory)
             self.log_message(f"Выбрана директория: {directory}")
             self.log_message("Начинаем поиск файлов...")
+            self.stop_live()
+            self.stop_processing(wait=True)
+            # Новый каталог — данные прошлого не смешиваются с ним
+            self.parser = BBOXParser(mode='stream')
+            if self.imported is not None:
+                self.parser.merge_lists(self.imported.lists())
+            self.requested_files = set()
+            self.loaded_dates = set()
+            self.engine_metrics = None
+            self.index = None
+            self.rebuild_job = self.plot_job = self.live_job = None  # Результаты заданий по прошлому каталогу не нужны
+            self.graph_state = None
             if self.find_bbox_files(directory):
-                self.process_files()
+                self.build_manifest(directory)
+
+    def build_manifest(self, directory):
+        """Обновляет оглавление архива в фоне; после этого загружается только выбранный период"""
+        self.manifest = Manifest.for_directory(directory)
+        self.builder = ManifestBuilder(self.manifest, self.found_files)
+        self.builder.progress.connect(self.log_message)
+        self.builder.finished.connect(self.on_manifest_ready)
+        self.builder.start()
+
+    def on_manifest_ready(self):
+        """Даты и АЗС берутся из оглавления всего архива; по умолчанию выбрана последняя неделя"""
+        date_range = self.manifest.date_range()
+        if date_range is not None:
+            first, last = date_range
+            min_date = QDate(first.year, first.month, first.day)
+            max_date = QDate(last.year, last.month, last.day)
+            for edit in (self.start_date, self.end_date):
+                edit.blockSignals(True)
+                edit.setDateRange(min_date, max_date)
+            self.start_date.setDate(max(min_date, max_date.addDays(-6)))
+            self.end_date.setDate(max_date)
+            for edit in (self.start_date, self.end_date):
+                edit.blockSignals(False)
+        self.update_comboboxes()
+        self.load_selection()
 
-    def process_files(self):
-        """Асинхронная обработка файлов"""
-        self.processor = DataProcessor(self.parser, self.found_files)
+    def selected_range(self):
+        """Выбранный период [start, end) в микросекундах от 1970-01-01"""
+        start_date = self.start_date.date().toPyDate()
+        end_date = self.end_date.date().toPyDate() + timedelta(days=1)
+        return (to_timestamp(datetime.combine(start_date, datetime.min.time())),
+                to_timestamp(datetime.combine(end_date, datetime.min.time())))
+
+    def load_selection(self):
+        """Догружает файлы, пересекающиеся с выбранной АЗС и периодом; если догружать нечего — перерисовывает график"""
+        if self.history_mode() or self.manifest is None or (getattr(self, 'processor', None) is not None and self.processor.isRunning()):
+            # Во время разбора выбор учитывается в on_processing_finished
+            self.draw_graph()
+            return
+        start, end = self.selected_range()
+        # Сравнение топлива по всем АЗС требует файлов всех АЗС
+        station = None if COMPARE_MODES[self.compare_combo.currentIndex()][1] == 'fuel' else \
+            self.gas_station.currentText() or None
+        files = [file_path for file_path in
+                 self.manifest.select(self.found_files, station, start, end)
+                 if file_path not in self.requested_files]
+        if not files:
+            self.draw_graph()
+            return
+        self.log_message(f"Загрузка файлов за выбранный период: {len(files)} из {len(self.found_files)}")
+        self.process_files(files)
+
+    def process_files(self, files=None):
+        """Асинхронная обработка файлов (по умолчанию — всех найденных)"""
+        files = self.found_files if files is None else files
+        self.requested_files.update(files)
+        self.parser.mode = 'scan' if self.scan_checkbox.isChecked() else 'stream'
+        self.processor = DataProcessor(self.parser, files, self.workers_spin.value(), self.cache, self.manifest,
+                                       self.history)
         self.processor.progress.connect(self.log_message)
         self.processor.finished.connect(self.on_processing_finished)
         self.processor.start()
 
+    def stop_processing(self, wait=False):
+        """Прерывает фоновую обработку файлов"""
+        for thread in (getattr(self, 'builder', None), getattr(self, 'processor', None)):
+            if thread is not None and thread.isRunning():
+                thread.requestInterruption()
+                if wait:
+                    thread.wait()
+
+    def clear_cache(self):
+        """Удаляет все сохраненные результаты разбора"""
+        self.cache.clear()
+        self.log_message(f"Кэш разбора очищен: {self.cache.directory}")
+
     def on_processing_finished(self):
         self.update_comboboxes()
+        self.report_metrics = True
         self.calculate_graph_data()
+        if self.processor.isInterruptionRequested():
+            self.draw_graph()
+        else:
+            # Пока шел разбор, фильтр могли расширить — догружаем недостающее
+            self.load_selection()
+        if self.live_checkbox.isChecked():
+            self.start_live()
+
+    def import_partials(self):
+        """Загружает частичные результаты (.bbp) в фоне и добавляет их транзакции к своим"""
+        paths, _ = QFileDialog.getOpenFileNames(self, "Частичные результаты", "",
+                                                "Частичные результаты (*.bbp)")
+        if not paths:
+            return
+        self.loader = PartialLoader(paths, self.imported, self.history)
+        self.loader.progress.connect(self.log_message)
+        self.loader.finished.connect(self.on_partials_loaded)
+        self.loader.start()
+
+    def on_partials_loaded(self):
+        if self.loader.result is None:
+            return
+        self.imported = self.loader.result
+        self.parser.merge_lists(self.imported.lists())
+        self.update_comboboxes()
+        self.calculate_graph_data()
+
+    def collect_metrics(self):
+        """Сводные метрики: разбор, восстановление транзакций и этапы окна"""
+        metrics = Metrics()
+        metrics.merge(self.parser.metrics)
+        # Сбои кэша и оглавления — по всему сеансу
+        metrics.merge(self.cache.metrics)
+        if self.manifest is not None:
+            metrics.merge(self.manifest.metrics)
+        if self.imported_used is not None:
+            metrics.merge(self.imported_used.metrics())
+        if getattr(self, 'engine_metrics', None) is not None:
+            metrics.merge(self.engine_metrics)
+        metrics.merge(self.metrics)
+        return metrics
+
+    def export_metrics(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Сохранить метрики", "metrics.json", "JSON (*.json)")
+        if not file_path:
+            return
+        try:
+            self.collect_metrics().to_json(file_path)
+            self.log_message(f"Метрики сохранены: {file_path}")
+        except Exception as e:
+            self.log_message(f"Ошибка при сохранении метрик: {str(e)}")
+
+    def toggle_live(self, checked):
+        if checked:
+            self.start_live()
+        else:
+            self.stop_live()
+
+    def start_live(self):
+        """Запускает дочитывание новых данных; до окончания первичной обработки ничего не делает"""
+        if not self.dir_path.text() or (self.live is not None and self.live.isRunning()):
+            return
+        if getattr(self, 'processor', None) is None or self.processor.isRunning():
+            return
+        # Файлы, которые не удалось разобрать целиком (например, незакрытый текущий лог), дочитываются с начала;
+        # еще не загруженные файлы архива разбираются при выборе их периода
+        known_files = self.parser.files + [file_path for file_path in self.found_files
+                                           if file_path not in self.requested_files]
+        self.live = LiveUpdater(self.dir_path.text(), known_files, self.parser.mode, history=self.history,
+                                context=list(self.parser.data))
+        self.live.progress.connect(self.log_message)
+        self.live.updated.connect(self.on_live_update)
+        self.live.reset.connect(self.on_live_reset)
+        self.live.start()
+        self.log_message("Онлайн-режим включен")
+
+    def stop_live(self):
+        if self.live is not None and self.live.isRunning():
+            self.live.requestInterruption()
+            self.live.wait()
+            self.log_message("Онлайн-режим выключен")
+        self.live = None
+
+    def on_live_reset(self, file_path):
+        """Файл заменен или обрезан: его события отбрасываются, транзакции пересчитываются заново"""
+        self.parser.reset_file(file_path)
+        self.graph_state = None  # Движок уже учел старые события — следующее обновление пересчитает все
+
+    def on_live_update(self, partials):
+        """Добавляет дочитанные события; через автомат ТРК в фоне проходят только новые события"""
+        for partial in partials:
+            self.parser.merge_tail(partial)
+        self.update_comboboxes()
+        if self.graph_state is None or self.rebuild_job is not None or self.imported is not None:
+            # Пересчет по старому снимку отменяется, новый учтет и дочитанные события.
+            # Транзакции других узлов не проходят через движок — с ними снимок собирается заново
+            self.calculate_graph_data()
+            return
+        # Еще не начатое задание с прошлыми событиями заменяется этим: оно возьмет все, что не прошло через движок
+        state, snapshot = self.graph_state, self.snapshot()
+        self.live_job = self.rebuild_worker.submit(lambda is_cancelled: update_graph_data(state, snapshot))
+
+    def history_mode(self):
+        return self.history is not None and self.history_checkbox.isChecked()
+
+    def toggle_history(self, checked):
+        """Переключает источник графика и списков между загруженными файлами и историей"""
+        if checked:
+            date_range = self.history.date_range()
+            if date_range is None:
+                self.log_message("История пуста")
+            else:
+                self.extendDateRange(date_range)
+        self.update_comboboxes()
         self.draw_graph()
 
+    def history_lists(self):
+        """{станция: {ТРК: [топливо]}} рядов истории — как GlobalDict разбора"""
+        lists = dict()
+        for station, trk, fuel in self.history.series():
+            lists.setdefault(station, dict()).setdefault(str(trk), []).append(fuel)
+        return lists
+
     def validDateUpdate(self, dates):
         """Обработчик завершения обработки файлов"""
         self.loaded_dates = set()
@@ -159,11 +607,41 @@ class MainWindow(QMainWindow):
 
         self.draw_graph()
 
+    def extendDateRange(self, dates):
+        """Расширяет допустимый диапазон дат, не сбрасывая выбор пользователя"""
+        new_dates = set(dates) - self.loaded_dates
+        if not new_dates:
+            return
+        bounds = self.date_bounds()
+        follow_end = bounds is None or self.end_date.date().toPyDate() >= bounds[1]
+        self.loaded_dates |= new_dates
+        first, last = self.date_bounds()
+        min_date = QDate.fromString(first.strftime('%Y-%m-%d'), 'yyyy-MM-dd')
+        max_date = QDate.fromString(last.strftime('%Y-%m-%d'), 'yyyy-MM-dd')
+        self.start_date.setDateRange(min_date, max_date)
+        self.end_date.setDateRange(min_date, max_date)
+        if follow_end:
+            self.end_date.setDate(max_date)
+
+    def date_bounds(self):
+        """Допустимый диапазон дат: весь архив по оглавлению вместе с загруженными датами (и историей); None — данных нет"""
+        dates = set(self.loaded_dates)
+        date_range = self.manifest.date_range() if self.manifest is not None else None
+        if date_range is not None:
+            dates.update(date_range)
+        if self.history_mode():
+            dates.update(self.history.date_range() or ())
+        if not dates:
+            return None
+        return min(dates), max(dates)
+
     def update_comboboxes(self):
         try:
             self.parser.columns.sort()
             self.parser.fuels.sort()
-            self.IsDoClear = True
+            # Пока списки заполняются, их сигналы не вызывают пересчет
+            for combo in (self.fuel_column_combo, self.fuel_type_combo, self.gas_station):
+                combo.blockSignals(True)
             fuel_column_combo_last_text = self.fuel_column_combo.currentText()
             self.fuel_column_combo.clear()
             fuel_type_combo_last_text = self.fuel_type_combo.currentText()
@@ -171,8 +649,13 @@ class MainWindow(QMainWindow):
             gas_station_last_text = self.gas_station.currentText()
             self.gas_station.clear()
 
-            # Add all gas_stations
-            for station in self.parser.gas_stations:
+            # Add all gas_stations, including not yet loaded ones from the manifest
+            stations = list(self.parser.gas_stations)
+            if self.manifest is not None:
+                stations += [station for station in self.manifest.stations() if station not in stations]
+            HistoryDict = self.history_lists() if self.history_mode() else dict()
+            stations += [station for station in HistoryDict if station not in stations]
+            for station in stations:
                 self.gas_station.addItem(station)
 
             # Add columns in this gaz station
@@ -182,7 +665,8 @@ class MainWindow(QMainWindow):
                 Station = gas_station_last_text
                 self.gas_station.setCurrentText(Station)
 
-            for column in self.parser.GlobalDict[Station].keys():
+            StationDict = HistoryDict.get(Station) or self.parser.GlobalDict.get(Station, dict())
+            for column in StationDict.keys():
                 StationsList.append(column)
             StationsList.sort()
             for station in StationsList:
@@ -191,27 +675,27 @@ class MainWindow(QMainWindow):
             # Add fuels in this column
             FuelList = []
             Column = self.fuel_column_combo.currentText()
-            if fuel_column_combo_last_text and fuel_column_combo_last_text in self.parser.GlobalDict[Station]:
+            if fuel_column_combo_last_text and fuel_column_combo_last_text in StationDict:
                 Column = fuel_column_combo_last_text
                 self.fuel_column_combo.setCurrentText(Column)
-            for fuel in self.parser.GlobalDict[Station][Column]:
+            for fuel in StationDict.get(Column, list()):
                 FuelList.append(fuel)
             FuelList.sort()
             for fuel in FuelList:
                 self.fuel_type_combo.addItem(fuel.strip())
 
-            if fuel_type_combo_last_text and fuel_type_combo_last_text in self.parser.GlobalDict[Station][Column]:
+            if fuel_type_combo_last_text and fuel_type_combo_last_text in StationDict.get(Column, list()):
                 self.fuel_type_combo.setCurrentText(fuel_type_combo_last_text)
-
-            self.IsDoClear = False
         except Exception as e:
-            self.IsDoClear = False
-            print(f"Ошибка обновления выпадающих списков. \n{e}")
+            self.metrics.warn('window_errors', self.dir_path.text(), f"списки не обновлены: {str(e)}")
+            self.log_message(f"Ошибка обновления выпадающих списков: {str(e)}")
+        finally:
+            for combo in (self.fuel_column_combo, self.fuel_type_combo, self.gas_station):
+                combo.blockSignals(False)
 
     def onComboBoxChange(self):
-        if not self.IsDoClear:
-            self.update_comboboxes()
-            self.draw_graph()
+        self.update_comboboxes()
+        self.selection_timer.start()
 
     def onDateChange(self):
         """Обработчик изменения дат"""
@@ -224,9 +708,9 @@ class MainWindow(QMainWindow):
         selected_start = self.start_date.date().toPyDate()
         selected_end = self.end_date.date().toPyDate()
 
-        if self.loaded_dates:
-            min_date = min(self.loaded_dates)
-            max_date = max(self.loaded_dates)
+        bounds = self.date_bounds()
+        if bounds is not None:
+            min_date, max_date = bounds
 
             if selected_start < min_date:
                 self.log_message(f"Начальная дата не может быть раньше {min_date}")
@@ -238,169 +722,157 @@ class MainWindow(QMainWindow):
                 self.end_date.setDate(QDate.fromString(max_date.strftime('%Y-%m-%d'), 'yyyy-MM-dd'))
                 return
 
-        self.draw_graph()
+        self.selection_timer.start()
+
+    def snapshot(self):
+        """(путь, события, число событий) загруженных файлов: онлайн-режим дописывает события в те же списки"""
+        return [(file_path, file_data, len(file_data)) for file_path, file_data in zip(self.parser.files,
+                                                                                      self.parser.data)]
 
     def calculate_graph_data(self):
-        self.Graph = dict()
-        hose_into_fuel = []
-        loadedDates = []
-        for i in range(len(self.parser.columns)):
-            hose_into_fuel.append(dict(zip([_ + 1 for _ in range(len(self.parser.fuels))],
-                                           [fuel for fuel in self.parser.fuels])))
-        for file_data in self.parser.data:
-            Column_operation = [{"Start fuel value": 0.0,
-                                 "End fuel value": 0.0,
-                                 "Start time": 0,
-                                 "Fuel": -1,
-                                 "FuelName": "",
-                                 "End time": 0} for _ in range(len(self.parser.columns))]
-
-            for Operation in file_data:
-                if "Доза установлена" in Operation['ACTION']:
-                    actionData = Operation['ACTION'].split(';')
-                    ColumnIdx = -1
-                    for data in actionData:
-                        if "ТРК: " in data:
-                            ColumnIdx = int(data[data.find(':') + 1:]) - 1
-                        elif "Прод.: " in data:
-                            Fuel = data[data.find('Прод.: ') + len("Прод.: "):]
-                            Column_operation[ColumnIdx]["FuelName"] = Fuel
-                            break
-                elif "Установка дозы" in Operation['ACTION']:
-                    actionData = Operation['ACTION'].split(';')
-                    ColumnIdx = -1
-                    for data in actionData:
-                        if "ТРК : " in data:
-                            ColumnIdx = int(data[data.find(':') + 1:]) - 1
-                        elif "Рукав: " in data:
-                            Fuel = int(data[data.find('Рукав:') + len("Рукав:"):])
-                            Column_operation[ColumnIdx]["Fuel"] = Fuel
-                            if Column_operation[ColumnIdx]["FuelName"]:
-                                hose_into_fuel[ColumnIdx][Fuel] = Column_operation[ColumnIdx]["FuelName"]
-                        elif "Счетчик:" in data:
-                            StartFuelValue = float(str(data[data.find(':') + 1:]).replace(',', '.'))
-                            Column_operation[ColumnIdx]["Start fuel value"] = StartFuelValue
-                elif "На ТРК идет отпуск топлива" in Operation['ACTION']:
-                    actionData = Operation['ACTION'].split(';')
-                    ColumnIdx = -1
-                    for data in actionData:
-                        if "ТРК : " in data:
-                            ColumnIdx = int(data[data.find(':') + 1:]) - 1
-                            break
-                    if Column_operation[ColumnIdx]["Start time"]:
-                        continue
-                    Column_operation[ColumnIdx]["Start time"] = datetime.strptime(Operation['DATETIME'] + "000",
-                                                                                  "%Y%m%dT%H:%M:%S%f")
-                elif "На ТРК закончен отпуск топлива" in Operation['ACTION']:
-                    actionData = Operation['ACTION'].split(';')
-                    ColumnIdx = -1
-                    for data in actionData:
-                        if "ТРК : " in data:
-                            ColumnIdx = int(data[data.find(':') + 1:]) - 1
-                            break
-                    Column_operation[ColumnIdx]["End time"] = datetime.strptime(Operation['DATETIME'] + "000",
-                                                                                "%Y%m%dT%H:%M:%S%f")
-                elif "Конец транзакции" in Operation['ACTION']:
-                    actionData = Operation['ACTION'].split(';')
-                    ColumnIdx = -1
-                    for data in actionData:
-                        if "ТРК : " in data:
-                            ColumnIdx = int(data[data.find(':') + 1:]) - 1
-                        if "Счетчик:" in data:
-                            txt = str(data[data.find(':') + 1:]).replace(',', '.').strip()
-                            if txt == "NAN":
-                                Column_operation[ColumnIdx] = {"Start fuel value": 0.0, "End fuel value": 0.0,
-                                                               "Start time": 0, "Fuel": -1, "FuelName": "",
-                                                               "End time": 0}
-                                continue
-                            EndFuelValue = float(txt)
-                            Column_operation[ColumnIdx]["End fuel value"] = EndFuelValue
-                    dTime = Column_operation[ColumnIdx]["End time"] - Column_operation[ColumnIdx]["Start time"]
-                    if dTime:
-                        dTime = dTime.total_seconds() / 60
-                        dFuel = Column_operation[ColumnIdx]["End fuel value"] - Column_operation[ColumnIdx][
-                            "Start fuel value"]
-                        if dFuel < 0:
-                            dFuel = 1000000 - Column_operation[ColumnIdx]["Start fuel value"] + \
-                                    Column_operation[ColumnIdx]["End fuel value"]
-                        Speed = dFuel / dTime
-                        DATE = Column_operation[ColumnIdx]["End time"].date()
-                        if DATE not in loadedDates:
-                            loadedDates.append(DATE)
-                        if Speed < 0 or Speed > 150:
-                            print("???????????????????", DATE)
-                        FuelName = Column_operation[ColumnIdx]["FuelName"]
-                        # if not DATE in self.Graph:
-                        #     self.Graph[DATE] = []
-                        #     for i in range(len(self.parser.columns)):
-                        #         self.Graph[DATE].append(dict(zip([fuel for fuel in self.parser.fuels],
-                        #                                   [{"time": 0, "fuel": 0} for _ in
-                        #                                    range(len(self.parser.fuels))])))
-                        # self.Graph[DATE][ColumnIdx][FuelName]["fuel"] += dFuel
-                        # self.Graph[DATE][ColumnIdx][FuelName]["time"] += dTime
-                        if not DATE in self.Graph:
-                            self.Graph[DATE] = []
-                            for i in range(len(self.parser.columns)):
-                                self.Graph[DATE].append(dict(zip([fuel for fuel in self.parser.fuels],
-                                                                 [{"time": [], "fuel": []} for _ in
-                                                                  range(len(self.parser.fuels))])))
-                        self.Graph[DATE][ColumnIdx][FuelName]["fuel"].append(dFuel)
-                        self.Graph[DATE][ColumnIdx][FuelName]["time"].append(
-                            (Column_operation[ColumnIdx]["Start time"], Column_operation[ColumnIdx]["End time"]))
-
-                    Column_operation[ColumnIdx] = {"Start fuel value": 0.0, "End fuel value": 0.0, "Start time": 0,
-                                                   "Fuel": -1, "FuelName": "", "End time": 0}
-                elif "Топливный заказ перемещен" in Operation['ACTION']:
-                    # Тр: 3078491;
-                    # Топливный заказ перемещен с ТРК: 8 на ТРК: 7
-                    FROM, TO = Operation['ACTION'][Operation['ACTION'].find("ТРК:") + len("ТРК:"):].split("на ТРК:")
-                    Column_operation[int(TO) - 1]["FuelName"] = Column_operation[int(FROM) - 1]["FuelName"]
-                    Column_operation[int(FROM) - 1] = {"Start fuel value": 0.0, "End fuel value": 0.0, "Start time": 0,
-                                                       "Fuel": -1, "FuelName": "", "End time": 0}
-        self.validDateUpdate(loadedDates)
+        """Пересчитывает транзакции, детектор и агрегаты в фоне; окно обновляется в on_graph_data"""
+        snapshot = self.snapshot()
+        imported = self.imported
+        self.live_job = None
+        self.rebuild_job = self.rebuild_worker.submit(
+            lambda is_cancelled: build_graph_data(snapshot, imported, is_cancelled))
+
+    def apply_graph_data(self, data):
+        for stage, seconds in data['timings'].items():
+            self.metrics.add_time(stage, seconds)
+        self.engine_metrics = data['metrics']
+        self.transactions = data['transactions']
+        self.index = data['index']
+        self.alerts = data['alerts']
+        self.rollups = data['rollups']
+        self.imported_used = data['imported']
+        self.show_alerts()
+
+    def on_graph_data(self, job, data):
+        if job == self.live_job:
+            self.live_job = None
+            self.apply_graph_data(data)
+            self.extendDateRange(self.transactions.dates())
+            self.draw_graph()
+            return
+        if job != self.rebuild_job:
+            return  # Устаревший пересчет
+        self.rebuild_job = None
+        self.graph_state = data
+        self.apply_graph_data(data)
+        outlier_dates = self.transactions.outlier_dates()
+        if outlier_dates:
+            self.log_message("Скорость вне диапазона в даты: " + ", ".join(str(DATE) for DATE in outlier_dates))
+        if self.report_metrics:
+            self.report_metrics = False
+            for line in self.collect_metrics().summary():
+                self.log_message(line)
+        if self.manifest is not None and self.manifest.date_range() is not None:
+            # Диапазон дат задан оглавлением (и расширяется загруженными результатами), выбор пользователя не сбрасываем
+            self.extendDateRange(self.transactions.dates())
+            self.draw_graph()
+        else:
+            self.validDateUpdate(self.transactions.dates())
+
+    def on_graph_failed(self, job, error):
+        if job == self.live_job:
+            # Состояние движка могло остаться на середине порции — следующие события пересчитают все заново
+            self.live_job = self.graph_state = None
+        elif job == self.rebuild_job:
+            self.rebuild_job = None
+        elif job != self.plot_job:
+            return
+        self.log_message(f"Ошибка при подготовке графика: {error}")
+
+    def show_alerts(self):
+        """Заполняет список подозрений на засор, от самого сильного падения скорости"""
+        alerts = self.alerts
+        self.alerts_list.clear()
+        for alert in alerts:
+            self.alerts_list.addItem(f"АЗС {alert['station']}, ТРК {alert['trk']}, {alert['fuel']}: "
+                                     f"-{alert['drop']:.0%} с {alert['decline_start']} "
+                                     f"({alert['baseline_flow']:.1f} → {alert['current_flow']:.1f} л/мин)")
+            self.alerts_list.item(self.alerts_list.count() - 1).setData(
+                Qt.UserRole, (alert['station'], alert['trk'], alert['fuel']))
+        if alerts:
+            self.log_message(f"Подозрений на засор: {len(alerts)}")
+
+    def select_alert(self, item):
+        """Показывает ряд выбранного подозрения на засор"""
+        station, trk, fuel = item.data(Qt.UserRole)
+        self.gas_station.setCurrentText(station)
+        self.fuel_column_combo.setCurrentText(str(trk))
+        self.fuel_type_combo.setCurrentText(fuel)
 
     def draw_graph(self):
-        if not self.Graph:
+        """Готовит данные выбранного ряда в фоне; график обновляется в plot_selection"""
+        key = (self.gas_station.currentText(), int(self.fuel_column_combo.currentText() or 0),
+               self.fuel_type_combo.currentText())
+        start, end = self.selected_range()
+        chart, buckets = self.chart, self.chart.width()
+        mode = COMPARE_MODES[self.compare_combo.currentIndex()][1]
+        if mode is not None:
+            self.draw_comparison(mode, key, start, end)
+            return
+        if self.history_mode():
+            history = self.history
+
+            def history_job(is_cancelled):
+                started = time.perf_counter()
+                return prepare_history_plot(history, chart, key, start, end, buckets), time.perf_counter() - started
+
+            self.plot_job = self.plot_worker.submit(history_job)
+            return
+        if self.rebuild_job is not None:
+            return  # График нарисуется, когда будут готовы транзакции
+        if getattr(self, 'index', None) is None or not self.index.series:
             self.log_message(f"Не удалось получить данные для построения графика")
             return
-        X = []
-        Y = []
-        dX = []
-        self.figure.clear()
-        self.ax = self.figure.add_subplot(111)
 
-        start_date = self.start_date.date().toPyDate()
-        end_date = self.end_date.date().toPyDate()
-        self.Graph = dict(sorted(self.Graph.items()))
-        k = 0
-        dSpeed = 0
-        cnt = 0
-        for x, columns in self.Graph.items():
-            if x < start_date or x > end_date:
-                continue
-            fuel = columns[int(self.fuel_column_combo.currentText()) - 1][self.fuel_type_combo.currentText()]["fuel"]
-            time = columns[int(self.fuel_column_combo.currentText()) - 1][self.fuel_type_combo.currentText()]["time"]
-            if time:
-                for _ in range(len(fuel)):
-                    if time[_][1] - time[_][0]:
-                        dt = ((time[_][1] - time[_][0]).total_seconds() / 60)
-                        meanSpeed = fuel[_] / dt
-                        dSpeed += meanSpeed
-                        cnt += 1
-                        Y.append(meanSpeed)
-                        X.append(time[_][0])
-                        dX.append(timedelta(minutes=dt))
-        dSpeed /= cnt
-        self.ax.bar(X, Y, dX, color="blue")
-        self.ax.axhline(dSpeed, color="red")
-        self.ax.set_ylim(0, 100)
-        self.ax.margins(0.05)
-        self.ax.set_xlabel("Дата")
-        self.ax.set_ylabel("Скорость")
-        self.ax.xaxis.set_major_formatter(plt.matplotlib.dates.DateFormatter('%Y-%m-%d'))
-        plt.xticks(rotation=45)
-        self.figure.tight_layout()
-        self.canvas.draw()
+        index, rollups = self.index, self.rollups
+
+        def job(is_cancelled):
+            started = time.perf_counter()
+            return prepare_plot(index, rollups, chart, key, start, end, buckets), time.perf_counter() - started
+
+        self.plot_job = self.plot_worker.submit(job)
+
+    def draw_comparison(self, mode, key, start, end):
+        """Готовит в фоне линии рядов, сравниваемых с key; не больше COMPARE_SERIES"""
+        if self.history_mode():
+            history = self.history
+            keys = compare_keys(history.series(), mode, key)
+
+            def grid(keys, start, end, buckets):
+                return history_grid(history, keys, start, end, buckets)
+        else:
+            if self.rebuild_job is not None:
+                return  # График нарисуется, когда будут готовы транзакции
+            if getattr(self, 'index', None) is None or not self.index.series:
+                self.log_message(f"Не удалось получить данные для построения графика")
+                return
+            keys = compare_keys(self.index.keys(), mode, key)
+            grid = self.index.grid
+        if len(keys) > COMPARE_SERIES:
+            self.log_message(f"Рядов для сравнения: {len(keys)}, показаны первые {COMPARE_SERIES}")
+            keys = keys[:COMPARE_SERIES]
+        chart, buckets = self.chart, max(1, self.chart.width() // COMPARE_PIXELS)
+
+        def job(is_cancelled):
+            started = time.perf_counter()
+            return prepare_comparison(grid, chart, keys, start, end, buckets), time.perf_counter() - started
+
+        self.plot_job = self.plot_worker.submit(job)
+
+    def plot_selection(self, job, result):
+        if job != self.plot_job:
+            return  # Данные устаревшего выбора
+        prepared, seconds = result
+        self.metrics.add_time('prepare_plot', seconds)
+        with self.metrics.stage('draw'):
+            self.chart.show(prepared)
+        if prepared is None:
+            self.log_message("Нет данных за выбранный период")
 
         # if X and Y:
         #     self.ax.plot(X, Y)
@@ -425,6 +897,9 @@ class MainWindow(QMainWindow):
         )
 
         if reply == QMessageBox.Yes:
+            self.stop_live()
+            self.rebuild_worker.stop()
+            self.plot_worker.stop()
             event.accept()
         else:
             event.ignore()
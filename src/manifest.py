@@ -0,0 +1,236 @@
+import codecs
+import hashlib
+import html
+import json
+import os
+import re
+import tempfile
+
+from src.cache import default_cache_dir
+from src.events import parse_timestamp, to_datetime
+from src.files import is_compressed, open_bbox, source_stat
+from src.metrics import Metrics
+from src.parser import station_of
+
+BLOCK_BYTES = 1 << 14  # Сколько читать с начала и с конца файла
+ENCODING_RE = re.compile(rb'<\?xml[^>]*?encoding[ \t\r\n]*=[ \t\r\n]*["\']([A-Za-z][-\w.]*)["\']')
+HOST_RE = re.compile(rb'HOST[ \t\r\n]*=[ \t\r\n]*"([^"]*)"')
+DATETIME_RE = re.compile(rb'DATETIME[ \t\r\n]*=[ \t\r\n]*"([^"]*)"')
+ROW_RE = re.compile(rb'<ROW[ \t\r\n/>]')  # Строка ROW, но не корень ROWDATA
+
+
+def _timestamps(block):
+    timestamps = []
+    for raw in DATETIME_RE.findall(block):
+        try:
+            timestamps.append(parse_timestamp(raw.decode('ascii')))
+        except (UnicodeDecodeError, ValueError):
+            continue  # Значение, разрезанное границей блока, или испорченная строка
+    return timestamps
+
+
+def _read_compressed(file_path, block):
+    """Начало, конец и точное число строк сжатого файла: к концу можно прийти только распаковкой"""
+    rows = 0
+    with open_bbox(file_path) as f:
+        head = f.read(block)
+        tail = head
+        while chunk := f.read(1 << 20):
+            # Соединяем с хвостом прошлой порции, чтобы не потерять строку на границе
+            rows += len(ROW_RE.findall(tail[-4:] + chunk))
+            tail = (tail + chunk)[-block:]
+    return head, tail, rows + len(ROW_RE.findall(head))
+
+
+def scan_file(file_path, block=BLOCK_BYTES):
+    """Запись оглавления по первым и последним block байтам файла без разбора XML.
+
+    Станции — из HOST в этих блоках, first/last — первое и последнее время
+    (микросекунды от 1970-01-01, None — не найдено), rows — число строк ROW,
+    для больших файлов оценка по плотности строк в начале (exact = False).
+    Сжатый файл распаковывается потоком, и число строк в нем точное.
+    size и mtime_ns — файла на диске (для файла внутри .zip — архива).
+    """
+    stat = source_stat(file_path)
+    rows = None
+    if is_compressed(file_path):
+        head, tail, rows = _read_compressed(file_path, block)
+    else:
+        with open(file_path, 'rb') as f:
+            if stat.st_size <= 2 * block:
+                head = tail = f.read()
+            else:
+                head = f.read(block)
+                f.seek(-block, os.SEEK_END)
+                tail = f.read()
+    exact = head is tail or rows is not None
+    match = ENCODING_RE.search(head, 0, 200)
+    encoding = 'utf-8'
+    if match is not None:
+        try:
+            encoding = codecs.lookup(match.group(1).decode('ascii')).name
+        except LookupError:
+            pass
+    hosts = dict.fromkeys(HOST_RE.findall(head) + ([] if head is tail else HOST_RE.findall(tail)))
+    stations = []
+    for raw in hosts:
+        station = station_of(html.unescape(raw.decode(encoding, 'replace')))
+        if station not in stations:
+            stations.append(station)
+    first = _timestamps(head)
+    last = first if head is tail else _timestamps(tail)
+    if rows is None:
+        rows = len(ROW_RE.findall(head))
+        if not exact and rows:
+            rows = round(rows * stat.st_size / len(head))
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'stations': stations,
+        'first': min(first) if first else None,
+        'last': max(last) if last else None,
+        'rows': rows,
+        'exact': exact,
+    }
+
+
+class Manifest:
+    """Оглавление архива BBOX: для каждого файла станции, время первой и последней строки, размер и число строк.
+
+    Записи строятся по началу и концу файла (scan_file) и хранятся между
+    сеансами в JSON-файле path; запись файла с другим размером или временем
+    изменения строится заново. По оглавлению select выбирает файлы,
+    пересекающиеся с фильтром, и их соседей по времени, чтобы не разбирать
+    весь архив. После разбора файла record уточняет станции и число строк.
+    Сбои чтения, записи и просмотра файлов не прерывают работу и копятся в
+    metrics.warnings.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path  # None — оглавление не сохраняется
+        self.entries = dict()  # Путь файла -> запись scan_file
+        self.metrics = Metrics()
+        if path is not None:
+            self.load()
+
+    @classmethod
+    def for_directory(cls, directory, cache_dir=None):
+        """Оглавление каталога архива; хранится в кэше пользователя под хэшем пути каталога"""
+        name = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest() + '.json'
+        return cls(os.path.join(cache_dir or default_cache_dir('manifest'), name))
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored.get('version') == self.VERSION:
+                self.entries = stored['files']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.metrics.warn('manifest_errors', self.path, f"оглавление не читается: {str(e)}")
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.VERSION, 'files': self.entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.metrics.warn('manifest_errors', self.path, f"не удалось сохранить оглавление: {str(e)}")
+
+    def refresh(self, found_files, is_cancelled=lambda: False):
+        """Приводит оглавление к списку found_files; возвращает число заново просмотренных файлов"""
+        entries = dict()
+        scanned = 0
+        for file_path in found_files:
+            if is_cancelled():
+                break
+            entry = self.entries.get(file_path)
+            try:
+                stat = source_stat(file_path)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                    entry = scan_file(file_path)
+                    scanned += 1
+            except Exception as e:  # Недоступный файл или испорченный архив — файл будет выбираться всегда
+                self.metrics.warn('manifest_errors', file_path, f"не удалось просмотреть файл: {str(e)}")
+                continue
+            entries[file_path] = entry
+        if not is_cancelled():
+            self.entries = entries
+        else:
+            self.entries.update(entries)
+        return scanned
+
+    def record(self, file_path, partial):
+        """Уточняет запись по результату полного разбора файла"""
+        entry = self.entries.get(file_path)
+        try:
+            stat = source_stat(file_path)
+        except OSError:
+            return
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = scan_file(file_path)
+        # Новая запись вместо изменения старой: оглавление читается из окна, пока поток разбора его обновляет
+        entry = dict(entry, stations=list(partial.gas_stations), exact=True)
+        if 'rows' in partial.metrics.counters:
+            entry['rows'] = partial.metrics.counters['rows']
+        self.entries[file_path] = entry
+
+    def stations(self):
+        stations = set()
+        for entry in self.entries.values():
+            stations.update(entry['stations'])
+        return sorted(stations)
+
+    def date_range(self):
+        """(первая дата, последняя дата) по всем файлам или None"""
+        firsts = [entry['first'] for entry in self.entries.values() if entry['first'] is not None]
+        lasts = [entry['last'] for entry in self.entries.values() if entry['last'] is not None]
+        if not firsts or not lasts:
+            return None
+        return to_datetime(min(firsts)).date(), to_datetime(max(lasts)).date()
+
+    def select(self, found_files, station=None, start=None, end=None):
+        """Файлы found_files, которые могут содержать данные станции station за [start, end).
+
+        Файлы без записи, без найденных станций или времени выбираются всегда.
+        К каждому выбранному файлу добавляются предыдущий и следующий по
+        времени файлы той же станции: транзакция на границе диапазона может
+        начаться или закончиться в соседнем файле.
+        """
+        matched = set()
+        for file_path in found_files:
+            entry = self.entries.get(file_path)
+            if entry is not None:
+                if station is not None and entry['stations'] and station not in entry['stations']:
+                    continue
+                if start is not None and entry['last'] is not None and entry['last'] < start:
+                    continue
+                if end is not None and entry['first'] is not None and entry['first'] >= end:
+                    continue
+            matched.add(file_path)
+        neighbours = set()
+        for files in self._by_station(found_files, station).values():
+            for position, file_path in enumerate(files):
+                if file_path in matched:
+                    neighbours.update(files[max(position - 1, 0):position + 2])
+        return [file_path for file_path in found_files if file_path in matched or file_path in neighbours]
+
+    def _by_station(self, found_files, station=None):
+        """Файлы с известным временем по станциям (только station, если задана) в порядке времени"""
+        by_station = dict()
+        for file_path in found_files:
+            entry = self.entries.get(file_path)
+            if entry is None or entry['first'] is None or entry['last'] is None:
+                continue
+            for name in entry['stations']:
+                if station is None or name == station:
+                    by_station.setdefault(name, []).append(file_path)
+        for files in by_station.values():
+            files.sort(key=lambda file_path: (self.entries[file_path]['first'], self.entries[file_path]['last']))
+        return by_station
@@ -0,0 +1,167 @@
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Причины, по которым завершенная в логе транзакция не попадает в расчет скорости
+DROP_REASONS = {
+    'dropped_nan': "счетчик NAN",
+    'dropped_zero_duration': "нулевая длительность",
+    'dropped_incomplete': "нет начала или конца отпуска",
+    'dropped_moved': "заказ перемещен на другую ТРК",
+}
+# Сбои, после которых обработка продолжается: файл разбирается без кэша, архив пропускается,
+# выпадающие списки окна остаются прежними
+WARNINGS = {
+    'cache_errors': "кэш разбора",
+    'manifest_errors': "оглавление",
+    'archive_errors': "архивы",
+    'window_errors': "окно",
+}
+
+
+class Metrics:
+    """Время этапов и счетчики обработки.
+
+    stages — этап -> [секунд всего, вызовов, секунд в последнем вызове];
+    counters — общие счетчики (файлы, байты, строки, транзакции);
+    events — число событий каждого вида EventKind; stations — те же счетчики
+    по АЗС, чтобы видеть, какие станции пишут негодные данные; errors —
+    файлы, которые не удалось разобрать, warnings — сбои кэша, оглавления и
+    архивов, после которых обработка продолжается. Метрики
+    частичных парсеров из процессов-разборщиков сливаются через merge.
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.counters = dict()
+        self.events = dict()
+        self.stations = dict()
+        self.errors = []  # (файл, текст ошибки)
+        self.warnings = []  # (файл, текст предупреждения)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds, calls=1):
+        stage = self.stages.setdefault(name, [0.0, 0, 0.0])
+        stage[0] += seconds
+        stage[1] += calls
+        stage[2] = seconds
+
+    def count(self, name, value=1, station=None):
+        self.counters[name] = self.counters.get(name, 0) + value
+        if station is not None:
+            counters = self.stations.setdefault(station, dict())
+            counters[name] = counters.get(name, 0) + value
+
+    def count_events(self, events):
+        for event in events:
+            name = event.kind.name
+            self.events[name] = self.events.get(name, 0) + 1
+
+    def fail(self, file_path, error):
+        self.count('files_failed')
+        self.errors.append((file_path, str(error)))
+
+    def warn(self, name, file_path, error):
+        """Сбой вида name из WARNINGS, после которого обработка продолжается"""
+        self.count(name)
+        self.warnings.append((file_path, str(error)))
+
+    def set_transactions(self, transactions):
+        """Число транзакций и скоростей вне диапазона — по снимку, а не накопительно"""
+        self.counters['transactions'] = len(transactions)
+        self.counters['out_of_range'] = int(transactions.outlier.sum())
+        total = np.bincount(transactions.station, minlength=len(transactions.stations))
+        outliers = np.bincount(transactions.station[transactions.outlier], minlength=len(transactions.stations))
+        for code, station in enumerate(transactions.stations):
+            counters = self.stations.setdefault(station, dict())
+            counters['transactions'] = int(total[code])
+            counters['out_of_range'] = int(outliers[code])
+
+    def merge(self, other):
+        for name, (seconds, calls, last) in other.stages.items():
+            self.add_time(name, seconds, calls)
+            self.stages[name][2] = last
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for name, value in other.events.items():
+            self.events[name] = self.events.get(name, 0) + value
+        for station, counters in other.stations.items():
+            own = self.stations.setdefault(station, dict())
+            for name, value in counters.items():
+                own[name] = own.get(name, 0) + value
+        self.errors.extend(other.errors)
+        self.warnings.extend(other.warnings)
+
+    def as_dict(self):
+        return {
+            'stages': {name: {'seconds': round(seconds, 6), 'calls': calls, 'last': round(last, 6)}
+                       for name, (seconds, calls, last) in self.stages.items()},
+            'counters': dict(self.counters),
+            'events': dict(self.events),
+            'stations': {station: dict(counters) for station, counters in self.stations.items()},
+            'errors': [{'file': file_path, 'error': error} for file_path, error in self.errors],
+            'warnings': [{'file': file_path, 'error': error} for file_path, error in self.warnings],
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        """Метрики из as_dict (например, сохраненные в частичном результате другого узла)"""
+        metrics = cls()
+        for name, stage in values.get('stages', dict()).items():
+            metrics.stages[name] = [stage['seconds'], stage['calls'], stage['last']]
+        metrics.counters = dict(values.get('counters', dict()))
+        metrics.events = dict(values.get('events', dict()))
+        metrics.stations = {station: dict(counters) for station, counters in values.get('stations', dict()).items()}
+        metrics.errors = [(error['file'], error['error']) for error in values.get('errors', [])]
+        metrics.warnings = [(warning['file'], warning['error']) for warning in values.get('warnings', [])]
+        return metrics
+
+    def to_json(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(), f, ensure_ascii=False, indent=2)
+
+    def summary(self):
+        """Строки для консоли окна и stderr отчета"""
+        counters = self.counters
+        lines = [f"Этап {name}: {seconds * 1000:.1f} мс" + (f" ({calls} раз)" if calls > 1 else "")
+                 for name, (seconds, calls, _) in self.stages.items()]
+        if 'files' in counters or 'files_failed' in counters:
+            lines.append(f"Файлов: {counters.get('files', 0)}, из кэша: {counters.get('files_cached', 0)}, "
+                         f"с ошибками: {counters.get('files_failed', 0)}, "
+                         f"пропущено по оглавлению: {counters.get('files_skipped', 0)}; "
+                         f"{counters.get('bytes', 0) / 1e6:.1f} МБ, строк: {counters.get('rows', 0)}")
+        if counters.get('compressed_files'):
+            lines.append(f"Из архивов: файлов {counters['compressed_files']}, "
+                         f"{counters.get('compressed_bytes', 0) / 1e6:.1f} МБ в сжатом виде")
+        if counters.get('partials'):
+            lines.append(f"Частичных результатов: {counters['partials']}, "
+                         f"повторяющихся файлов: {counters.get('files_duplicated', 0)}")
+        if self.warnings:
+            lines.append(f"Предупреждений: {len(self.warnings)} — " +
+                         ", ".join(f"{text} {counters[name]}" for name, text in WARNINGS.items() if counters.get(name)))
+        if 'history_added' in counters:
+            lines.append(f"В историю добавлено транзакций: {counters['history_added']}")
+        if self.events:
+            lines.append("События: " + ", ".join(f"{name} {value}" for name, value in sorted(self.events.items())))
+        if 'transactions' in counters:
+            dropped = ", ".join(f"{text} — {counters[name]}" for name, text in DROP_REASONS.items()
+                                if counters.get(name))
+            lines.append(f"Транзакций: {counters['transactions']}, скорость вне диапазона: "
+                         f"{counters.get('out_of_range', 0)}; отброшено: {dropped or 'нет'}")
+        for station, station_counters in sorted(self.stations.items()):
+            problems = [f"{text} — {station_counters[name]}" for name, text in DROP_REASONS.items()
+                        if station_counters.get(name)]
+            if station_counters.get('out_of_range'):
+                problems.append(f"скорость вне диапазона — {station_counters['out_of_range']}")
+            if problems:
+                lines.append(f"АЗС {station}: " + ", ".join(problems))
+        return lines
@@ -1,76 +1,219 @@
+import sys
 import xml.etree.ElementTree as ET
 
+from src.events import decode_event
+from src.files import bbox_sizes, is_compressed, open_bbox
+from src.metrics import Metrics
+from src.scan import ByteScanner, ScanFallback
+
+# Режимы разбора: 'tree' — весь XML в памяти (ET.parse),
+# 'stream' — потоковый разбор (ET.iterparse) с постоянным расходом памяти,
+# 'scan' — поиск нужных строк в сырых байтах (src.scan), при необычной разметке — как 'stream'
+PARSE_MODES = ('tree', 'stream', 'scan')
+# Версия формата результата разбора; увеличивается при любом изменении, влияющем на data/GlobalDict,
+# чтобы старые записи кэша разбора перестали находиться
+PARSER_VERSION = 3
+
+
+def station_of(host):
+    """Номер АЗС по HOST вида «АЗС001 - SRV01»"""
+    return sys.intern(host[:host.find('-')].strip())
+
 
 class BBOXParser:
-    def __init__(self):
+    def __init__(self, mode='tree'):
+        if mode not in PARSE_MODES:
+            raise ValueError(f"Неизвестный режим разбора: {mode}")
+        self.mode = mode
+        self.files = []  # Пути файлов, соответствующие элементам data
         self.data = []
         self.fuels = []
         self.columns = []
         self.gas_stations = []
         self.GlobalDict = dict()
+        self.metrics = Metrics()
+        self._hosts = dict()  # HOST -> станция; станции уже есть в gas_stations и GlobalDict
 
     def parse_file(self, file_path):
         try:
-            tree = ET.parse(file_path)
-            root = tree.getroot()
+            with self.metrics.stage('parse_file'):
+                if self.mode == 'scan':
+                    file_data = self.scan_rows(file_path)
+                elif self.mode == 'stream':
+                    file_data = list(self.iter_rows(file_path))
+                else:
+                    with open_bbox(file_path) as f:
+                        tree = ET.parse(f)
+                    root = tree.getroot()
 
-            file_data = []
-
-            # Здесь будет логика парсинга XML файла
-            for element in root.iter():
-                if element.tag == "ROW":
-                    if (station := element.attrib['HOST'][
-                        :element.attrib['HOST'].find('-')].strip()) not in self.gas_stations:
-                        self.gas_stations.append(station)
-                        if station not in self.GlobalDict:
-                            self.GlobalDict[station] = dict()  # Добавляем словарь станций
-                    if element.attrib['ACTION'].startswith('ТРК : '):
-                        action = element.attrib['ACTION']
-                        TRK_number = action[action.find("ТРК : ") + len("ТРК : "):action.find(";")].strip()
-                        if TRK_number not in self.GlobalDict[station]:
-                            self.GlobalDict[station][TRK_number] = list()  # Добавляем массив топлива
-                        file_data.append(
-                            {'DATETIME': element.attrib['DATETIME'], 'ACTION': element.attrib['ACTION']}
-                        )
-                    elif element.attrib['ACTION'].startswith('Тр: ') and "Топливный заказ перемещен" in element.attrib[
-                        'ACTION']:
-                        file_data.append(
-                            {'DATETIME': element.attrib['DATETIME'], 'ACTION': element.attrib['ACTION']}
-                        )
-                    elif element.attrib['ACTION'].startswith('Тр: ') and "Доза установлена" in element.attrib['ACTION']:
-                        action = element.attrib['ACTION']
-                        TRK_number = action[action.find("ТРК: ") + len("ТРК: "):]
-                        TRK_number = TRK_number[:TRK_number.find(";")].strip()
-                        FuelName = action[action.find("Прод.:") + len("Прод.:"):]
-                        FuelName = FuelName[:FuelName.find(';')].strip()
-                        if FuelName not in self.GlobalDict[station][TRK_number]:
-                            self.GlobalDict[station][TRK_number].append(FuelName)
-                        file_data.append(
-                            {'DATETIME': element.attrib['DATETIME'], 'ACTION': element.attrib['ACTION']}
-                        )
-                    elif (element.attrib['ACTION'].startswith('Тр: ') and
-                          "Налив зафиксирован" in element.attrib['ACTION']):
-                        action = element.attrib['ACTION']
-                        TRK_number = action[action.find("ТРК: ") + len("ТРК: "):]
-                        TRK_number = TRK_number[:TRK_number.find(";")].strip()
-                        FuelName = action[action.find("Прод.:") + len("Прод.:"):]
-                        FuelName = FuelName[:FuelName.find(';')].strip()
-                        if FuelName not in self.GlobalDict[station][TRK_number]:
-                            self.GlobalDict[station][TRK_number].append(FuelName)
-                        dataStartIdx = element.attrib['ACTION'].find('(')
-                        dataArr = element.attrib['ACTION'][dataStartIdx + 1:-1].split(';')
-                        for data in dataArr:
-                            if "Прод.:" in data:
-                                FuelName = data[data.find(':') + 1:].strip()
-                                if FuelName not in self.fuels:
-                                    self.fuels.append(FuelName)
-                            elif "ТРК: " in data:
-                                ColumnNum = int(data[data.find(':') + 1:])
-                                if ColumnNum not in self.columns:
-                                    self.columns.append(ColumnNum)
+                    file_data = []
+                    rows = 0
+                    for element in root.iter():
+                        if element.tag == "ROW":
+                            rows += 1
+                            row = self.parse_row(element.attrib)
+                            if row is not None:
+                                file_data.append(row)
+                    self.metrics.count('rows', rows)
 
+            self.files.append(file_path)
             self.data.append(file_data)
+            self.metrics.count('files')
+            size, stored = bbox_sizes(file_path)
+            self.metrics.count('bytes', size)
+            if is_compressed(file_path):
+                self.metrics.count('compressed_files')
+                self.metrics.count('compressed_bytes', stored)
+            self.metrics.count_events(file_data)
             return True
         except Exception as e:
-            print(f"Error parsing file {file_path}: {str(e)}")
+            self.metrics.fail(file_path, e)
             return False
+
+    def merge(self, other):
+        """Добавляет результат другого парсера (например, разбора одного файла в отдельном процессе)"""
+        self.merge_lists(other)
+        self.metrics.merge(other.metrics)
+        self.files.extend(other.files)
+        self.data.extend(other.data)
+
+    def merge_tail(self, other):
+        """Как merge, но события дописываются к уже загруженному файлу с тем же путем (онлайн-режим)"""
+        self.merge_lists(other)
+        self.metrics.merge(other.metrics)
+        for file_path, file_data in zip(other.files, other.data):
+            if file_path in self.files:
+                self.data[self.files.index(file_path)].extend(file_data)
+            else:
+                # Копия: дочитанная порция может попасть и в другой парсер, а этот список будет расти
+                self.files.append(file_path)
+                self.data.append(list(file_data))
+
+    def reset_file(self, file_path):
+        """Отбрасывает события файла (онлайн-режим: файл заменен или обрезан и будет прочитан заново)"""
+        if file_path in self.files:
+            # Новый список, а не очистка старого: старый может читать фоновый пересчет
+            self.data[self.files.index(file_path)] = []
+
+    def merge_lists(self, other):
+        for station in other.gas_stations:
+            if station not in self.gas_stations:
+                self.gas_stations.append(station)
+        for station, columns in other.GlobalDict.items():
+            StationDict = self.GlobalDict.setdefault(station, dict())
+            for TRK_number, fuels in columns.items():
+                Fuels = StationDict.setdefault(TRK_number, list())
+                for FuelName in fuels:
+                    if FuelName not in Fuels:
+                        Fuels.append(FuelName)
+        for FuelName in other.fuels:
+            if FuelName not in self.fuels:
+                self.fuels.append(FuelName)
+        for ColumnNum in other.columns:
+            if ColumnNum not in self.columns:
+                self.columns.append(ColumnNum)
+
+    def scan_rows(self, file_path):
+        """Быстрый разбор: parse_row вызывается только для строк с нужными действиями"""
+        try:
+            scanner = ByteScanner(file_path)
+        except ScanFallback:
+            self.metrics.count('scan_fallbacks')
+            return list(self.iter_rows(file_path))
+        with scanner:
+            # Станция регистрируется по любой строке, в том числе пропускаемой
+            for host in scanner.hosts():
+                self.add_station(host)
+            file_data = []
+            for attrib in scanner.candidates():
+                row = self.parse_row(attrib)
+                if row is not None:
+                    file_data.append(row)
+            self.metrics.count('rows', scanner.rows)
+        return file_data
+
+    def iter_rows(self, file_path):
+        """Потоковый разбор файла: каждый ROW обрабатывается при закрытии и сразу освобождается"""
+        with open_bbox(file_path) as f:
+            yield from self.handle_xml_events(ET.iterparse(f, events=('start', 'end')), [])
+
+    def handle_xml_events(self, xml_events, parents):
+        """Обрабатывает события start/end от iterparse или XMLPullParser.
+
+        parents — стек открытых элементов; его можно передавать между вызовами,
+        если документ поступает частями.
+        """
+        rows = 0
+        try:
+            for event, element in xml_events:
+                if event == 'start':
+                    parents.append(element)
+                    continue
+                parents.pop()
+                if element.tag == "ROW":
+                    rows += 1
+                    row = self.parse_row(element.attrib)
+                    if row is not None:
+                        yield row
+                # Освобождаем элемент и отцепляем его от родителя, чтобы дерево не росло
+                element.clear()
+                if parents:
+                    del parents[-1][:]
+        finally:
+            self.metrics.count('rows', rows)
+
+    def add_station(self, host):
+        station = self._hosts.get(host)
+        if station is not None:
+            return station
+        station = station_of(host)
+        if station not in self.gas_stations:
+            self.gas_stations.append(station)
+            if station not in self.GlobalDict:
+                self.GlobalDict[station] = dict()  # Добавляем словарь станций
+        self._hosts[host] = station
+        return station
+
+    def parse_row(self, attrib):
+        """Обновляет списки станций, ТРК и топлива; возвращает Event, если строка нужна для анализа"""
+        station = self.add_station(attrib['HOST'])
+        if attrib['ACTION'].startswith('ТРК : '):
+            action = attrib['ACTION']
+            TRK_number = action[action.find("ТРК : ") + len("ТРК : "):action.find(";")].strip()
+            if TRK_number not in self.GlobalDict[station]:
+                self.GlobalDict[station][TRK_number] = list()  # Добавляем массив топлива
+            return decode_event(station, attrib['DATETIME'], attrib['ACTION'])
+        elif attrib['ACTION'].startswith('Тр: ') and "Топливный заказ перемещен" in attrib['ACTION']:
+            return decode_event(station, attrib['DATETIME'], attrib['ACTION'])
+        elif attrib['ACTION'].startswith('Тр: ') and "Доза установлена" in attrib['ACTION']:
+            action = attrib['ACTION']
+            TRK_number = action[action.find("ТРК: ") + len("ТРК: "):]
+            TRK_number = TRK_number[:TRK_number.find(";")].strip()
+            FuelName = action[action.find("Прод.:") + len("Прод.:"):]
+            FuelName = FuelName[:FuelName.find(';')].strip()
+            # ТРК может впервые встретиться в строке "Тр: " — файл не должен зависеть от предыдущих
+            Fuels = self.GlobalDict[station].setdefault(TRK_number, list())
+            if FuelName not in Fuels:
+                Fuels.append(FuelName)
+            return decode_event(station, attrib['DATETIME'], attrib['ACTION'])
+        elif attrib['ACTION'].startswith('Тр: ') and "Налив зафиксирован" in attrib['ACTION']:
+            action = attrib['ACTION']
+            TRK_number = action[action.find("ТРК: ") + len("ТРК: "):]
+            TRK_number = TRK_number[:TRK_number.find(";")].strip()
+            FuelName = action[action.find("Прод.:") + len("Прод.:"):]
+            FuelName = FuelName[:FuelName.find(';')].strip()
+            Fuels = self.GlobalDict[station].setdefault(TRK_number, list())
+            if FuelName not in Fuels:
+                Fuels.append(FuelName)
+            dataStartIdx = action.find('(')
+            dataArr = action[dataStartIdx + 1:-1].split(';')
+            for data in dataArr:
+                if "Прод.:" in data:
+                    FuelName = data[data.find(':') + 1:].strip()
+                    if FuelName not in self.fuels:
+                        self.fuels.append(FuelName)
+                elif "ТРК: " in data:
+                    ColumnNum = int(data[data.find(':') + 1:])
+                    if ColumnNum not in self.columns:
+                        self.columns.append(ColumnNum)
+        return None
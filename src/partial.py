@@ -0,0 +1,283 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from src.engine import TransactionEngine, Transactions, merge_ranges
+from src.files import bbox_sizes, open_bbox
+from src.metrics import Metrics
+from src.parser import PARSER_VERSION, BBOXParser
+
+# Частичный результат — транзакции и списки АЗС/ТРК/топлива набора файлов, посчитанные на одном узле.
+# Файл .bbp — сжатые массивы NumPy (np.savez_compressed) и JSON-описание в массиве 'meta';
+# pickle не используется, поэтому файл с чужого узла безопасно загружать
+FORMAT = 'bbox-partial'
+VERSION = 1
+SUFFIX = '.bbp'
+HEAD_BYTES = 4096  # Начало файла, по которому узнается тот же лог на другом узле
+COLUMNS = (('station', np.int32), ('trk', np.int32), ('fuel', np.int32), ('start', np.int64), ('end', np.int64),
+           ('liters', np.float64))
+
+
+def file_identity(file_path):
+    """(ключ, байт после распаковки) файла BBOX.
+
+    Ключ — имя файла и хэш первых HEAD_BYTES байт, он не зависит от пути и
+    узла. Текущий лог только растет, поэтому из двух версий одного файла
+    полнее та, что длиннее.
+    """
+    with open_bbox(file_path) as f:
+        head = f.read(HEAD_BYTES)
+    name = os.path.basename(file_path).upper()
+    if name.endswith('.GZ'):
+        name = name[:-3]
+    return hashlib.sha1(name.encode('utf-8') + b'\0' + head).hexdigest(), bbox_sizes(file_path)[0]
+
+
+def _lists(parser):
+    return {'gas_stations': parser.gas_stations, 'GlobalDict': parser.GlobalDict, 'fuels': parser.fuels,
+            'columns': parser.columns}
+
+
+class PartialResult:
+    """Результат обработки набора файлов, который можно перенести на другой узел и слить с другими.
+
+    Для каждого файла хранятся его ключ (file_identity), размер, списки
+    станций, ТРК и топлива, метрики разбора и отрезок [offsets[i],
+    offsets[i + 1]) в столбцах транзакций. Коды station и fuel — номера в
+    отсортированных списках stations и fuels, liters — объем с учетом
+    перехода счетчика. merge сохраняет из одинаковых файлов самую полную
+    версию (_rank) и упорядочивает файлы по ключу, поэтому не зависит ни
+    от порядка, ни от группировки слияний.
+    """
+
+    def __init__(self, files=None, stations=None, fuels=None, offsets=None, columns=None):
+        self.files = files if files is not None else []
+        self.stations = stations if stations is not None else []
+        self.fuels = fuels if fuels is not None else []
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.columns = columns if columns is not None else {name: np.empty(0, dtype=dtype)
+                                                            for name, dtype in COLUMNS}
+
+    @classmethod
+    def from_file(cls, file_path, partial):
+        """Результат одного файла по частичному BBOXParser его разбора"""
+        return cls.from_files([(file_path, partial)])[0]
+
+    @classmethod
+    def from_files(cls, items, context=()):
+        """Результаты файлов [(путь, частичный BBOXParser)] узла, восстановленные вместе.
+
+        События всех файлов идут через один TransactionEngine в порядке
+        merge_ranges, поэтому транзакция на стыке файлов не теряется. Она
+        достается файлу, в котором закончилась, туда же идут и счетчики
+        отброшенных. context — списки событий других файлов (например, уже
+        добавленных в историю), которые нужны только для состояния ТРК.
+        """
+        streams = []
+        owners = []  # Номер файла в items для каждого списка streams, None — context
+        for number, (_, partial) in enumerate(items):
+            streams.extend(partial.data)
+            owners.extend([number] * len(partial.data))
+        for stream in context:
+            streams.append(stream)
+            owners.append(None)
+        engine = TransactionEngine()
+        engine_metrics = [Metrics() for _ in items]
+        context_metrics = Metrics()
+        ended = []  # Номер файла для каждой транзакции engine, -1 — транзакция из context
+        for number, lo, hi in merge_ranges(streams):
+            owner = owners[number]
+            engine.metrics = engine_metrics[owner] if owner is not None else context_metrics
+            done = len(engine)
+            stream = streams[number]
+            engine.feed(stream if lo == 0 and hi == len(stream) else map(stream.__getitem__, range(lo, hi)))
+            ended.extend([-1 if owner is None else owner] * (len(engine) - done))
+        engine.metrics = context_metrics
+        transactions = engine.transactions()
+        ended = np.array(ended, dtype=np.int32)
+        return [cls._single(file_path, partial, transactions.take(np.flatnonzero(ended == number)),
+                            engine_metrics[number])
+                for number, (file_path, partial) in enumerate(items)]
+
+    @classmethod
+    def _single(cls, file_path, partial, transactions, engine_metrics):
+        """Результат одного файла по его транзакциям и счетчикам восстановления"""
+        # Списки результата — только АЗС и топливо его транзакций, в порядке сортировки
+        station_used = np.unique(transactions.station)
+        fuel_used = np.unique(transactions.fuel)
+        stations = sorted(transactions.stations[code] for code in station_used)
+        fuels = sorted(transactions.fuels[code] for code in fuel_used)
+        station_codes = np.zeros(len(transactions.stations) or 1, dtype=np.int32)
+        station_codes[station_used] = [stations.index(transactions.stations[code]) for code in station_used]
+        fuel_codes = np.zeros(len(transactions.fuels) or 1, dtype=np.int32)
+        fuel_codes[fuel_used] = [fuels.index(transactions.fuels[code]) for code in fuel_used]
+        transactions = Transactions(stations, fuels, station_codes[transactions.station], transactions.trk,
+                                    fuel_codes[transactions.fuel], transactions.start, transactions.end,
+                                    np.zeros(len(transactions)), transactions.liters)
+        engine_metrics.set_transactions(transactions)
+        metrics = Metrics()
+        metrics.merge(partial.metrics)
+        metrics.merge(engine_metrics)
+        values = metrics.as_dict()
+        # Время разбора и попадание в кэш относятся к узлу, а не к файлу
+        del values['stages']
+        values['counters'].pop('files_cached', None)
+        key, size = file_identity(file_path)
+        columns = {name: getattr(transactions, name) for name, _ in COLUMNS}
+        entry = {'key': key, 'name': os.path.basename(file_path), 'size': size, 'lists': _lists(partial),
+                 'metrics': values}
+        return cls([entry], stations, fuels, np.array([0, len(transactions)], dtype=np.int64), columns)
+
+    def _rank(self, position):
+        """Полнота версии файла: размер, затем число транзакций и меньше отброшенных неполных.
+
+        Одинаковые файлы на разных узлах дают разные транзакции, если на
+        одном из узлов нет соседнего файла с началом транзакции. Хэш
+        транзакций в конце делает выбор однозначным и при полном совпадении
+        счетчиков.
+        """
+        entry = self.files[position]
+        counters = entry['metrics']['counters']
+        lo, hi = int(self.offsets[position]), int(self.offsets[position + 1])
+        digest = hashlib.sha1(b''.join(self.columns[name][lo:hi].tobytes()
+                                       for name in ('trk', 'start', 'end', 'liters'))).hexdigest()
+        return entry['size'], counters.get('transactions', 0), -counters.get('dropped_incomplete', 0), digest
+
+    @classmethod
+    def merge_all(cls, results):
+        """Слияние любого числа результатов за один проход"""
+        chosen = dict()  # Ключ файла -> (полнота, результат, номер файла в нем)
+        for result in results:
+            for position, entry in enumerate(result.files):
+                rank = result._rank(position)
+                current = chosen.get(entry['key'])
+                if current is None or rank > current[0]:
+                    chosen[entry['key']] = (rank, result, position)
+        stations = sorted({station for result in results for station in result.stations})
+        fuels = sorted({fuel for result in results for fuel in result.fuels})
+        recoded = dict()  # id результата -> (коды станций, коды топлива) в общих списках
+        for result in results:
+            recoded[id(result)] = (np.array([stations.index(station) for station in result.stations] or [0],
+                                            dtype=np.int32),
+                                   np.array([fuels.index(fuel) for fuel in result.fuels] or [0], dtype=np.int32))
+        files = []
+        parts = {name: [] for name, _ in COLUMNS}
+        offsets = [0]
+        for key in sorted(chosen):
+            _, result, position = chosen[key]
+            files.append(result.files[position])
+            lo, hi = int(result.offsets[position]), int(result.offsets[position + 1])
+            station_codes, fuel_codes = recoded[id(result)]
+            for name, _ in COLUMNS:
+                column = result.columns[name][lo:hi]
+                if name == 'station':
+                    column = station_codes[column]
+                elif name == 'fuel':
+                    column = fuel_codes[column]
+                parts[name].append(column)
+            offsets.append(offsets[-1] + hi - lo)
+        columns = {name: np.concatenate(parts[name]).astype(dtype) if parts[name] else np.empty(0, dtype=dtype)
+                   for name, dtype in COLUMNS}
+        return cls(files, stations, fuels, np.array(offsets, dtype=np.int64), columns)
+
+    def merge(self, other):
+        """Новый результат с файлами self и other; повторяющийся файл берется в самой полной версии"""
+        return PartialResult.merge_all([self, other])
+
+    def exclude(self, keys):
+        """Результат без файлов с ключами keys (например, уже разобранных локально)"""
+        if not keys:
+            return self
+        kept = PartialResult([], self.stations, self.fuels)
+        kept.files = [entry for entry in self.files if entry['key'] not in keys]
+        ranges = [(int(self.offsets[i]), int(self.offsets[i + 1])) for i, entry in enumerate(self.files)
+                  if entry['key'] not in keys]
+        kept.offsets = np.array([0] + list(np.cumsum([hi - lo for lo, hi in ranges])), dtype=np.int64)
+        take = np.concatenate([np.arange(lo, hi) for lo, hi in ranges]) if ranges else np.empty(0, dtype=np.int64)
+        kept.columns = {name: column[take] for name, column in self.columns.items()}
+        return kept
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def transactions(self):
+        """Транзакции всех файлов в виде Transactions, как после TransactionEngine"""
+        columns = self.columns
+        # Объем уже учитывает переход счетчика, поэтому передается как конечное показание при нулевом начальном
+        return Transactions(list(self.stations), list(self.fuels), columns['station'].copy(), columns['trk'].copy(),
+                            columns['fuel'].copy(), columns['start'].copy(), columns['end'].copy(),
+                            np.zeros(len(self)), columns['liters'].copy())
+
+    def lists(self):
+        """Пустой BBOXParser со списками станций, ТРК и топлива всех файлов — для BBOXParser.merge_lists"""
+        parser = BBOXParser()
+        for entry in self.files:
+            other = BBOXParser()
+            other.gas_stations = entry['lists']['gas_stations']
+            other.GlobalDict = entry['lists']['GlobalDict']
+            other.fuels = entry['lists']['fuels']
+            other.columns = entry['lists']['columns']
+            parser.merge_lists(other)
+        return parser
+
+    def metrics(self):
+        """Метрики разбора и восстановления транзакций всех файлов"""
+        metrics = Metrics()
+        for entry in self.files:
+            metrics.merge(Metrics.from_dict(entry['metrics']))
+        return metrics
+
+    def save(self, path):
+        meta = {'format': FORMAT, 'version': VERSION, 'parser_version': PARSER_VERSION, 'files': self.files,
+                'stations': self.stations, 'fuels': self.fuels}
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, meta=np.frombuffer(json.dumps(meta, ensure_ascii=False).encode('utf-8'),
+                                                       dtype=np.uint8),
+                            offsets=self.offsets, **self.columns)
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Загружает файл .bbp; ValueError — чужой формат или другая версия"""
+        with np.load(path, allow_pickle=False) as stored:
+            if 'meta' not in stored.files:
+                raise ValueError(f"{path}: не частичный результат")
+            meta = json.loads(stored['meta'].tobytes().decode('utf-8'))
+            if meta.get('format') != FORMAT or meta.get('version') != VERSION:
+                raise ValueError(f"{path}: неподдерживаемая версия частичного результата {meta.get('version')}")
+            columns = {name: stored[name].astype(dtype, copy=False) for name, dtype in COLUMNS}
+            offsets = stored['offsets'].astype(np.int64, copy=False)
+        return cls(meta['files'], meta['stations'], meta['fuels'], offsets, columns)
+
+
+def find_partials(paths):
+    """Файлы .bbp из списка файлов и каталогов (каталоги — рекурсивно)"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, file) for file in sorted(files) if file.lower().endswith(SUFFIX))
+        else:
+            found.append(path)
+    return found
+
+
+def load_partials(paths):
+    """Загружает частичные результаты из файлов и каталогов; возвращает (результаты, [(файл, ошибка)])"""
+    results = []
+    errors = []
+    for path in find_partials(paths):
+        try:
+            results.append(PartialResult.load(path))
+        except Exception as e:
+            errors.append((path, str(e)))
+    return results, errors
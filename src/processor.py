@@ -1,27 +1,325 @@
 import os
+import threading
+import time
 from PyQt5.QtCore import QThread, pyqtSignal
 
+from src.engine import US_PER_DAY
+from src.files import find_bbox_files, is_compressed
+from src.ingest import iter_partials
+from src.metrics import Metrics
+from src.parser import BBOXParser
+from src.partial import PartialResult, file_identity, load_partials
+from src.tail import FileTail
+
+PROGRESS_INTERVAL = 0.5  # Не чаще одного сообщения о ходе разбора за столько секунд
+PROGRESS_ERRORS = 10  # Сколько ошибок разбора показывать в одном сообщении
+
 class DataProcessor(QThread):
     progress = pyqtSignal(str)
     finished = pyqtSignal()
 
-    def __init__(self, parser, found_files):
+    def __init__(self, parser, found_files, workers=1, cache=None, manifest=None, history=None):
         super().__init__()
         self.parser = parser
         self.found_files = found_files
+        self.workers = workers
+        self.cache = cache
+        self.manifest = manifest
+        self.history = history  # src.history.HistoryStore — пополняется новыми файлами
 
     def run(self):
-        self.progress.emit("Начинаем обработку файлов...")
+        if self.workers > 1:
+            self.progress.emit(f"Начинаем обработку файлов ({self.workers} процессов)...")
+        else:
+            self.progress.emit("Начинаем обработку файлов...")
         processed = 0
-        for file_path in self.found_files:
-            try:
-                if self.parser.parse_file(file_path):
+        from_cache = 0
+        done = reported = 0
+        errors = []  # Ошибки с прошлого сообщения
+        fresh = []  # (файл, частичный разбор) файлов, которых еще нет в истории
+        context = []  # События остальных разобранных файлов — для транзакций на стыке с новыми
+        started = last_report = time.perf_counter()
+        warned = [len(owner.metrics.warnings) for owner in (self.cache, self.manifest) if owner is not None]
+        try:
+            # Частичные результаты сливаются в порядке found_files, поэтому итог не зависит от числа процессов
+            for file_path, ok, partial, cached in iter_partials(self.found_files, self.parser.mode,
+                                                                self.workers, self.isInterruptionRequested,
+                                                                self.cache):
+                done += 1
+                if partial is not None:
+                    self.parser.merge(partial)
+                    errors.extend(f"{os.path.basename(file_path)}: {error}" for _, error in partial.metrics.warnings)
+                if ok:
                     processed += 1
-                    self.progress.emit(f"Обработан файл: {os.path.basename(file_path)}")
+                    from_cache += cached
+                    if self.manifest is not None:
+                        self.manifest.record(file_path, partial)
+                    if self.history is not None:
+                        try:
+                            if self.history.known(*file_identity(file_path)):
+                                context.extend(partial.data)
+                            else:
+                                fresh.append((file_path, partial))
+                        except Exception as e:
+                            errors.append(f"{os.path.basename(file_path)}: история — {str(e)}")
                 else:
-                    self.progress.emit(f"Ошибка при обработке файла: {os.path.basename(file_path)}")
-            except Exception as e:
-                self.progress.emit(f"Исключение при обработке {os.path.basename(file_path)}: {str(e)}")
+                    error = partial.metrics.errors[-1][1] if partial is not None and partial.metrics.errors else ""
+                    errors.append(f"{os.path.basename(file_path)}: {error}")
+                # Тысячи сообщений по одному на файл забивают консоль — сводка не чаще PROGRESS_INTERVAL
+                if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.perf_counter()
+                    self.report(done, from_cache, errors)
+                    reported = done
+                    errors = []
+        except Exception as e:
+            self.progress.emit(f"Исключение при обработке файлов: {str(e)}")
+        if done != reported:
+            self.report(done, from_cache, errors)
+        if fresh:
+            self.store_history(fresh, context)
+        self.parser.metrics.add_time('ingest', time.perf_counter() - started)
+        if self.manifest is not None:
+            self.manifest.save()
+        # Сбои кэша и оглавления за этот разбор (их счетчики — в метриках окна)
+        for owner, seen in zip([owner for owner in (self.cache, self.manifest) if owner is not None], warned):
+            for file_path, error in owner.metrics.warnings[seen:]:
+                self.progress.emit(f"Предупреждение: {os.path.basename(file_path)}: {error}")
 
+        if self.isInterruptionRequested():
+            self.progress.emit("Обработка остановлена пользователем")
         self.progress.emit(f"Обработка завершена. Успешно обработано файлов: {processed}/{len(self.found_files)}")
         self.finished.emit()
+
+    def report(self, done, from_cache, errors):
+        """Одно сообщение о ходе разбора вместе с ошибками с прошлого сообщения"""
+        message = f"Обработано файлов: {done}/{len(self.found_files)}, из кэша: {from_cache}"
+        if errors:
+            message += f", ошибок: {len(errors)} — " + "; ".join(errors[:PROGRESS_ERRORS])
+            if len(errors) > PROGRESS_ERRORS:
+                message += f" и еще {len(errors) - PROGRESS_ERRORS}"
+        self.progress.emit(message)
+
+    def store_history(self, items, context=()):
+        """Записывает в историю файлы items [(файл, частичный разбор)], восстановленные вместе"""
+        try:
+            added = self.history.add(PartialResult.merge_all(PartialResult.from_files(items, context)))
+            self.progress.emit(f"В историю добавлено транзакций: {added}")
+        except Exception as e:
+            self.progress.emit(f"Ошибка при записи истории: {str(e)}")
+
+
+class ManifestBuilder(QThread):
+    """Обновляет оглавление архива: заново просматриваются только новые и измененные файлы"""
+    progress = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, manifest, found_files):
+        super().__init__()
+        self.manifest = manifest
+        self.found_files = found_files
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            scanned = self.manifest.refresh(self.found_files, self.isInterruptionRequested)
+            self.manifest.save()
+            for file_path, error in self.manifest.metrics.warnings:
+                self.progress.emit(f"Предупреждение: {os.path.basename(file_path)}: {error}")
+            self.progress.emit(f"Оглавление архива: файлов {len(self.manifest.entries)}, просмотрено заново "
+                               f"{scanned}, {(time.perf_counter() - started) * 1000:.0f} мс")
+        except Exception as e:
+            self.progress.emit(f"Ошибка при построении оглавления: {str(e)}")
+        self.finished.emit()
+
+
+class PartialLoader(QThread):
+    """Загружает частичные результаты других узлов и сливает их с уже загруженными (imported)"""
+    progress = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, paths, imported=None, history=None):
+        super().__init__()
+        self.paths = paths
+        self.imported = imported
+        self.history = history
+        self.result = None
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            results, errors = load_partials(self.paths)
+            for path, error in errors:
+                self.progress.emit(f"Ошибка при загрузке частичного результата {os.path.basename(path)}: {error}")
+            self.result = PartialResult.merge_all(([self.imported] if self.imported is not None else []) + results)
+            self.progress.emit(f"Загружено частичных результатов: {len(results)}; всего файлов "
+                               f"{len(self.result.files)}, транзакций {len(self.result)}, "
+                               f"{(time.perf_counter() - started) * 1000:.0f} мс")
+            if self.history is not None and results:
+                self.progress.emit(f"В историю добавлено транзакций: "
+                                   f"{self.history.add(PartialResult.merge_all(results))}")
+        except Exception as e:
+            self.progress.emit(f"Ошибка при загрузке частичных результатов: {str(e)}")
+        self.finished.emit()
+
+
+class GraphWorker(QThread):
+    """Фоновая подготовка данных графика.
+
+    submit ставит задание — функцию, которая получает is_cancelled и
+    возвращает результат. Выполняется только последнее поставленное задание:
+    более старое, еще не начатое, отбрасывается, а начатое видит
+    is_cancelled() == True и должно прерваться. Результат приходит сигналом
+    ready вместе с номером задания, который вернул submit.
+    """
+    ready = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self):
+        super().__init__()
+        self.condition = threading.Condition()
+        self.pending = None  # (номер, функция) — задание, ожидающее выполнения
+        self.number = 0  # Номер последнего поставленного задания
+
+    def submit(self, job):
+        with self.condition:
+            self.number += 1
+            self.pending = (self.number, job)
+            self.condition.notify()
+        if not self.isRunning():
+            self.start()
+        return self.number
+
+    def stop(self):
+        self.requestInterruption()
+        with self.condition:
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.isInterruptionRequested():
+                    self.condition.wait()
+                if self.isInterruptionRequested():
+                    return
+                number, job = self.pending
+                self.pending = None
+
+            def is_cancelled():
+                return self.number != number or self.isInterruptionRequested()
+
+            try:
+                result = job(is_cancelled)
+                if not is_cancelled():
+                    self.ready.emit(number, result)
+            except Exception as e:
+                self.failed.emit(number, str(e))
+
+
+class LiveUpdater(QThread):
+    """Онлайн-режим: следит за каталогом и дочитывает новые и растущие файлы BBOX.
+
+    Дописанный до конца файл (и новый архивный) записывается в историю
+    history; context — списки событий уже загруженных файлов, нужные для
+    транзакций на стыке с ними.
+    """
+    progress = pyqtSignal(str)
+    updated = pyqtSignal(object)  # Список частичных BBOXParser с новыми событиями
+    reset = pyqtSignal(str)  # Файл заменен или обрезан и читается заново — его прежние события не нужны
+
+    def __init__(self, directory, known_files, mode='stream', interval=2.0, rescan_interval=30.0, history=None,
+                 context=()):
+        super().__init__()
+        self.directory = directory
+        self.known_files = set(known_files)  # Полностью разобранные файлы, их дочитывать не нужно
+        self.mode = mode
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self.history = history
+        self.context = [stream for stream in context if len(stream)]
+
+    def run(self):
+        tails = dict()
+        whole = dict()  # Путь отслеживаемого файла -> BBOXParser со всеми его событиями — для истории
+        archived = []  # Новые файлы из архивов, ждущие разбора
+        unreadable = set()  # Архивы, о которых уже предупредили
+        last_scan = None
+        while not self.isInterruptionRequested():
+            # Обход каталога стоит дорого на больших архивах, поэтому новые файлы ищем реже, чем дочитываем
+            if last_scan is None or time.monotonic() - last_scan >= self.rescan_interval:
+                last_scan = time.monotonic()
+                try:
+                    metrics = Metrics()
+                    found_files = find_bbox_files(self.directory, metrics)
+                    for file_path, error in metrics.warnings:
+                        if file_path not in unreadable:
+                            unreadable.add(file_path)
+                            self.progress.emit(f"Предупреждение: {os.path.basename(file_path)}: {error}")
+                    for file_path in found_files:
+                        if file_path in self.known_files or file_path in tails:
+                            continue
+                        if is_compressed(file_path):
+                            # Архивы не дописываются — новый архив разбирается один раз целиком
+                            archived.append(file_path)
+                            self.known_files.add(file_path)
+                            continue
+                        tails[file_path] = FileTail(file_path, self.mode)
+                        whole[file_path] = BBOXParser(self.mode)
+                        self.progress.emit(f"Отслеживается файл: {os.path.basename(file_path)}")
+                except Exception as e:
+                    self.progress.emit(f"Ошибка при поиске файлов: {str(e)}")
+
+            partials = []
+            while archived:
+                file_path = archived.pop()
+                partial = BBOXParser(self.mode)
+                if partial.parse_file(file_path):
+                    partials.append(partial)
+                    self.progress.emit(f"Разобран новый архивный файл: {os.path.basename(file_path)}")
+                    self.store_history(file_path, partial, whole)
+                else:
+                    self.progress.emit(f"Ошибка при чтении {os.path.basename(file_path)}: "
+                                       f"{partial.metrics.errors[-1][1]}")
+            for file_path, tail in list(tails.items()):
+                try:
+                    partial = tail.poll()
+                except Exception as e:
+                    self.progress.emit(f"Ошибка при чтении {os.path.basename(file_path)}: {str(e)}")
+                    self.known_files.add(file_path)
+                    del tails[file_path]
+                    del whole[file_path]
+                    continue
+                if tail.restarted:
+                    self.progress.emit(f"Файл заменен или обрезан, читается заново: {os.path.basename(file_path)}")
+                    self.reset.emit(file_path)
+                    whole[file_path] = BBOXParser(self.mode)
+                if partial is not None:
+                    partials.append(partial)
+                    whole[file_path].merge_tail(partial)
+                if tail.closed:
+                    self.known_files.add(file_path)
+                    del tails[file_path]
+                    self.store_history(file_path, whole.pop(file_path), whole)
+            if partials:
+                self.updated.emit(partials)
+
+            for _ in range(max(1, int(self.interval * 10))):
+                if self.isInterruptionRequested():
+                    break
+                self.msleep(100)
+
+    def store_history(self, file_path, partial, whole):
+        """Записывает в историю дописанный файл; whole — еще отслеживаемые файлы, их события тоже нужны для стыков"""
+        if self.history is None or not any(partial.data):
+            return
+        try:
+            if self.history.known(*file_identity(file_path)):
+                return
+            # Транзакция на стыке могла начаться только в файле, который закончился не раньше чем за сутки до этого
+            first = min(stream[0].timestamp for stream in partial.data if stream)
+            context = [stream for stream in self.context if stream[-1].timestamp >= first - US_PER_DAY]
+            context.extend(stream for other in whole.values() for stream in other.data if stream)
+            added = self.history.add(PartialResult.merge_all(PartialResult.from_files([(file_path, partial)], context)))
+            self.progress.emit(f"В историю добавлено транзакций: {added} ({os.path.basename(file_path)})")
+        except Exception as e:
+            self.progress.emit(f"Ошибка при записи истории: {str(e)}")
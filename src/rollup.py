@@ -0,0 +1,259 @@
+import copy
+import math
+
+import numpy as np
+
+from src.engine import US_PER_DAY, US_PER_MINUTE
+
+US_PER_HOUR = 3600000000
+US_PER_WEEK = 7 * US_PER_DAY
+WEEK_OFFSET = 3 * US_PER_DAY  # 1970-01-01 — четверг; недели начинаются с понедельника 1969-12-29
+# Интервалы от крупных к мелким: запрос берет самый крупный, на границы которого ложится диапазон дат
+GRANULARITIES = (US_PER_WEEK, US_PER_DAY, US_PER_HOUR)
+
+# Квантильный эскиз с относительной погрешностью SKETCH_ACCURACY: скорость попадает в ячейку
+# (MIN_FLOW * GAMMA^(i-1), MIN_FLOW * GAMMA^i], в ячейку 0 — все, что не больше MIN_FLOW.
+# Эскизы складываются поячеечно, поэтому сливаются без потери точности
+SKETCH_ACCURACY = 0.01
+GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_FLOW = 0.01
+QUANTILES = (('p10_flow', 0.1), ('median_flow', 0.5), ('p90_flow', 0.9))
+
+
+def sketch_bins(flow):
+    bins = np.ceil(np.log(np.maximum(flow, MIN_FLOW) / MIN_FLOW) / LOG_GAMMA)
+    return np.maximum(bins, 0).astype(np.int32)
+
+
+def bin_value(index):
+    """Представитель ячейки: отличается от любого значения ячейки не больше чем на SKETCH_ACCURACY"""
+    if index <= 0:
+        return 0.0
+    return MIN_FLOW * GAMMA ** index * 2 / (GAMMA + 1)
+
+
+def bucket_start(start, width):
+    if width == US_PER_WEEK:
+        return (start + WEEK_OFFSET) // width * width - WEEK_OFFSET
+    return start // width * width
+
+
+def _changes(*columns):
+    """Начала групп одинаковых значений в упорядоченных столбцах"""
+    change = np.zeros(len(columns[0]), dtype=bool)
+    change[:1] = True
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+    return np.flatnonzero(change)
+
+
+class Rollup:
+    """Агрегаты одной ширины интервала по рядам (станция, ТРК, топливо).
+
+    Строка — непустой интервал ряда: bucket — начало интервала в микросекундах,
+    count, liters, minutes и flow_sum — число транзакций, литры, минуты налива и
+    сумма скоростей. Строки упорядочены по (ряд, bucket), у ряда отрезок
+    [lo, hi) в series. Эскиз скорости строки i — ячейки sketch_bin и их счетчики
+    sketch_count в отрезке [sketch_offsets[i], sketch_offsets[i + 1]).
+    """
+
+    def __init__(self, width, keys, key, bucket, count, liters, minutes, flow_sum, sketch_key, sketch_bucket,
+                 sketch_bin, sketch_count):
+        """Аргументы — несгруппированные строки и ячейки эскиза (например, по одной на транзакцию)"""
+        self.width = width
+        self.keys = keys
+        order = np.lexsort((bucket, key))
+        key = key[order]
+        bucket = bucket[order]
+        starts = _changes(key, bucket)
+        self.key = key[starts]
+        self.bucket = bucket[starts]
+        self.count = np.add.reduceat(count[order], starts)
+        self.liters = np.add.reduceat(liters[order], starts)
+        self.minutes = np.add.reduceat(minutes[order], starts)
+        self.flow_sum = np.add.reduceat(flow_sum[order], starts)
+
+        order = np.lexsort((sketch_bin, sketch_bucket, sketch_key))
+        sketch_key = sketch_key[order]
+        sketch_bucket = sketch_bucket[order]
+        sketch_bin = sketch_bin[order]
+        starts = _changes(sketch_key, sketch_bucket, sketch_bin)
+        self.sketch_bin = sketch_bin[starts]
+        self.sketch_count = np.add.reduceat(sketch_count[order], starts)
+        # У каждой строки есть хотя бы одна ячейка, и ячейки упорядочены так же, как строки
+        rows = _changes(sketch_key[starts], sketch_bucket[starts])
+        self.sketch_offsets = np.append(rows, len(starts))
+
+        self._index_series()
+
+    def _index_series(self):
+        self.series = dict()  # (станция, ТРК, топливо) -> (lo, hi)
+        bounds = np.append(_changes(self.key), len(self.key)).tolist()
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            self.series[self.keys[int(self.key[lo])]] = (lo, hi)
+
+    def columns(self, codes, rows=None):
+        """Строки (все или с номерами rows) и их ячейки в несгруппированном виде с кодами рядов через codes"""
+        sizes = np.diff(self.sketch_offsets)
+        if rows is None:
+            key, bucket = codes[self.key], self.bucket
+            count, liters, minutes, flow_sum = self.count, self.liters, self.minutes, self.flow_sum
+            sketch_bin, sketch_count = self.sketch_bin, self.sketch_count
+        else:
+            key, bucket = codes[self.key[rows]], self.bucket[rows]
+            count, liters, minutes, flow_sum = self.count[rows], self.liters[rows], self.minutes[rows], \
+                self.flow_sum[rows]
+            sizes = sizes[rows]
+            # Номера ячеек выбранных строк подряд без цикла по строкам
+            offsets = np.cumsum(sizes) - sizes
+            take = np.arange(int(sizes.sum())) + np.repeat(self.sketch_offsets[rows] - offsets, sizes)
+            sketch_bin, sketch_count = self.sketch_bin[take], self.sketch_count[take]
+        return (key, bucket, count, liters, minutes, flow_sum, np.repeat(key, sizes), np.repeat(bucket, sizes),
+                sketch_bin, sketch_count)
+
+    def merge(self, other, keys, codes):
+        """Новые агрегаты с добавленными строками other (коды его рядов в keys — codes).
+
+        Заново группируются только строки (ряд, интервал), которые есть в
+        other: они вычисляются вместе с такими же строками self, а остальные
+        строки self только сдвигаются. Сам self не меняется.
+        """
+        added = Rollup(self.width, keys, *other.columns(codes))
+        # Место строк added в строках self: по двоичному поиску внутри отрезка ряда, новые ряды — в конце
+        positions = np.full(len(added.key), len(self.key), dtype=np.int64)
+        for key, (lo, hi) in added.series.items():
+            series = self.series.get(key)
+            if series is not None:
+                positions[lo:hi] = series[0] + np.searchsorted(self.bucket[series[0]:series[1]],
+                                                               added.bucket[lo:hi], 'left')
+        found = positions < len(self.key)
+        found[found] = self.bucket[positions[found]] == added.bucket[found]
+        found[found] = self.key[positions[found]] == added.key[found]
+        matched = positions[found]
+        # Совпавшие строки считаются заново вместе с added; added и patch содержат одни и те же строки
+        patch = Rollup(self.width, keys, *(np.concatenate(column) for column in
+                                           zip(self.columns(np.arange(len(self.keys), dtype=np.int64), matched),
+                                               added.columns(np.arange(len(keys), dtype=np.int64)))))
+        keep = np.ones(len(self.key), dtype=bool)
+        keep[matched] = False
+        places = positions - np.searchsorted(matched, positions, 'left')  # Места в строках без совпавших
+        sizes = np.diff(self.sketch_offsets)
+        kept_sizes = sizes[keep]
+        kept_offsets = np.append(0, np.cumsum(kept_sizes))
+        kept_cells = np.repeat(keep, sizes)
+        patch_sizes = np.diff(patch.sketch_offsets)
+        cell_places = np.repeat(kept_offsets[places], patch_sizes)
+
+        merged = copy.copy(self)
+        merged.keys = keys
+        for name in ('key', 'bucket', 'count', 'liters', 'minutes', 'flow_sum'):
+            setattr(merged, name, np.insert(getattr(self, name)[keep], places, getattr(patch, name)))
+        merged.sketch_bin = np.insert(self.sketch_bin[kept_cells], cell_places, patch.sketch_bin)
+        merged.sketch_count = np.insert(self.sketch_count[kept_cells], cell_places, patch.sketch_count)
+        merged.sketch_offsets = np.append(0, np.cumsum(np.insert(kept_sizes, places, patch_sizes)))
+        merged._index_series()
+        return merged
+
+    def rows(self, key, start=None, end=None):
+        """Отрезок [lo, hi) строк ряда key с началом интервала в [start, end)"""
+        lo, hi = self.series.get(key, (0, 0))
+        buckets = self.bucket[lo:hi]
+        return (lo + (int(np.searchsorted(buckets, start, 'left')) if start is not None else 0),
+                lo + (int(np.searchsorted(buckets, end, 'left')) if end is not None else hi - lo))
+
+    def quantiles(self, lo, hi, levels):
+        counts = np.bincount(self.sketch_bin[self.sketch_offsets[lo]:self.sketch_offsets[hi]],
+                             weights=self.sketch_count[self.sketch_offsets[lo]:self.sketch_offsets[hi]])
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        return [bin_value(int(np.searchsorted(cumulative, level * (total - 1), 'right'))) for level in levels]
+
+
+class Rollups:
+    """Предрасчитанные агрегаты по часам, дням и неделям для каждого ряда (станция, ТРК, топливо).
+
+    Среднее, медиана и p10/p90 скорости за любой период считаются по строкам
+    интервалов, а не по транзакциям. Агрегаты разных файлов, процессов или
+    порций онлайн-режима сливаются через merge без исходных событий.
+    """
+
+    def __init__(self, keys=None, levels=None):
+        self.keys = keys if keys is not None else []
+        self.levels = levels if levels is not None else dict()  # Ширина интервала -> Rollup
+
+    @classmethod
+    def from_transactions(cls, transactions, since=0):
+        """Агрегаты транзакций снимка, начиная с номера since"""
+        keys = []
+        station = transactions.station[since:]
+        trk = transactions.trk[since:]
+        fuel = transactions.fuel[since:]
+        # Код ряда — номер уникальной тройки (станция, ТРК, топливо)
+        triples, inverse = np.unique(np.stack([station, trk, fuel]), axis=1, return_inverse=True)
+        for station_code, trk_number, fuel_code in triples.T.tolist():
+            keys.append((transactions.stations[station_code], trk_number, transactions.fuels[fuel_code]))
+        key = inverse.reshape(-1).astype(np.int64)
+        start = transactions.start[since:]
+        flow = transactions.flow[since:]
+        ones = np.ones(len(key), dtype=np.int64)
+        minutes = (transactions.end[since:] - start) / US_PER_MINUTE
+        bins = sketch_bins(flow)
+        levels = dict()
+        for width in GRANULARITIES:
+            bucket = bucket_start(start, width)
+            levels[width] = Rollup(width, keys, key, bucket, ones, transactions.liters[since:], minutes, flow,
+                                   key, bucket, bins, ones)
+        return cls(keys, levels)
+
+    def merge(self, other):
+        """Новые агрегаты, в которых сложены self и other"""
+        keys = list(self.keys)
+        positions = {key: code for code, key in enumerate(keys)}
+        for key in other.keys:
+            if key not in positions:
+                positions[key] = len(keys)
+                keys.append(key)
+        other_codes = np.array([positions[key] for key in other.keys] or [0], dtype=np.int64)
+        levels = dict()
+        for width in GRANULARITIES:
+            own, added = self.levels.get(width), other.levels.get(width)
+            if own is not None and added is not None:
+                # Коды рядов self в keys не меняются — пересчитываются только строки, которые есть в other
+                levels[width] = own.merge(added, keys, other_codes)
+            elif added is not None:
+                levels[width] = Rollup(width, keys, *added.columns(other_codes))
+            elif own is not None:
+                levels[width] = own
+        return Rollups(keys, levels)
+
+    def level(self, start, end):
+        """Самая крупная ширина интервала, на границы которой ложатся start и end"""
+        for width in GRANULARITIES:
+            if all(bound is None or bucket_start(bound, width) == bound for bound in (start, end)):
+                return width
+        return US_PER_HOUR
+
+    def stats(self, key, start=None, end=None):
+        """Сводка ряда key по транзакциям, начавшимся в [start, end) (микросекунды, None — без границы).
+
+        Если границы не ложатся на часы, берутся часы, начавшиеся внутри
+        диапазона. Квантили — с относительной погрешностью SKETCH_ACCURACY.
+        Возвращает None, если транзакций нет.
+        """
+        rollup = self.levels.get(self.level(start, end))
+        if rollup is None:
+            return None
+        lo, hi = rollup.rows(key, start, end)
+        if hi <= lo:
+            return None
+        count = int(rollup.count[lo:hi].sum())
+        stats = {
+            'transactions': count,
+            'liters': float(rollup.liters[lo:hi].sum()),
+            'minutes': float(rollup.minutes[lo:hi].sum()),
+            'mean_flow': float(rollup.flow_sum[lo:hi].sum()) / count,
+        }
+        for (name, _), value in zip(QUANTILES, rollup.quantiles(lo, hi, [level for _, level in QUANTILES])):
+            stats[name] = value
+        return stats
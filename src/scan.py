@@ -0,0 +1,251 @@
+import codecs
+import mmap
+import re
+from itertools import compress
+
+from src.files import is_compressed, open_bbox
+
+# Быстрый разбор по сырым байтам: файл отображается в память, одно регулярное выражение проходит
+# по всем строкам ROW, и декодируются только строки, действие которых может понадобиться parse_row.
+# Поддерживается только простая структура лога — корневой элемент с самозакрывающимися строками
+# ROW и атрибутами в двойных кавычках. Все остальное (DOCTYPE, комментарии, CDATA, другие
+# элементы, одинарные кавычки, многобайтовые кодировки кроме UTF-8, ошибки разметки) вызывает
+# ScanFallback, и файл разбирается XML-парсером. Сжатый файл распаковывается в память целиком.
+
+S = rb'[ \t\r\n]'
+EQ = S + rb'*=' + S + rb'*'
+NAME = rb'[A-Za-z_:][-A-Za-z0-9_:.]*'
+ATTRS = rb'(?:' + S + rb'+' + NAME + EQ + rb'"[^"]*")*'
+
+DECLARATION_RE = re.compile(rb'<\?xml' + S + rb'+version' + EQ + rb'(["\'])1\.[0-9]\1'
+                            rb'(?:' + S + rb'+encoding' + EQ + rb'(["\'])([A-Za-z][-\w.]*)\2)?'
+                            rb'(?:' + S + rb'+standalone' + EQ + rb'(["\'])(?:yes|no)\4)?'
+                            + S + rb'*\?>')
+ROOT_RE = re.compile(S + rb'*<(?!ROW[ \t\r\n/>])(' + NAME + rb')' + ATTRS + S + rb'*>')
+CLOSE_RE = re.compile(rb'</(' + NAME + rb')' + S + rb'*>' + S + rb'*\Z')
+# Повтор атрибута в строке ROW — ошибка разметки для XML-парсера
+DUPLICATE_RE = re.compile(rb'<ROW' + ATTRS + rb'?' + S + rb'+(' + NAME + rb')' + EQ + rb'"[^"]*"'
+                          + ATTRS + rb'?' + S + rb'+\1' + EQ + rb'"')
+ENTITY_REF_RE = re.compile(rb'&(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);')
+ENTITY_RE = re.compile(r'&(?:(amp|lt|gt|quot|apos)|#([0-9]+)|#x([0-9a-fA-F]+));')
+ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+# Байты, допустимые в XML в кодировке UTF-8: все, кроме управляющих символов
+UTF8_ALLOWED = bytes(range(32, 256)) + b'\t\n\r'
+
+TRK_PREFIX = 'ТРК : '
+ORDER_PREFIX = 'Тр: '
+ORDER_ACTIONS = ('Доза установлена', 'Налив зафиксирован', 'Топливный заказ перемещен')
+
+
+class ScanFallback(Exception):
+    """Файл нельзя надежно разобрать по байтам — нужен XML-парсер"""
+
+
+class Patterns:
+    """Регулярные выражения строк ROW для одной кодировки.
+
+    Группы canonical: DATETIME, HOST, ACTION, если он начинается с префикса
+    нужных действий, и ACTION с '&' или пробельными символами — после разбора
+    XML такое значение может совпасть с префиксом. В general перед каждым
+    атрибутом есть группа с кавычкой: по ней видно, что атрибут найден.
+    """
+
+    def __init__(self, encoding):
+        self.order_prefix = ORDER_PREFIX.encode(encoding)
+        self.order_actions = tuple(action.encode(encoding) for action in ORDER_ACTIONS)
+        prefixes = re.escape(TRK_PREFIX.encode(encoding)) + rb'|' + re.escape(self.order_prefix)
+        # Значение с префиксом, но с '&' или пробельными символами попадает во вторую группу
+        action = rb'"(?:((?:' + prefixes + rb')[^"&\t\r\n]*)"|([^"&\t\r\n]*[&\t\r\n][^"]*)"|[^"]*")'
+        # Обычный порядок атрибутов BBOX — проверяется первым, он заметно быстрее
+        self.canonical = re.compile(rb'<ROW' + S + rb'+DATETIME' + EQ + rb'"([^"]*)"' + S + rb'+HOST' + EQ
+                                    + rb'"([^"]*)"' + S + rb'+ACTION' + EQ + action + S + rb'*/>')
+        self.general = re.compile(rb'<ROW(?:' + S + rb'+(?:DATETIME' + EQ + rb'(")([^"]*)"|HOST' + EQ + rb'(")([^"]*)"|'
+                                  rb'ACTION' + EQ + rb'(?=("))' + action + rb'|' + NAME + EQ + rb'"[^"]*"))*'
+                                  + S + rb'*/>')
+
+
+def _single_byte_allowed(encoding):
+    """Байты, допустимые в XML и определенные в однобайтовой ASCII-совместимой кодировке; None — не такая кодировка"""
+    decoded = bytes(range(256)).decode(encoding, 'replace')
+    if len(decoded) != 256 or decoded[:128] != bytes(range(128)).decode('ascii'):
+        return None
+    return bytes(code for code in range(256) if (code >= 32 or code in (9, 10, 13)) and decoded[code] != '\ufffd')
+
+
+def _entity(match):
+    name, decimal, hexadecimal = match.groups()
+    if name is not None:
+        return ENTITIES[name]
+    return chr(int(decimal) if decimal is not None else int(hexadecimal, 16))
+
+
+class ByteScanner:
+    """Отображенный в память файл BBOX, проверенный на простую структуру.
+
+    Конструктор бросает ScanFallback, если файл не подходит; после этого
+    hosts() и candidates() выдают те же значения атрибутов, что и XML-парсер.
+    """
+    _patterns = dict()  # Кодировка -> Patterns
+    _allowed = dict()  # Кодировка -> допустимые байты (None для UTF-8)
+
+    def __init__(self, file_path):
+        if is_compressed(file_path):
+            with open_bbox(file_path) as f:
+                self.buffer = f.read()
+            if not self.buffer:
+                raise ScanFallback("empty file")
+        else:
+            with open(file_path, 'rb') as f:
+                try:
+                    self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:  # Пустой файл
+                    raise ScanFallback("empty file")
+        try:
+            self.size = len(self.buffer)
+            self.encoding, self.start = self._detect_encoding()
+            self.patterns = self._patterns.get(self.encoding)
+            if self.patterns is None:
+                self.patterns = self._patterns[self.encoding] = Patterns(self.encoding)
+            self.rows = self._match_rows()
+        except BaseException:
+            self.close()
+            raise
+
+    def _detect_encoding(self):
+        buffer = self.buffer
+        start = 0
+        encoding = 'utf-8'
+        if buffer[:3] == codecs.BOM_UTF8:
+            start = 3
+        elif buffer[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+            raise ScanFallback("UTF-16")
+        declaration = DECLARATION_RE.match(buffer, start)
+        if declaration is not None:
+            if declaration.group(3) is not None:
+                try:
+                    declared = codecs.lookup(declaration.group(3).decode('ascii')).name
+                except LookupError:
+                    raise ScanFallback("unknown encoding")
+                if start and declared != 'utf-8':
+                    raise ScanFallback("BOM does not match the declared encoding")
+                encoding = declared
+            start = declaration.end()
+        elif buffer[start:start + 5] == b'<?xml':
+            raise ScanFallback("unsupported XML declaration")
+        if encoding != 'utf-8':
+            if encoding not in self._allowed:
+                self._allowed[encoding] = _single_byte_allowed(encoding)
+            if self._allowed[encoding] is None:
+                raise ScanFallback(f"encoding {encoding}")
+        return encoding, start
+
+    def _count_tags(self, start, end):
+        """Проверки, которые XML-парсер делает над каждым байтом; возвращает число '<'.
+
+        Байты должны декодироваться, управляющие символы запрещены, '&'
+        допустим только в составе сущности, ']]>' вне CDATA — ошибка.
+        """
+        buffer = self.buffer
+        allowed = self._allowed.get(self.encoding)
+        decoder = codecs.getincrementaldecoder('utf-8')('strict') if allowed is None else None
+        tags = 0
+        step = 1 << 22
+        try:
+            for offset in range(start, end, step):
+                chunk = buffer[offset:min(offset + step, end)]
+                tags += chunk.count(b'<')
+                if chunk.translate(None, UTF8_ALLOWED if allowed is None else allowed):
+                    raise ScanFallback("invalid characters")
+                if decoder is not None:
+                    decoder.decode(chunk)
+            if decoder is not None:
+                decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise ScanFallback("undecodable bytes")
+        if buffer.find(b']]>', start, end) >= 0:
+            raise ScanFallback("unsupported document structure")
+        position = buffer.find(b'&', start, end)
+        while position >= 0:
+            if not ENTITY_REF_RE.match(buffer, position):
+                raise ScanFallback("invalid entity reference")
+            position = buffer.find(b'&', position + 1, end)
+        return tags
+
+    def _match_rows(self):
+        """Все строки ROW одним проходом регулярного выражения; возвращает их число"""
+        buffer = self.buffer
+        root = ROOT_RE.match(buffer, self.start)
+        if root is None:
+            raise ScanFallback("unsupported document structure")
+        close = CLOSE_RE.search(buffer, max(root.end(), self.size - 4096))
+        if close is None or root.group(1) != close.group(1):
+            raise ScanFallback("unsupported document structure")
+        # Каждый '<' между открытием и закрытием корня должен начинать правильную строку ROW
+        rows = self._count_tags(root.end(), close.start())
+        self.matches = self.patterns.canonical.findall(buffer, root.end(), close.start())
+        if len(self.matches) == rows:
+            return rows
+        matches = self.patterns.general.findall(buffer, root.end(), close.start())
+        if len(matches) != rows or DUPLICATE_RE.search(buffer, root.end(), close.start()):
+            raise ScanFallback("unsupported document structure")
+        # Без HOST или ACTION parse_row падает, а XML-парсер сообщит об ошибке
+        if not all(has_host and has_action for _, _, has_host, _, has_action, _, _ in matches):
+            raise ScanFallback("ROW without HOST or ACTION")
+        self.matches = [(timestamp if has_timestamp else None, host, action, special)
+                        for has_timestamp, timestamp, _, host, _, action, special in matches]
+        return rows
+
+    def value(self, raw):
+        """Значение атрибута так, как его вернул бы XML-парсер"""
+        text = raw.decode(self.encoding)
+        if '&' in text or '\t' in text or '\n' in text or '\r' in text:
+            text = text.replace('\r\n', '\n').translate({9: 32, 10: 32, 13: 32})  # Нормализация пробелов
+            text = ENTITY_RE.sub(_entity, text)
+        return text
+
+    def values(self, raw_values):
+        """Как value для списка значений; декодирование одним вызовом для всех строк"""
+        # '\x00' в файле быть не может (проверено в _count_tags), поэтому годится разделителем
+        text = b'\x00'.join(raw_values).decode(self.encoding)
+        if '&' in text or '\t' in text or '\n' in text or '\r' in text:
+            return [self.value(raw) for raw in raw_values]
+        return text.split('\x00')
+
+    def hosts(self):
+        """Значения HOST всех строк в порядке первого появления"""
+        return [self.value(raw) for raw in dict.fromkeys(match[1] for match in self.matches)]
+
+    def candidates(self):
+        """Атрибуты строк, которые могут понадобиться parse_row, в порядке документа"""
+        order_prefix = self.patterns.order_prefix
+        order_actions = self.patterns.order_actions
+        selected = []
+        for match in compress(self.matches, [match[2] or match[3] for match in self.matches]):
+            action = match[2]
+            # "Тр: " без нужного действия parse_row все равно пропустит
+            if action.startswith(order_prefix) and not any(key in action for key in order_actions):
+                continue
+            selected.append(match)
+        if not selected:
+            return
+        timestamps = self.values([match[0] or b'' for match in selected])
+        actions = self.values([match[2] or match[3] for match in selected])
+        hosts = dict()
+        for match, timestamp, action in zip(selected, timestamps, actions):
+            host = hosts.get(match[1])
+            if host is None:
+                host = hosts[match[1]] = self.value(match[1])
+            attrib = {'HOST': host, 'ACTION': action}
+            if match[0] is not None:  # None — атрибута DATETIME нет
+                attrib['DATETIME'] = timestamp
+            yield attrib
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,75 @@
+import os
+import xml.etree.ElementTree as ET
+
+from src.parser import BBOXParser
+
+HEAD_BYTES = 4096  # По началу файла видно, что файл заменен или переписан заново
+
+
+class FileTail:
+    """Дочитывает растущий файл BBOX: при каждом опросе разбирается только то, что дописано с прошлого раза.
+
+    Используется XMLPullParser, поэтому незакрытый корневой элемент текущего
+    лога не мешает разбору: строки ROW выдаются по мере появления. Если файл
+    заменен (другой inode), обрезан или его начало изменилось, он читается с
+    начала, а restarted после такого опроса равен True: прежние события файла
+    надо отбросить.
+    """
+
+    def __init__(self, file_path, mode='stream', chunk_size=1 << 20):
+        self.file_path = file_path
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.restarted = False
+        self.inode = None
+        self._reset()
+
+    def _reset(self):
+        self.offset = 0
+        self.head = b''  # Первые HEAD_BYTES байт прочитанного
+        self.closed = False  # Корневой элемент закрыт — файл дописан до конца
+        self._pull = ET.XMLPullParser(events=('start', 'end'))
+        self._parents = []
+
+    def poll(self):
+        """Возвращает частичный BBOXParser с новыми событиями или None, если файл не вырос"""
+        self.restarted = False
+        if self.closed:
+            return None
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None  # При ротации старый файл уже переименован, а новый еще не создан
+        with open(self.file_path, 'rb') as f:
+            if self.offset and (stat.st_ino != self.inode or stat.st_size < self.offset or
+                                f.read(len(self.head)) != self.head):
+                self._reset()
+                self.restarted = True
+            self.inode = stat.st_ino
+            size = stat.st_size
+            if size <= self.offset:
+                return None
+            partial = BBOXParser(self.mode)
+            events = []
+            f.seek(self.offset)
+            while self.offset < size:
+                chunk = f.read(min(self.chunk_size, size - self.offset))
+                if not chunk:
+                    break
+                if len(self.head) < HEAD_BYTES:
+                    self.head += chunk[:HEAD_BYTES - len(self.head)]
+                self.offset += len(chunk)
+                partial.metrics.count('bytes', len(chunk))
+                self._pull.feed(chunk)
+                for row in partial.handle_xml_events(self._read_events(), self._parents):
+                    events.append(row)
+        partial.files.append(self.file_path)
+        partial.data.append(events)
+        partial.metrics.count_events(events)
+        return partial
+
+    def _read_events(self):
+        for event, element in self._pull.read_events():
+            yield event, element
+            if event == 'end' and not self._parents:
+                self.closed = True
@@ -0,0 +1,70 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.events import Event, EventKind, to_timestamp
+
+HEADER = '<?xml version="1.0" encoding="windows-1251"?>\n<ROWDATA>\n'
+
+
+def transaction_events(station, trk, start, seconds, counter, liters, fuel="АИ-92"):
+    """События одной транзакции налива: start — datetime начала, counter — показание счетчика до налива"""
+    begin = to_timestamp(start)
+    end = to_timestamp(start + timedelta(seconds=seconds))
+    return [
+        Event(EventKind.DOSE_SET, station, trk, begin, fuel=fuel),
+        Event(EventKind.DOSE_SETUP, station, trk, begin, hose=1, counter=counter),
+        Event(EventKind.DISPENSE_START, station, trk, begin + 1000000),
+        Event(EventKind.DISPENSE_END, station, trk, end),
+        Event(EventKind.TRANSACTION_END, station, trk, end, counter=round((counter + liters) % 1000000, 2)),
+    ]
+
+
+def transaction_rows(trk, start, seconds, counter, liters, fuel="АИ-92"):
+    """Строки лога BBOX (время, ACTION) одной транзакции — те же, что у transaction_events"""
+    end = start + timedelta(seconds=seconds)
+    return [
+        (start, f"ТРК : {trk}; Снят пистолет; Рукав: 1"),
+        (start, f"Тр: 1; Доза установлена; ТРК: {trk}; Прод.: {fuel}; Объем: 50,00"),
+        (start, f"ТРК : {trk}; Установка дозы; Рукав: 1; Счетчик: {counter:.2f}".replace('.', ',')),
+        (start + timedelta(seconds=1), f"ТРК : {trk}; На ТРК идет отпуск топлива"),
+        (end, f"ТРК : {trk}; На ТРК закончен отпуск топлива"),
+        (end, f"ТРК : {trk}; Конец транзакции; Счетчик: {(counter + liters) % 1000000:.2f}".replace('.', ',')),
+    ]
+
+
+def row_lines(station, rows):
+    """Элементы ROW лога BBOX для строк rows (время, ACTION)"""
+    return [f'<ROW DATETIME="{moment.strftime("%Y%m%dT%H:%M:%S")}000" HOST="{station} - SRV01" '
+            f'ACTION="{action}" />\n' for moment, action in rows]
+
+
+def write_days(directory, station, rows):
+    """Пишет строки rows по файлам <каталог>/<АЗС>/<ГГГГММДД>/BBOX.XML — по дню строки; возвращает пути"""
+    days = dict()
+    for row in sorted(rows, key=lambda row: row[0]):
+        days.setdefault(row[0].strftime("%Y%m%d"), []).extend(row_lines(station, [row]))
+    paths = []
+    for day, lines in sorted(days.items()):
+        folder = os.path.join(directory, station, day)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, "BBOX.XML")
+        with open(path, 'w', encoding='cp1251') as f:
+            f.write(HEADER)
+            f.writelines(lines)
+            f.write('</ROWDATA>\n')
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def midnight_logs(tmp_path):
+    """Логи двух АЗС за два дня; у каждой одна транзакция идет через полночь и попадает в оба файла"""
+    paths = []
+    for number, station in enumerate(("АЗС001", "АЗС002")):
+        rows = (transaction_rows(1, datetime(2024, 3, 1, 10), 60, 100 + number, 20) +
+                transaction_rows(1, datetime(2024, 3, 1, 23, 59, 30), 60, 120 + number, 20) +
+                transaction_rows(2, datetime(2024, 3, 2, 10), 90, 999990, 30, fuel="ДТ"))
+        paths.extend(write_days(str(tmp_path), station, rows))
+    return paths
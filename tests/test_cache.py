@@ -0,0 +1,66 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from src.cache import ParseCache
+from src.parser import BBOXParser
+from tests.conftest import transaction_rows, write_days
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    return write_days(str(tmp_path / "logs"), "АЗС001", transaction_rows(1, datetime(2024, 3, 1, 10), 60, 100, 20))[0]
+
+
+def parse(path):
+    partial = BBOXParser(mode='stream')
+    assert partial.parse_file(path)
+    return partial
+
+
+def test_entry_is_found_until_file_changes(log_file, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    assert cache.get(log_file) is None
+    cache.put(log_file, parse(log_file))
+    cached = cache.get(log_file)
+    assert cached is not None
+    assert [len(events) for events in cached.data] == [len(events) for events in parse(log_file).data]
+    # Дописанный файл — другой размер и время изменения, старая запись не находится
+    with open(log_file, 'a', encoding='cp1251') as f:
+        f.write('\n')
+    os.utime(log_file, ns=(os.stat(log_file).st_atime_ns, os.stat(log_file).st_mtime_ns + 10 ** 9))
+    assert cache.get(log_file) is None
+
+
+def test_new_parser_version_misses(log_file, tmp_path, monkeypatch):
+    cache = ParseCache(str(tmp_path / "cache"))
+    cache.put(log_file, parse(log_file))
+    monkeypatch.setattr('src.cache.PARSER_VERSION', -1)
+    assert cache.get(log_file) is None
+
+
+def test_broken_entry_is_a_miss_with_warning(log_file, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    cache.put(log_file, parse(log_file))
+    with open(cache._entry_path(cache.key(log_file)), 'wb') as f:
+        f.write(b'not a cache entry')
+    assert cache.get(log_file) is None
+    assert cache.metrics.counters['cache_errors'] == 1
+    assert cache.metrics.warnings[0][0] == log_file
+    # Испорченная запись удалена
+    assert cache.size() == 0
+
+
+def test_evict_keeps_limit(tmp_path):
+    paths = write_days(str(tmp_path / "logs"), "АЗС001",
+                       [row for day in range(1, 4)
+                        for row in transaction_rows(1, datetime(2024, 3, day, 10), 60, 100, 20)])
+    cache = ParseCache(str(tmp_path / "cache"))
+    for path in paths:
+        cache.put(path, parse(path))
+    sizes = sorted(size for _, size, _ in cache._entries())
+    cache.max_bytes = sizes[-1]
+    cache.evict()
+    assert len(cache._entries()) == 1
+    assert cache.size() <= cache.max_bytes
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.detect import ClogDetector
+from src.engine import TransactionEngine
+from tests.conftest import transaction_events
+
+DAYS = 90
+DECLINE = 60  # С этого дня скорость на ТРК 1 падает
+
+
+def flows(trk, day):
+    if trk == 1 and day >= DECLINE:
+        return 40.0 * (1 - 0.4 * (day - DECLINE) / (DAYS - DECLINE))
+    return 40.0
+
+
+def series_events(days, trk):
+    counter = 1000.0
+    events = []
+    for day in days:
+        for hour in (8, 12, 16):
+            flow = flows(trk, day) * (1 + 0.01 * (hour - 12) / 4)
+            # Отпуск длится ровно минуту, поэтому объем равен скорости
+            events += transaction_events("АЗС001", trk, datetime(2024, 1, 1) + timedelta(days=day, hours=hour), 61,
+                                         counter, flow)
+            counter += flow
+    return events
+
+
+def reconstruct(parts):
+    engine = TransactionEngine()
+    for number, events in enumerate(parts):
+        engine.feed(events, stream=number)
+    return engine.transactions()
+
+
+def test_declining_series_alerts():
+    detector = ClogDetector(window=15)
+    detector.update(reconstruct([series_events(range(DAYS), 1), series_events(range(DAYS), 2)]))
+    alerts = detector.alerts()
+    assert [(alert['station'], alert['trk'], alert['fuel']) for alert in alerts] == [("АЗС001", 1, "АИ-92")]
+    alert = alerts[0]
+    assert alert['baseline_flow'] == pytest.approx(40.0, rel=0.02)
+    assert alert['drop'] > 0.3
+    assert alert['slope'] < 0
+    assert alert['transactions'] == DAYS * 3
+    # Медиана окна из 15 транзакций (5 дней) отстает от падения, и отставание на треть порога набирается не сразу
+    decline_start = datetime.fromisoformat(alert['decline_start'])
+    assert datetime(2024, 1, 1) + timedelta(days=DECLINE) <= decline_start <= \
+           datetime(2024, 1, 1) + timedelta(days=DECLINE + 10)
+    assert detector.alert(("АЗС001", 2, "АИ-92")) is None
+
+
+def test_incremental_update_equals_single_update():
+    whole = ClogDetector(window=15)
+    whole.update(reconstruct([series_events(range(DAYS), 1)]))
+    # Сначала поздние дни, затем ранние — ряд пересчитывается целиком
+    engine = TransactionEngine()
+    detector = ClogDetector(window=15)
+    engine.feed(series_events(range(DAYS // 2, DAYS), 1), stream=0)
+    detector.update(engine.transactions())
+    engine.feed(series_events(range(DAYS // 2), 1), stream=1)
+    detector.update(engine.transactions())
+    assert detector.alerts() == whole.alerts()
+    assert detector.update(engine.transactions()) == 0
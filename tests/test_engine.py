@@ -0,0 +1,101 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from src.engine import TransactionEngine, merge_events
+from src.events import Event, EventKind, to_timestamp
+from tests.conftest import transaction_events
+
+
+def reconstruct(streams):
+    engine = TransactionEngine()
+    engine.feed(merge_events(streams))
+    return engine, engine.transactions()
+
+
+def test_transaction_fields():
+    _, transactions = reconstruct([transaction_events("АЗС001", 3, datetime(2024, 3, 1, 10), 61, 100.0, 20.0)])
+    assert len(transactions) == 1
+    assert transactions.stations == ["АЗС001"]
+    assert transactions.fuels == ["АИ-92"]
+    assert transactions.trk[0] == 3
+    assert transactions.liters[0] == pytest.approx(20.0)
+    # Отпуск начался через секунду после установки дозы и длился минуту
+    assert transactions.flow[0] == pytest.approx(20.0)
+    assert not transactions.outlier[0]
+
+
+def test_counter_rollover():
+    _, transactions = reconstruct([transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10), 61, 999990.0, 25.0)])
+    assert transactions.liters[0] == pytest.approx(25.0)
+    assert transactions.flow[0] == pytest.approx(25.0)
+
+
+def test_transaction_end_without_start():
+    moment = to_timestamp(datetime(2024, 3, 1, 10))
+    events = [Event(EventKind.TRANSACTION_END, "АЗС001", 1, moment, counter=120.0)]
+    events += transaction_events("АЗС001", 1, datetime(2024, 3, 1, 11), 61, 120.0, 10.0)
+    engine, transactions = reconstruct([events])
+    assert len(transactions) == 1
+    assert transactions.liters[0] == pytest.approx(10.0)
+    assert engine.metrics.counters['dropped_incomplete'] == 1
+    assert engine.metrics.stations["АЗС001"]['dropped_incomplete'] == 1
+
+
+def test_nan_counter_is_dropped():
+    events = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10), 61, 100.0, 10.0)
+    events[-1].counter = float('nan')
+    engine, transactions = reconstruct([events])
+    assert len(transactions) == 0
+    assert engine.metrics.counters['dropped_nan'] == 1
+
+
+def test_nan_start_counter_is_dropped():
+    events = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10), 61, 100.0, 10.0)
+    events[1].counter = float('nan')
+    engine, transactions = reconstruct([events])
+    assert len(transactions) == 0
+    assert engine.metrics.counters['dropped_nan'] == 1
+
+
+def test_moved_order_counts_only_started_transactions():
+    first = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10), 61, 100.0, 10.0)
+    second = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10, 5), 61, 100.0, 10.0)
+    # Первый заказ перемещен до отпуска, второй — во время отпуска
+    events = (first[:2] + [Event(EventKind.ORDER_MOVED, "АЗС001", 1, first[1].timestamp, target=2)] + second[:3] +
+              [Event(EventKind.ORDER_MOVED, "АЗС001", 1, second[2].timestamp, target=2)])
+    engine, transactions = reconstruct([events])
+    assert len(transactions) == 0
+    assert engine.metrics.counters['dropped_moved'] == 1
+
+
+def test_separate_streams_do_not_mix():
+    events = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10), 61, 100.0, 20.0)
+    engine = TransactionEngine()
+    engine.feed(events[:3], stream='a')
+    engine.feed(events[3:], stream='b')
+    assert len(engine) == 0
+    assert engine.metrics.counters['dropped_incomplete'] == 1
+    np.testing.assert_array_equal(engine.transactions().start, [])
+
+
+def test_cross_file_transaction():
+    events = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 23, 59, 30), 61, 100.0, 20.0)
+    # Начало транзакции — в логе одного дня, конец — в логе следующего; файлы поданы не по порядку
+    first, second = events[:3], events[3:]
+    _, transactions = reconstruct([second, first])
+    assert len(transactions) == 1
+    assert transactions.liters[0] == pytest.approx(20.0)
+    assert transactions.start[0] == to_timestamp(datetime(2024, 3, 1, 23, 59, 31))
+
+
+def test_merge_events_keeps_file_order():
+    a = transaction_events("АЗС001", 1, datetime(2024, 3, 1, 10), 61, 100.0, 20.0)
+    b = transaction_events("АЗС001", 2, datetime(2024, 3, 1, 10, 0, 30), 61, 200.0, 20.0)
+    merged = list(merge_events([a, b]))
+    assert sorted(merged, key=lambda event: event.timestamp) == merged
+    assert [event for event in merged if event.trk == 1] == a
+    # Списки разных АЗС не сливаются по времени, а идут один за другим
+    c = transaction_events("АЗС002", 1, datetime(2024, 3, 1, 9), 61, 100.0, 20.0)
+    assert list(merge_events([a, c])) == a + c
@@ -0,0 +1,91 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from src.events import to_timestamp
+from src.history import HistoryStore
+from src.parser import BBOXParser
+from src.partial import PartialResult
+from tests.conftest import transaction_rows, write_days
+
+DAYS = [datetime(2024, 2, 27) + timedelta(days=day) for day in range(40)]
+
+
+# Отпуск начинается через секунду после установки дозы
+FLOW = 30 / (119 / 60)
+
+
+def day_rows(days, liters=20):
+    rows = []
+    for number, day in enumerate(days):
+        rows += transaction_rows(1, day + timedelta(hours=10), 60, 1000 + 100 * number, liters)
+        rows += transaction_rows(2, day + timedelta(hours=15), 120, 5000 + 100 * number, 30, fuel="ДТ")
+    return rows
+
+
+def result(paths):
+    items = []
+    for path in paths:
+        partial = BBOXParser(mode='stream')
+        assert partial.parse_file(path)
+        items.append((path, partial))
+    return PartialResult.merge_all(PartialResult.from_files(items))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / "history.sqlite3"))
+
+
+def test_add_is_idempotent(store, tmp_path):
+    paths = write_days(str(tmp_path / "logs"), "АЗС001", day_rows(DAYS))
+    assert store.add(result(paths[:10])) == 20
+    assert store.add(result(paths[:10])) == 0
+    # Перекрывающийся набор — добавляются только новые файлы
+    assert store.add(result(paths[5:])) == 60
+    assert store.series() == [("АЗС001", 1, "АИ-92"), ("АЗС001", 2, "ДТ")]
+    assert store.date_range() == (DAYS[0].date(), DAYS[-1].date())
+    rows = store.rows(("АЗС001", 2, "ДТ"))
+    assert len(rows['start']) == 40
+    assert np.all(np.diff(rows['start']) > 0)
+    assert rows['flow'] == pytest.approx(np.full(40, FLOW))
+
+
+def test_aggregate_matches_transactions(store, tmp_path):
+    store.add(result(write_days(str(tmp_path / "logs"), "АЗС001", day_rows(DAYS))))
+    # Середина месяца с обеих сторон: целый март берется из месячных агрегатов, края — из суточных
+    start, end = to_timestamp(datetime(2024, 2, 28)), to_timestamp(datetime(2024, 4, 3))
+    total = store.aggregate(start=start, end=end)
+    days = (end - start) // (24 * 3600 * 1000000)
+    assert [(row['trk'], row['transactions']) for row in total] == [(1, days), (2, days)]
+    assert total[0]['liters'] == pytest.approx(20 * days)
+    assert total[1]['mean_flow'] == pytest.approx(FLOW, abs=0.001)
+    assert total[1]['minutes'] == pytest.approx(119 / 60 * days, abs=0.001)
+    by_day = store.aggregate(trk=1, start=start, end=end, by='day')
+    assert [row['period'] for row in by_day] == [(datetime(2024, 2, 28) + timedelta(days=day)).date().isoformat()
+                                                 for day in range(days)]
+    by_month = store.aggregate(fuel="ДТ", by='month')
+    assert [(row['period'], row['transactions']) for row in by_month] == [("2024-02", 3), ("2024-03", 31),
+                                                                          ("2024-04", 6)]
+    with pytest.raises(ValueError):
+        store.aggregate(by='week')
+
+
+def test_grown_file_adds_only_new_transactions(store, tmp_path):
+    path, = write_days(str(tmp_path / "logs"), "АЗС001", day_rows(DAYS[:1]))
+    store.add(result([path]))
+    # Тот же лог дописан: начало файла то же, транзакции в нем повторяются
+    write_days(str(tmp_path / "logs"), "АЗС001", day_rows(DAYS[:1]) +
+               transaction_rows(1, DAYS[0] + timedelta(hours=20), 60, 3000, 10))
+    assert store.add(result([path])) == 1
+    assert store.aggregate(trk=1)[0]['transactions'] == 2
+
+
+def test_other_version_is_rejected(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    with sqlite3.connect(path) as connection:
+        connection.execute("PRAGMA user_version = 99")
+    with pytest.raises(ValueError, match="версия истории"):
+        HistoryStore(path)
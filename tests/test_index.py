@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from src.engine import TransactionEngine
+from src.index import SeriesIndex, flow_grid
+from tests.conftest import transaction_events
+
+KEYS = [("АЗС001", 1, "АИ-92"), ("АЗС001", 2, "ДТ"), ("АЗС002", 1, "АИ-92")]
+
+
+@pytest.fixture(scope='module')
+def transactions():
+    """Неделя транзакций трех рядов со случайными временем и объемом"""
+    rng = np.random.default_rng(3)
+    engine = TransactionEngine()
+    for number, (station, trk, fuel) in enumerate(KEYS):
+        counter = 1000.0
+        events = []
+        for minute in sorted(rng.choice(7 * 24 * 60 - 5, 200, replace=False).tolist()):
+            liters = round(float(rng.uniform(5, 60)), 2)
+            events += transaction_events(station, trk, datetime(2024, 3, 4) + timedelta(minutes=minute), 61, counter,
+                                         liters, fuel=fuel)
+            counter += liters
+        engine.feed(events, stream=number)
+    return engine.transactions()
+
+
+def test_flow_grid_cells():
+    rows = np.array([0, 0, 1, 1, 1])
+    start = np.array([0, 9, 10, 55, 99])
+    flow = np.array([10.0, 20.0, 30.0, 40.0, 50.0])
+    edges, mean, counts = flow_grid(rows, start, flow, 3, 0, 100, 4)
+    assert edges.tolist() == [0, 25, 50, 75, 100]
+    assert counts.tolist() == [[2, 0, 0, 0], [1, 0, 1, 1], [0, 0, 0, 0]]
+    np.testing.assert_array_equal(mean, [[15, np.nan, np.nan, np.nan], [30, np.nan, 40, 50],
+                                         [np.nan, np.nan, np.nan, np.nan]])
+
+
+def test_grid_equals_series_by_series(transactions):
+    index = SeriesIndex(transactions)
+    start = int(transactions.start.min()) + 3600 * 1000000
+    end = int(transactions.start.max()) - 3600 * 1000000
+    keys = KEYS + [("АЗС003", 1, "АИ-92")]
+    edges, mean, counts = index.grid(keys, start, end, 24)
+    assert len(edges) == 25 and mean.shape == counts.shape == (4, 24)
+    for row, key in enumerate(keys):
+        lo, hi = index.range(key, start, end)
+        _, expected_mean, expected_counts = flow_grid(np.zeros(hi - lo, dtype=np.int64), index.start[lo:hi],
+                                                      index.flow[lo:hi], 1, start, end, 24)
+        np.testing.assert_array_equal(counts[row], expected_counts[0])
+        np.testing.assert_allclose(mean[row], expected_mean[0])
+    assert counts[:3].sum() == sum(hi - lo for lo, hi in (index.range(key, start, end) for key in KEYS))
+    assert not counts[3].any()
+
+
+def test_extend_equals_rebuild(transactions):
+    # Последняя порция с новым рядом и транзакциями внутри уже занятых отрезков старых рядов
+    order = np.argsort(transactions.start, kind='stable')
+    later = np.isin(order, np.flatnonzero(transactions.mask(*KEYS[2])))
+    later[len(order) // 2:] = True
+    later[:len(order) // 2:7] = True
+    head, tail = np.sort(order[~later]), order[later]
+    whole = SeriesIndex(transactions)
+    first = SeriesIndex(transactions.take(head))
+    extended = first.extend(transactions.take(tail))
+    assert extended.series == whole.series
+    for name in ('start', 'duration', 'flow', 'liters'):
+        np.testing.assert_array_equal(getattr(extended, name), getattr(whole, name))
+    # Исходный индекс не меняется
+    assert len(first.start) == len(head)
+    assert first.extend(transactions.take(np.empty(0, dtype=np.int64))) is first
@@ -0,0 +1,74 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from src.events import to_timestamp
+from src.manifest import Manifest
+from src.parser import BBOXParser
+from tests.conftest import transaction_rows, write_days
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """Логи двух АЗС за четыре дня: {АЗС: [пути по дням]}"""
+    return {station: write_days(str(tmp_path / "logs"), station,
+                                [row for day in range(1, 5)
+                                 for row in transaction_rows(1, datetime(2024, 3, day, 10), 60, 100 * day, 20)])
+            for station in ("АЗС001", "АЗС002")}
+
+
+def files(archive):
+    return archive["АЗС001"] + archive["АЗС002"]
+
+
+def test_select_by_station_and_dates(archive):
+    manifest = Manifest()
+    assert manifest.refresh(files(archive)) == 8
+    assert manifest.stations() == ["АЗС001", "АЗС002"]
+    assert manifest.select(files(archive)) == files(archive)
+    assert manifest.select(files(archive), station="АЗС002") == archive["АЗС002"]
+    # Второй день с соседними по времени файлами той же АЗС
+    start, end = to_timestamp(datetime(2024, 3, 2)), to_timestamp(datetime(2024, 3, 3))
+    assert manifest.select(files(archive), "АЗС001", start, end) == archive["АЗС001"][:3]
+    assert manifest.select(files(archive), None, start, end) == archive["АЗС001"][:3] + archive["АЗС002"][:3]
+    assert manifest.select(files(archive), "АЗС001", to_timestamp(datetime(2024, 3, 4))) == archive["АЗС001"][2:]
+
+
+def test_unknown_files_are_always_selected(archive):
+    manifest = Manifest()
+    manifest.refresh(archive["АЗС001"])
+    extra = archive["АЗС002"][0]
+    assert manifest.select(archive["АЗС001"] + [extra], "АЗС001", to_timestamp(datetime(2024, 3, 4))) == \
+           archive["АЗС001"][2:] + [extra]
+
+
+def test_saved_manifest_rescans_changed_files(archive, tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = Manifest(path)
+    manifest.refresh(files(archive))
+    partial = BBOXParser(mode='stream')
+    assert partial.parse_file(archive["АЗС001"][0])
+    manifest.record(archive["АЗС001"][0], partial)
+    manifest.save()
+    loaded = Manifest(path)
+    assert loaded.entries == manifest.entries
+    assert loaded.entries[archive["АЗС001"][0]]['exact']
+    assert loaded.refresh(files(archive)) == 0
+    changed = archive["АЗС002"][3]
+    with open(changed, 'a', encoding='cp1251') as f:
+        f.write('\n')
+    stat = os.stat(changed)
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert loaded.refresh(files(archive)) == 1
+    assert loaded.date_range() == (datetime(2024, 3, 1).date(), datetime(2024, 3, 4).date())
+
+
+def test_broken_manifest_is_rebuilt_with_warning(archive, tmp_path):
+    path = str(tmp_path / "manifest.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{')
+    manifest = Manifest(path)
+    assert manifest.entries == {}
+    assert manifest.metrics.counters['manifest_errors'] == 1
+    assert manifest.refresh(files(archive)) == 8
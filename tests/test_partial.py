@@ -0,0 +1,131 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from src.engine import TransactionEngine, merge_events
+from src.parser import BBOXParser
+from src.partial import PartialResult, file_identity
+from tests.conftest import transaction_rows, write_days
+
+
+def parse(paths):
+    """[(путь, частичный BBOXParser)] — как при разборе по одному файлу в процессах"""
+    items = []
+    for path in paths:
+        partial = BBOXParser(mode='stream')
+        assert partial.parse_file(path)
+        items.append((path, partial))
+    return items
+
+
+def rows(transactions):
+    """Транзакции как отсортированный список строк, независимый от кодов станций и топлива"""
+    return sorted((transactions.stations[station], int(trk), transactions.fuels[fuel], int(start), int(end),
+                   round(float(liters), 6))
+                  for station, trk, fuel, start, end, liters in zip(transactions.station, transactions.trk,
+                                                                    transactions.fuel, transactions.start,
+                                                                    transactions.end, transactions.liters))
+
+
+def direct(paths):
+    parser = BBOXParser(mode='stream')
+    for path, partial in parse(paths):
+        parser.merge(partial)
+    engine = TransactionEngine()
+    engine.feed(merge_events(parser.data))
+    return engine.transactions()
+
+
+@pytest.fixture
+def day_logs(tmp_path):
+    """Логи двух АЗС за два дня, транзакции не переходят через полночь"""
+    paths = []
+    for number, station in enumerate(("АЗС001", "АЗС002")):
+        rows = (transaction_rows(1, datetime(2024, 3, 1, 10), 60, 100 + number, 20) +
+                transaction_rows(2, datetime(2024, 3, 2, 10), 90, 999990, 30, fuel="ДТ"))
+        paths.extend(write_days(str(tmp_path / "logs"), station, rows))
+    return paths
+
+
+def test_saved_results_merge_like_direct_parse(day_logs, tmp_path):
+    # Узлы — по АЗС; второй файл первой АЗС есть на обоих узлах
+    hosts = [day_logs[:2], day_logs[1:]]
+    paths = []
+    for number, files in enumerate(hosts):
+        path = str(tmp_path / f"host{number}.bbp")
+        PartialResult.merge_all([PartialResult.from_file(*item) for item in parse(files)]).save(path)
+        paths.append(path)
+    loaded = [PartialResult.load(path) for path in paths]
+    merged = PartialResult.merge_all(loaded)
+    assert len(merged.files) == 4
+    assert merged.stations == ["АЗС001", "АЗС002"]
+    assert rows(merged.transactions()) == rows(direct(day_logs))
+    assert rows(loaded[1].merge(loaded[0]).transactions()) == rows(merged.transactions())
+    assert merged.metrics().counters['transactions'] == 4
+
+
+def test_exclude_drops_files(day_logs):
+    merged = PartialResult.merge_all([PartialResult.from_file(*item) for item in parse(day_logs)])
+    kept = merged.exclude({file_identity(day_logs[0])[0]})
+    assert len(kept.files) == 3
+    assert rows(kept.transactions()) == rows(direct(day_logs[1:]))
+    assert merged.exclude(set()) is merged
+
+
+def test_files_of_host_are_rebuilt_together(midnight_logs):
+    results = PartialResult.from_files(parse(midnight_logs))
+    merged = PartialResult.merge_all(results)
+    assert len(merged) == 6
+    assert rows(merged.transactions()) == rows(direct(midnight_logs))
+    # Транзакция через полночь достается файлу, в котором закончилась
+    assert [len(result) for result in results] == [1, 2, 1, 2]
+
+
+def test_partial_merge_equals_direct_parse(midnight_logs, tmp_path):
+    # Узлы — по АЗС; первый файл второй АЗС есть на обоих узлах
+    hosts = [midnight_logs[:3], midnight_logs[2:]]
+    paths = []
+    for number, files in enumerate(hosts):
+        path = str(tmp_path / f"host{number}.bbp")
+        PartialResult.merge_all(PartialResult.from_files(parse(files))).save(path)
+        paths.append(path)
+    loaded = [PartialResult.load(path) for path in paths]
+    merged = PartialResult.merge_all(loaded)
+    assert len(merged.files) == 4
+    assert rows(merged.transactions()) == rows(direct(midnight_logs))
+    # Слияние не зависит от порядка
+    assert rows(PartialResult.merge_all(loaded[::-1]).transactions()) == rows(merged.transactions())
+    assert merged.metrics().counters['transactions'] == 6
+
+
+def test_context_gives_state_only(midnight_logs):
+    items = parse(midnight_logs[:2])
+    # Без первого дня транзакция через полночь неполная, с ним в контексте — полная, но сам день в результат не входит
+    alone = PartialResult.from_files(items[1:])
+    with_context = PartialResult.from_files(items[1:], context=items[0][1].data)
+    assert len(alone[0]) == 1
+    assert alone[0].metrics().counters['dropped_incomplete'] == 1
+    assert len(with_context[0]) == 2
+    assert [entry['name'] for entry in with_context[0].files] == ["BBOX.XML"]
+    assert sorted(with_context[0].columns['liters']) == pytest.approx([20.0, 30.0])
+
+
+def test_duplicate_with_transaction_end_does_not_depend_on_order(midnight_logs):
+    # На узле A оба дня первой АЗС, на узле B — только второй, где заканчивается транзакция через полночь
+    a = PartialResult.merge_all(PartialResult.from_files(parse(midnight_logs[:2])))
+    b = PartialResult.merge_all(PartialResult.from_files(parse(midnight_logs[1:2])))
+    assert len(a) == 3 and len(b) == 1
+    forward = PartialResult.merge_all([a, b])
+    backward = PartialResult.merge_all([b, a])
+    assert len(forward) == len(backward) == 3
+    assert rows(forward.transactions()) == rows(backward.transactions()) == rows(direct(midnight_logs[:2]))
+    assert forward.metrics().counters == backward.metrics().counters
+    assert forward.metrics().counters.get('dropped_incomplete', 0) == 0
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = str(tmp_path / "other.npz")
+    np.savez(path, values=np.arange(3))
+    with pytest.raises(ValueError, match="не частичный результат"):
+        PartialResult.load(path)
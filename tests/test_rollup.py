@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from src.engine import TransactionEngine
+from src.events import to_timestamp
+from src.rollup import SKETCH_ACCURACY, US_PER_HOUR, US_PER_WEEK, Rollups
+from tests.conftest import transaction_events
+
+KEYS = [("АЗС001", 1, "АИ-92"), ("АЗС001", 2, "ДТ")]
+
+
+@pytest.fixture(scope='module')
+def transactions():
+    """Три недели транзакций двух ТРК со случайной скоростью"""
+    rng = np.random.default_rng(7)
+    engine = TransactionEngine()
+    for number, (station, trk, fuel) in enumerate(KEYS):
+        counter = 1000.0
+        events = []
+        for day in range(21):
+            for minute in sorted(rng.choice(24 * 60 - 5, 20, replace=False).tolist()):
+                liters = round(float(rng.uniform(5, 60)), 2)
+                events += transaction_events(station, trk, datetime(2024, 3, 4) + timedelta(days=day, minutes=minute),
+                                             61, counter, liters, fuel=fuel)
+                counter += liters
+        engine.feed(events, stream=number)
+    return engine.transactions()
+
+
+def expected(transactions, key, start, end):
+    mask = transactions.mask(*key) & (transactions.start >= start) & (transactions.start < end)
+    return transactions.flow[mask]
+
+
+@pytest.mark.parametrize('start, end', [
+    (datetime(2024, 3, 4), datetime(2024, 3, 25)),  # Недели
+    (datetime(2024, 3, 6), datetime(2024, 3, 13)),  # Дни
+    (datetime(2024, 3, 6, 7), datetime(2024, 3, 9, 19)),  # Часы
+])
+def test_stats_match_transactions(transactions, start, end):
+    rollups = Rollups.from_transactions(transactions)
+    start, end = to_timestamp(start), to_timestamp(end)
+    for key in KEYS:
+        flow = expected(transactions, key, start, end)
+        stats = rollups.stats(key, start, end)
+        assert stats['transactions'] == len(flow)
+        assert stats['mean_flow'] == pytest.approx(flow.mean())
+        for name, level in (('p10_flow', 0.1), ('median_flow', 0.5), ('p90_flow', 0.9)):
+            assert stats[name] == pytest.approx(np.quantile(flow, level, method='lower'), rel=SKETCH_ACCURACY)
+
+
+def test_level_follows_bounds(transactions):
+    rollups = Rollups.from_transactions(transactions)
+    assert rollups.level(to_timestamp(datetime(2024, 3, 4)), to_timestamp(datetime(2024, 3, 11))) == US_PER_WEEK
+    assert rollups.level(to_timestamp(datetime(2024, 3, 4, 7)), None) == US_PER_HOUR
+    assert rollups.stats(("АЗС002", 1, "АИ-92")) is None
+
+
+def test_merge_equals_single_rollup(transactions):
+    whole = Rollups.from_transactions(transactions)
+    # Части в разном порядке, вторая добавляет новый ряд к первому
+    middle = len(transactions) // 3
+    first = Rollups.from_transactions(transactions.take(np.arange(middle)))
+    rest = Rollups.from_transactions(transactions, middle)
+    ranges = [(None, None), (to_timestamp(datetime(2024, 3, 6)), to_timestamp(datetime(2024, 3, 13))),
+              (to_timestamp(datetime(2024, 3, 6, 7)), to_timestamp(datetime(2024, 3, 9, 19)))]
+    for merged in (first.merge(rest), rest.merge(first), Rollups().merge(first).merge(rest)):
+        assert sorted(merged.keys) == sorted(whole.keys)
+        for key in KEYS:
+            for start, end in ranges:
+                stats, reference = merged.stats(key, start, end), whole.stats(key, start, end)
+                assert stats == pytest.approx(reference)
@@ -0,0 +1,73 @@
+import gzip
+import shutil
+from datetime import datetime
+
+import pytest
+
+from src.parser import BBOXParser
+from tests.conftest import HEADER, row_lines, transaction_rows
+
+ROWS = row_lines("АЗС001", transaction_rows(1, datetime(2024, 3, 1, 10), 60, 100, 20) +
+                 transaction_rows(2, datetime(2024, 3, 1, 11), 60, 999990, 30, fuel="ДТ"))
+
+
+def parse(path, mode):
+    parser = BBOXParser(mode=mode)
+    assert parser.parse_file(path)
+    return parser
+
+
+def same_result(path):
+    """Результаты scan и tree совпадают; возвращает парсер scan"""
+    scan, tree = parse(path, 'scan'), parse(path, 'tree')
+    assert [[repr(event) for event in events] for events in scan.data] == \
+           [[repr(event) for event in events] for events in tree.data]
+    assert (scan.gas_stations, scan.GlobalDict, scan.fuels, scan.columns) == \
+           (tree.gas_stations, tree.GlobalDict, tree.fuels, tree.columns)
+    assert scan.metrics.counters['rows'] == tree.metrics.counters['rows']
+    return scan
+
+
+def write(path, text, encoding='cp1251'):
+    with open(path, 'w', encoding=encoding) as f:
+        f.write(text)
+    return str(path)
+
+
+def test_scan_equals_tree(tmp_path):
+    scan = same_result(write(tmp_path / "BBOX.XML", HEADER + "".join(ROWS) + "</ROWDATA>\n"))
+    assert len(scan.data[0]) == 10
+    assert not scan.metrics.counters.get('scan_fallbacks')
+
+
+def test_scan_reads_compressed_files(tmp_path):
+    path = write(tmp_path / "BBOX.XML", HEADER + "".join(ROWS) + "</ROWDATA>\n")
+    with open(path, 'rb') as src, gzip.open(path + ".gz", 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    assert not same_result(path + ".gz").metrics.counters.get('scan_fallbacks')
+
+
+def test_entities_are_decoded_without_fallback(tmp_path):
+    rows = [row.replace("ТРК : ", "ТРК&#32;: ", 1) if "отпуск" in row else row for row in ROWS]
+    scan = same_result(write(tmp_path / "BBOX.XML", HEADER + "".join(rows) + "</ROWDATA>\n"))
+    assert len(scan.data[0]) == 10
+    assert not scan.metrics.counters.get('scan_fallbacks')
+
+
+@pytest.mark.parametrize('text, encoding', [
+    (HEADER + "<!-- комментарий -->\n" + "".join(ROWS) + "</ROWDATA>\n", 'cp1251'),
+    (HEADER + "".join(row.replace('"', "'") for row in ROWS) + "</ROWDATA>\n", 'cp1251'),
+    (HEADER.replace("windows-1251", "UTF-16") + "".join(ROWS) + "</ROWDATA>\n", 'utf-16'),
+])
+def test_unusual_markup_falls_back_to_xml_parser(tmp_path, text, encoding):
+    scan = same_result(write(tmp_path / "BBOX.XML", text, encoding))
+    assert len(scan.data[0]) == 10
+    assert scan.metrics.counters['scan_fallbacks'] == 1
+
+
+def test_broken_file_fails_like_tree(tmp_path):
+    path = write(tmp_path / "BBOX.XML", HEADER + "".join(ROWS) + "<ROW DATETIME=\n")
+    for mode in ('scan', 'tree'):
+        parser = BBOXParser(mode=mode)
+        assert not parser.parse_file(path)
+        assert parser.metrics.errors[0][0] == path
@@ -0,0 +1,68 @@
+import os
+from datetime import datetime
+
+from src.tail import FileTail
+from tests.conftest import HEADER, row_lines, transaction_rows
+
+FIRST = row_lines("АЗС001", transaction_rows(1, datetime(2024, 3, 1, 10), 60, 100, 20))
+SECOND = row_lines("АЗС001", transaction_rows(2, datetime(2024, 3, 1, 11), 60, 200, 30))
+
+
+def write(path, lines, mode='w'):
+    with open(path, mode, encoding='cp1251') as f:
+        f.writelines(lines)
+
+
+def events(tail):
+    partial = tail.poll()
+    return None if partial is None else partial.data[0]
+
+
+def test_only_appended_rows_are_read(tmp_path):
+    path = str(tmp_path / "BBOX.XML")
+    write(path, [HEADER] + FIRST)
+    tail = FileTail(path)
+    first = events(tail)
+    assert len(first) == 5
+    assert events(tail) is None
+    write(path, SECOND + ['</ROWDATA>\n'], 'a')
+    second = events(tail)
+    assert [event.trk for event in second] == [2] * 5
+    assert not tail.restarted
+    assert tail.closed
+    assert events(tail) is None
+
+
+def test_rewritten_file_is_read_again(tmp_path):
+    path = str(tmp_path / "BBOX.XML")
+    write(path, [HEADER] + FIRST + SECOND)
+    tail = FileTail(path)
+    assert len(events(tail)) == 10
+    # Файл переписан заново и короче прежнего
+    write(path, [HEADER] + SECOND)
+    assert [event.trk for event in events(tail)] == [2] * 5
+    assert tail.restarted
+    # Тот же размер, но другое начало
+    write(path, [HEADER] + FIRST)
+    assert [event.trk for event in events(tail)] == [1] * 5
+    assert tail.restarted
+
+
+def test_replaced_file_is_read_again(tmp_path):
+    path = str(tmp_path / "BBOX.XML")
+    write(path, [HEADER] + FIRST)
+    tail = FileTail(path)
+    assert len(events(tail)) == 5
+    other = str(tmp_path / "BBOX.NEW")
+    write(other, [HEADER] + FIRST + SECOND)
+    os.replace(other, path)
+    assert len(events(tail)) == 10
+    assert tail.restarted
+
+
+def test_missing_file_is_waited_for(tmp_path):
+    path = str(tmp_path / "BBOX.XML")
+    tail = FileTail(path)
+    assert events(tail) is None
+    write(path, [HEADER] + FIRST)
+    assert len(events(tail)) == 5